@@ -33,6 +33,11 @@ use Getopt::Long;
 use v5.10;
 use Parallel::ForkManager;
 use Cwd;
+use Time::HiRes;
+use Storable qw(nstore retrieve);
+use Digest::MD5 qw(md5_hex);
+use Fcntl qw(:flock);
+use IO::Select;
 
 ##############
 ##Command-line
@@ -41,9 +46,18 @@ use Cwd;
 
 # nohup perl ./mQC.pl --experiment_name test --samfile untreat.sam --cores 20 --species mouse --ens_db ENS_mmu_86.db --ens_v 86 --offset plastid > nohup_mappingqc.txt &
 
-my($work_dir,$exp_name,$sam,$original_bam,$cores,$species,$version,$tmpfolder,$unique,$mapper,$maxmultimap,$ens_db,$offset_option,$offset_file,$cst_3prime_offset,$min_cst_3prime_offset,$max_cst_3prime_offset,$bam,$tool_dir,$plotrpftool,$min_length_plastid,$max_length_plastid,$min_length_gd,$max_length_gd,$outfolder,$outhtml,$outzip,$galaxy,$galaxysam,$galaxytest,$comp_logo);
+my($work_dir,$exp_name,$sam,$original_bam,$cores,$species,$version,$tmpfolder,$unique,$mapper,$maxmultimap,$ens_db,$offset_option,$offset_file,$cst_3prime_offset,$min_cst_3prime_offset,$max_cst_3prime_offset,$bam,$tool_dir,$plotrpftool,$min_length_plastid,$max_length_plastid,$min_length_gd,$max_length_gd,$outfolder,$outhtml,$outzip,$galaxy,$galaxysam,$galaxytest,$comp_logo,$mode,$shard,$shard_dir,$samplesheet,$annotation_cache,$offset_target_reads,$preview,$adaptive,$adaptive_chunks,$follow,$follow_interval,$follow_idle,$render_profile,$report,$single_file);
 my $help;
 
+#Number of relative position bins in the phase - relative position distribution
+my $pos_bins = 20;
+#QC summary format version and metagenic count classes (in the order of the annotation_coding table)
+my $qc_summary_version = 2;
+my @metagenic_classes = ('ribo', 'exon', '5utr', '3utr', 'intron', 'nc', 'intergenic');
+#P sites are sorted in chunks of this many positions, merged runs above this many bytes are spilled to disk
+my $psite_chunk_size = 1000000;
+my $psite_spill_bytes = 64 * 1024 * 1024;
+
 
 GetOptions(
 "work_dir:s" => \$work_dir,                 # The working directory                                         Optional argument (default: CWD)
@@ -74,6 +88,9 @@ GetOptions(
                                                 #grouped2D: use Seaborn to plot a grouped 2D bar chart (default)
                                                 #pyplot3D: use mplot3d to plot a 3D bar chart (Suffers sometimes from Escher effects)
                                                 #mayavi: use the mayavi package to plot a 3D bar chart (only on systems with graphics cards)
+"render_profile:s" => \$render_profile,     # Figure size, font size and resolution of the figures (fast/standard/print)  Optional argument (default: standard)
+"report:s" => \$report,                     # Report type: static (images) or interactive (charts drawn in the browser)  Optional argument (default: static)
+"single_file:s" => \$single_file,           # Self-contained HTML report with the images and logos inlined (Y/N)          Optional argument (default: N)
 "outfolder:s" => \$outfolder,               # The folder for storing output figures                                     Optional argument (default: workdir/mQC_output)
 "outhtml:s" => \$outhtml,                   # The output HTML file                                                      Optional argument (default: workdir/mQC_exp_name.html)
 "outzip:s" => \$outzip,                     # The output zip file                                                       Optional argument (default: workdir/mQC_exp_name.zip)
@@ -81,6 +98,18 @@ GetOptions(
 "galaxysam:s" => \$galaxysam,               # Parameter needed for galaxy version                                       Optional argument (default: Y)
 "galaxytest:s" => \$galaxytest,             # Parameter needed for galaxy version (to run tests)                        Optional argument (default: N)
 "comp_logo:s" => \$comp_logo,
+"mode:s" => \$mode,                         # Run mode: run, shard, merge, append or batch                              Optional argument (default: run)
+"shard:s" => \$shard,                       # The shard to run in shard mode, as index/total (e.g. 2/4)                  Mandatory if mode equals 'shard'
+"shard_dir:s" => \$shard_dir,               # The shared directory for the shard results                                Optional argument (default: workdir/mQC_shards)
+"samplesheet:s" => \$samplesheet,           # Tab-separated sample sheet (experiment name, SAM/BAM file)               Mandatory if mode equals 'batch'
+"offset_target_reads=i" => \$offset_target_reads,   # Start codon anchored reads per RPF length for native offsets           Optional argument (default: 5000, 0 for all reads)
+"preview:i" => \$preview,                   # Preview on a deterministic subsample of about this many alignments       Optional argument (default without value: 2000000)
+"adaptive:f" => \$adaptive,                 # Stop when the phase fractions change less than this tolerance between chunks  Optional argument (default without value: 0.005)
+"adaptive_chunks=i" => \$adaptive_chunks,   # Number of random read chunks in adaptive mode                             Optional argument (default: 16)
+"follow" => \$follow,                       # Follow a growing SAM/BAM file of a running aligner                        Optional argument
+"follow_interval=i" => \$follow_interval,   # Seconds between report updates in follow mode                              Optional argument (default: 60)
+"follow_idle=i" => \$follow_idle,           # Stop following after this many seconds without new alignments             Optional argument (default: 600)
+"annotation_cache:s" => \$annotation_cache,   # Shared cache directory for annotation derived files (plastid ROIs)       Optional argument (default: workdir/mQC_annotation_cache)
 "help" => \$help                            # Help text option
 );
 
@@ -103,7 +132,61 @@ if ($work_dir){
     print "Working directory                                        : $work_dir\n";
 }
 my $TMP             = ($ENV{'TMP'}) ? $ENV{'TMP'} : ($tmpfolder) ? $tmpfolder : "$CWD/tmp"; # (1) get the TMP environment variable, (2) get the $tmpfolder variable, (3) get current_working_dir/tmp
+#Run mode
+my ($shard_index, $shard_count);
+if ($mode){
+    if ($mode ne "run" && $mode ne "shard" && $mode ne "merge" && $mode ne "append" && $mode ne "batch"){
+        die "ERROR: mode should be 'run', 'shard', 'merge', 'append' or 'batch'!\n";
+    }
+} else {
+    $mode = "run";
+}
+print "Run mode                                                 : $mode\n";
+if (defined $preview){
+    if ($mode ne "run"){
+        die "ERROR: preview can only be used in run mode!\n";
+    }
+    $preview = 2000000 if ($preview <= 0);
+    print "Preview on a subsample of about                          : $preview alignments\n";
+    #The preview works in its own tmp folder, so it never mixes with the full run
+    $TMP = $TMP."/preview";
+}
+if ($follow){
+    if ($mode ne "run" || defined $preview || defined $adaptive){
+        die "ERROR: follow can only be used in run mode, without preview or adaptive early stopping!\n";
+    }
+    $follow_interval = 60 unless ($follow_interval && $follow_interval > 0);
+    $follow_idle = 600 unless ($follow_idle && $follow_idle > 0);
+    print "Follow the input, report every                           : $follow_interval s (stop after $follow_idle s idle)\n";
+}
+if (defined $adaptive){
+    if ($mode ne "run"){
+        die "ERROR: adaptive early stopping can only be used in run mode!\n";
+    }
+    $adaptive = 0.005 if ($adaptive <= 0);
+    $adaptive_chunks = 16 unless ($adaptive_chunks && $adaptive_chunks >= 2);
+    print "Adaptive early stopping: phase fraction tolerance        : $adaptive (".$adaptive_chunks." chunks)\n";
+}
+if ($mode eq "shard"){
+    if ($shard && $shard =~ m/^(\d+)\/(\d+)$/ && $1 >= 1 && $1 <= $2){
+        ($shard_index, $shard_count) = ($1, $2);
+        print "Shard                                                    : $shard\n";
+    } else {
+        die "ERROR: shard mode needs a shard as index/total (e.g. --shard 2/4)!\n";
+    }
+    #Every shard works in its own tmp folder, so shards can also run next to each other on one host
+    $TMP = $TMP."/shard_".$shard_index."_of_".$shard_count;
+}
 print "The following tmpfolder is used                          : $TMP\n";
+if ($mode eq "shard" || $mode eq "merge"){
+    unless ($shard_dir) {
+        $shard_dir = $work_dir."/mQC_shards";
+    }
+    print "The shard directory is                                   : $shard_dir\n";
+    if (!-e $shard_dir) {
+        system("mkdir -p ".$shard_dir);
+    }
+}
 if ($galaxy){
     if ($galaxy ne 'N' && $galaxy ne 'Y'){
         print "ERROR: galaxy option should be Y or N!\n";
@@ -129,10 +212,13 @@ if ($galaxy){
 
 #Check if tmpfolder exists, if not create it...
 if (!-e "$TMP") {
-    system ("mkdir ". $TMP);
+    system ("mkdir -p ". $TMP);
 }
 if ($exp_name){
     print "The experiment name                                      : $exp_name\n";
+} elsif ($mode eq "batch"){
+    #Every sample of the sample sheet has its own experiment name
+    $exp_name = "batch";
 } else {
     print_help_text();
     print "\n\n\n";
@@ -140,9 +226,67 @@ if ($exp_name){
 }
 
 
+#Streaming input: alignments out of stdin or a named pipe are read only once, while splitting them per chromosome
+my $stream_input;
+if (defined $sam && ($sam eq "-" || -p $sam)){
+    if ($mode eq "batch" || $mode eq "merge" || defined $preview || $follow){
+        die "ERROR: streaming input (stdin or named pipe) can not be used in batch or merge mode, or with preview or follow!\n";
+    }
+    $stream_input = $sam;
+    $sam = $TMP."/stream.sam"; #Name for the splitted files, this file is never written
+    print "Streaming input (read once)                              : ".(($stream_input eq "-") ? "stdin" : $stream_input)."\n";
+}
+
+#Fingerprint of the input file, to recognise inputs that are already part of the QC summary
+my $input_name = (!defined $stream_input) ? $sam : ($stream_input eq "-") ? "stdin" : $stream_input;
+#A stream can not be read twice, so it gets a fingerprint of its own
+#A followed file may not exist yet, its fingerprint is taken at every update
+my $input_fingerprint = (defined $stream_input) ? "stream-".md5_hex($input_name."\t".time()) : ($mode ne "merge" && $mode ne "batch" && !$follow) ? input_fingerprint($sam) : "";
+if ($mode eq "append"){
+    my $previous_summary_file = $TMP."/mappingqc/qc_summary.bin";
+    if (! -e $previous_summary_file){
+        die "ERROR: append mode needs the QC summary of a previous run of this experiment (".$previous_summary_file.")!\n";
+    }
+    if (exists read_qc_summary($previous_summary_file)->{'inputs'}->{$input_fingerprint}){
+        print "Input file ".$sam." is already part of the QC summary, nothing to append\n";
+        exit;
+    }
+}
+
+#Preview: hash-based subsample of the alignments (all alignments of a read are kept or dropped together)
+my $preview_fraction = 1;
+my $analysed_fraction = 1;
+if (defined $preview){
+    my $total_alignments = count_input_alignments($sam);
+    $preview_fraction = ($total_alignments > $preview) ? $preview / $total_alignments : 1;
+    printf("Preview subsample fraction                               : %.6f (of %d alignments)\n", $preview_fraction, $total_alignments);
+    if (! -e $TMP."/preview.sam"){
+        my $subsample = "";
+        if ($preview_fraction < 1){
+            #samtools -s SEED.FRACTION hashes the read name, so the subsample is the same in every run
+            $subsample = sprintf("%.6f", ($preview_fraction > 0.000001) ? $preview_fraction : 0.000001);
+            $subsample =~ s/^0//;
+            $subsample = " -s 42".$subsample;
+        }
+        system("samtools view -h".$subsample." ".$sam." > ".$TMP."/preview.sam.tmp");
+        system("mv ".$TMP."/preview.sam.tmp ".$TMP."/preview.sam");
+    }
+    $sam = $TMP."/preview.sam";
+}
+
 #Check the extension of the input file
 my $ext = "";
-if($sam =~ m/\.([^.]+)$/){
+my $samples;
+if($mode eq "batch"){
+    #Batch: input files come from the sample sheet
+    if ($samplesheet){
+        print "The sample sheet                                         : $samplesheet\n";
+    } else {
+        die "ERROR: batch mode needs a sample sheet (--samplesheet)!\n";
+    }
+    $samples = read_samplesheet($samplesheet);
+    print "Number of samples                                        : ".scalar(@{$samples})."\n";
+} elsif($sam =~ m/\.([^.]+)$/){
     $ext = $1;
     if ($ext eq "sam"){
         if ($sam){
@@ -153,8 +297,8 @@ if($sam =~ m/\.([^.]+)$/){
     } elsif ($ext eq "bam"){
         if ($sam){
             print "the input bam file                                       : $sam\n";
-            #Convert input bam file to sam format
-            system("samtools view -h ".$sam." > ".$TMP."/input.sam");
+            #Convert input bam file to sam format (a followed bam file is read while it grows)
+            system("samtools view -h ".$sam." > ".$TMP."/input.sam") unless ($follow);
             $original_bam = $sam;
             $sam = $TMP."/input.sam";
         } else {
@@ -270,18 +414,10 @@ if (!-e $tool_dir."/mQC.py"){
     print "Could not find the python mappingQC plotting script mQC.py!\n";
     die;
 }
-if (!-e $tool_dir."/metagenic_piecharts.R"){
-    print "Could not find the R metagenic distribution plotting script metagenic_piecharts.R!\n";
-    die;
-}
-if (!-e $tool_dir."/quality_plots.R"){
-    print "Could not find the R quality plotting script quality_plots.R!\n";
-    die;
-}
 if ($outfolder){
     print "The figure output folder is                              : $outfolder\n";
 } else {
-    $outfolder = $work_dir."/mQC_output/";
+    $outfolder = $work_dir.((defined $preview) ? "/mQC_output_preview/" : "/mQC_output/");
     print "The figure output folder is                              : $outfolder\n";
 }
 if ($plotrpftool){
@@ -304,16 +440,44 @@ if ($plotrpftool){
     $plotrpftool = "grouped2D";
     print "RPF phase plotting tool:                                 : $plotrpftool\n";
 }
+if ($render_profile){
+    if ($render_profile ne "fast" && $render_profile ne "standard" && $render_profile ne "print"){
+        die "The render_profile option should be 'fast', 'standard' or 'print'!\n";
+    }
+} else {
+    $render_profile = "standard";
+}
+print "Figure rendering profile                                 : $render_profile\n";
+if ($report){
+    if ($report ne "static" && $report ne "interactive"){
+        die "The report option should be 'static' or 'interactive'!\n";
+    }
+    if ($report eq "interactive" && !-e $tool_dir."/mqc_report.js"){
+        print "Could not find the javascript renderer of the interactive report mqc_report.js!\n";
+        die;
+    }
+} else {
+    $report = "static";
+}
+print "Report type                                              : $report\n";
+if ($single_file){
+    if ($single_file ne "Y" && $single_file ne "N"){
+        die "ERROR: single_file option should be 'Y' or 'N'!";
+    }
+} else {
+    $single_file = "N";
+}
+print "Self-contained HTML report                               : $single_file\n";
 if ($outhtml){
     print "The output HTML file is                                  : $outhtml\n";
 } else {
-    $outhtml = $work_dir."/mQC_".$exp_name.".html";
+    $outhtml = $work_dir."/mQC_".$exp_name.((defined $preview) ? "_preview" : "").".html";
     print "The output HTML file is                                  : $outhtml\n";
 }
 if ($outzip){
     print "The output zip file is                                   : $outzip\n";
 } else {
-    $outzip = $work_dir."/mQC_".$exp_name.".zip";
+    $outzip = $work_dir."/mQC_".$exp_name.((defined $preview) ? "_preview" : "").".zip";
     print "The output zip file is                                   : $outzip\n";
 }
 unless ($comp_logo) {
@@ -358,10 +522,10 @@ if ($maxmultimap){
     print "Maximun number of loci for reads to be acceptable        : $maxmultimap\n";
 }
 if ($offset_option) {
-    if ($offset_option eq "standard" || $offset_option eq "from_file" || $offset_option eq "plastid" || $offset_option eq "cst_3prime") {
+    if ($offset_option eq "standard" || $offset_option eq "from_file" || $offset_option eq "plastid" || $offset_option eq "native" || $offset_option eq "cst_3prime") {
         print "Offset source                                            : $offset_option\n";
     } else {
-        die "Offset argument needs to be \" standard\", \"from_file\", \"cst_3prime\" or \"plastid\"!";
+        die "Offset argument needs to be \" standard\", \"from_file\", \"cst_3prime\", \"plastid\" or \"native\"!";
     }
 } else {
     $offset_option = "standard";
@@ -376,7 +540,19 @@ if ($offset_option eq "from_file"){
 } else {
     $offset_file = "";
 }
-if ($offset_option eq "plastid"){
+if (defined $stream_input && ($offset_option eq "plastid" || $offset_option eq "native") && (!$bam || $bam eq "convert")){
+    #A stream can not be converted to bam afterwards
+    die "ERROR: plastid and native offsets of a streaming input need a bam file (--plastid_bam)!\n";
+}
+if ($follow && ($offset_option eq "plastid" || $offset_option eq "native")){
+    #Plastid and native offsets need the complete (indexed) bam file
+    die "ERROR: follow mode needs the \"standard\", \"from_file\" or \"cst_3prime\" offsets!\n";
+}
+if ($offset_option eq "native" && $mode eq "shard"){
+    #Each shard only has the start codons of its own chromosomes, but the merge needs equal offsets
+    die "ERROR: native offsets can not be used in shard mode, use \"from_file\" with the offsets of a previous run!\n";
+}
+if ($offset_option eq "plastid" || $offset_option eq "native"){
     if ($bam){
         if ($bam eq "convert"){
             print "Bam file for plastid offset generation will be converted out of sam file\n";
@@ -399,6 +575,18 @@ if ($offset_option eq "plastid"){
         $max_length_plastid = 34;
         print "Maximum length for plastid offset generation             : $max_length_plastid\n";
     }
+    if ($offset_option eq "native"){
+        unless (defined $offset_target_reads) {
+            $offset_target_reads = 5000;
+        }
+        print "Target anchored reads per RPF length for native offsets  : ".(($offset_target_reads > 0) ? $offset_target_reads : "all")."\n";
+    }
+    if ($offset_option eq "plastid"){
+        unless ($annotation_cache) {
+            $annotation_cache = $work_dir."/mQC_annotation_cache";
+        }
+        print "Annotation cache directory                               : $annotation_cache\n";
+    }
 }
 unless ($cst_3prime_offset) {
     $cst_3prime_offset = 15; #Default value
@@ -433,6 +621,23 @@ if ($cores) {
     print "Number of cores to use for analysis                      : $cores\n";
 }
 
+#Merge mode: combine the results of all shards and make the output
+if ($mode eq "merge"){
+    print "\n\nMERGE SHARDS\n";
+    if (! -e $TMP."/mappingqc"){
+        system("mkdir ".$TMP."/mappingqc");
+    }
+    my ($summary, $offset_hash, $shard_offset_option, $offset_img) = merge_shards($shard_dir, $exp_name);
+    $offset_option = $shard_offset_option;
+    offsets_to_csv($offset_hash, $TMP);
+    
+    print "PREPARE DATA FOR PLOTTING MODULES\n";
+    prepare_plot_data($summary, $offset_hash, get_nPCbiotypes($ens_db, "", ""));
+    run_plotting_script($offset_img);
+    print "   DONE! \n";
+    exit;
+}
+
 #Download ChromInfo.txt (cfr. get_igenomes.py script PROTEOFORMER)
 if (! -e $TMP."/ChromInfo.txt"){
     download_chrominfo($TMP, $ucsc);
@@ -454,6 +659,15 @@ if($galaxytest eq 'Y'){
     $chr_sizesY{'Y'} = $chr_sizes{'Y'};
     %chr_sizes = %chr_sizesY;
 }
+
+#Shard mode: only keep the chromosomes of this shard
+if ($mode eq "shard"){
+    %chr_sizes = %{select_shard_chromosomes(\%chr_sizes, $shard_index, $shard_count)};
+    if (!%chr_sizes){
+        die "ERROR: shard ".$shard." has no chromosomes, use less shards!\n";
+    }
+    print "Chromosomes of shard ".$shard."                             : ".join(",", sort keys %chr_sizes)."\n";
+}
     
 #Download chromosome sequences
 if (! -e $TMP."/Chromosomes"){
@@ -473,13 +687,14 @@ if ($cores>15){
 } else {
     $cores_download = $cores;
 }
-my $pm_download = new Parallel::ForkManager($cores_download);
+my %download_durations;
+my $pm_download = init_worker_pool($cores_download, \%download_durations);
 print "   Using ".$cores_download." core(s) (max 15)\n   ----------------------\n";
 
-foreach my $chr (keys %chr_sizes){
+foreach my $chr (schedule_chromosomes(\%chr_sizes, \%chr_sizes)){
     
     ### Start parallel process
-    $pm_download->start and next;
+    $pm_download->start($chr) and next;
     
     ### Download chromosome per process
     if (! -e $TMP."/Chromosomes/".$chr.".fa"){
@@ -494,6 +709,7 @@ foreach my $chr (keys %chr_sizes){
 }
 
 $pm_download->wait_all_children;
+report_task_durations("Chromosome download", \%download_durations);
 print "\n";
 
 
@@ -523,6 +739,35 @@ if ($galaxytest eq 'Y') {
 print "\nChecking/Creating binary chrom files ...\n";
 create_BIN_chromosomes($BIN_chrom_dir,$cores,$chrs,$work_dir,$TMP);
 
+#Batch mode: all samples share the annotation and one worker pool
+if ($mode eq "batch"){
+    $work_dir = Cwd::abs_path($work_dir);
+    $TMP = Cwd::abs_path($TMP);
+    foreach my $sample (@{$samples}){
+        $sample->{'tmp'} = $TMP."/samples/".$sample->{'name'};
+        $sample->{'outfolder'} = $work_dir."/mQC_output/".$sample->{'name'}."/";
+        $sample->{'outhtml'} = $work_dir."/mQC_".$sample->{'name'}.".html";
+        $sample->{'outzip'} = $work_dir."/mQC_".$sample->{'name'}.".zip";
+        $sample->{'fingerprint'} = input_fingerprint($sample->{'input'});
+    }
+    run_batch($samples, \%chr_sizes);
+    
+    print "   DONE! \n";
+    my $end = time - $start;
+    printf("Runtime: %02d:%02d:%02d\n\n",int($end/3600), int(($end % 3600)/60), int($end % 60));
+    exit;
+}
+
+#Follow mode: live QC while the aligner is still writing the input file
+if ($follow){
+    run_follow(\%chr_sizes);
+    
+    print "   DONE! \n";
+    my $end = time - $start;
+    printf("Runtime: %02d:%02d:%02d\n\n",int($end/3600), int(($end % 3600)/60), int($end % 60));
+    exit;
+}
+
 #Sam file splitting
 print "\n";
 if (! -e $TMP."/mappingqc"){
@@ -540,7 +785,7 @@ if(uc($species) eq "SL1344" || uc($species) eq "MYC_ABS_ATCC_19977"){
     $samfilechr1 = $TMP."/mappingqc/".$samFileName."_1.sam";
 }
 
-if (-e $samfilechr1){
+if (-e $samfilechr1 && $mode ne "append" && !defined $stream_input){
     print "Splitted sam files already exist\n";
 } else {
     print "Splitting genomic mapping per chromosome\n";
@@ -550,62 +795,20 @@ if (-e $samfilechr1){
 # Construct p offset hash
 print "\n";
 my $offset_hash = {};
-if($offset_option eq "plastid"){
-    
-    $offset_hash = run_plastid($bam, $TMP, $version, $spec, $assembly, $exp_name, $min_length_plastid, $max_length_plastid);
-    
-} elsif($offset_option eq "from_file"){
-    #Init
-    $offset_hash->{"min"} = 1000;
-    $offset_hash->{"max"} = 0;
-    #Read in file
-    open(my $FR, $offset_file) or die "Could not open $offset_file";
-    
-    #Parse
-    while(my $line = <$FR>){
-        if($line =~ /^(\d+)\s+(\d+)$/){
-            my $length = $1;
-            my $offset = $2;
-            $offset_hash->{$length} = $offset;
-            if($length<$offset_hash->{"min"}){
-                $offset_hash->{"min"} = $length;
-            }
-            if($length>$offset_hash->{"max"}){
-                $offset_hash->{"max"} = $length;
-            }
-        }
-    }
-} elsif($offset_option eq "cst_3prime"){
+my $annotation;
+if($mode eq "append"){
     
-    #Translate constant 3 prime offsets into 5 prime offsets
-    $offset_hash->{"min"} = $min_cst_3prime_offset;
-    $offset_hash->{"max"} = $max_cst_3prime_offset;
-    for(my $rpf = $offset_hash->{"min"}; $rpf<=$offset_hash->{"max"}; $rpf++){
-        $offset_hash->{$rpf} = $rpf - $cst_3prime_offset - 1
-    }
+    #Counts of the new input are added to the previous ones, so keep the offsets of the previous run
+    print "Use the offsets of the previous run\n";
+    $offset_hash = read_offsets_csv($TMP);
     
 } else {
-    #Standard P site offset options from Ingolia paper (2012) (cfr. suppl methods in that paper)
-    if(uc($species) eq 'FRUITFLY'){
-        $offset_hash->{25} = 12;
-    }
-    $offset_hash->{26} = 12;
-    $offset_hash->{27} = 12;
-    $offset_hash->{28} = 12;
-    $offset_hash->{29} = 12;
-    $offset_hash->{30} = 12;
-    $offset_hash->{31} = 13;
-    $offset_hash->{32} = 13;
-    $offset_hash->{33} = 13;
-    $offset_hash->{34} = 14;
-    
-    #Boundaries
-    if(uc($species) eq 'FRUITFLY'){
-        $offset_hash->{"min"} = 25;
-    } else {
-        $offset_hash->{"min"} = 26;
+    if ($offset_option eq "native"){
+        #Native offsets need the start codons of the annotation index
+        print "Build annotation index\n";
+        $annotation = build_annotation_index($ens_db, $coord_system_id, \%chr_sizes, $cores);
     }
-    $offset_hash->{"max"} = 34;
+    $offset_hash = construct_offsets();
 }
 
 #Write offsets to csv for output html file
@@ -615,187 +818,121 @@ offsets_to_csv($offset_hash, $TMP);
 print "\n\n";
 
 
-if ((!-e $TMP."/mappingqc/rpf_phase.csv") || (!-e $TMP."/mappingqc/pos_table_all.csv") || (!-e $TMP."/mappingqc/total_triplet.csv") || (!-e $TMP."/mappingqc/rankedgenes.png") || (!-e $TMP."/mappingqc/cumulative.png") || (!-e $TMP."/mappingqc/density.png") || (!-e $TMP."/mappingqc/annotation_coding.png") || (!-e $TMP."/mappingqc/annotation_noncoding.png")){
+#Shard results
+my $shard_base = ($mode eq "shard") ? $exp_name."_shard_".$shard_index."_of_".$shard_count : "";
+#A new stream or appended input always has to be analysed, whatever a previous run left in the tmp folder
+my $fused_done = ($mode eq "append" || defined $stream_input) ? 0 : ($mode eq "shard") ? (-e $shard_dir."/".$shard_base.".manifest") : ((-e $TMP."/mappingqc/rpf_phase.csv") && (-e $TMP."/mappingqc/pos_table_all.csv") && (-e $TMP."/mappingqc/total_triplet.csv") && !grep { !-e $TMP."/mappingqc/".$_ } ("genedistribution.txt", "annotation_coding.txt", "annotation_noncoding.txt"));
 
-    print "RIBOSOMAL PARSING\n";
-    system("mkdir ".$TMP."/counts");
-    # Init multi core
-    my $pm = new Parallel::ForkManager($cores);
-    print "   Using ".$cores." core(s)\n   ---------------\n";
+if (!$fused_done){
 
-    foreach my $chr (keys %chr_sizes){
+    print "FUSED CHROMOSOMAL ANALYSIS\n";
+    print "   (phase, triplet, gene distribution and metagenic classification in one pass per chromosome)\n";
+    
+    #The non-coding biotypes are the same for all chromosomes, so query them only once
+    my $biotypes = get_nPCbiotypes($db_ENS, $us_ENS, $pw_ENS);
+    
+    #Build the annotation index once, all workers share it (copy-on-write after fork)
+    if (!defined $annotation){
+        print "   Build annotation index\n";
+        $annotation = build_annotation_index($ens_db, $coord_system_id, \%chr_sizes, $cores);
+    }
+    
+    print "   Using ".$cores." core(s)\n   ---------------\n";
+    my $read_counts = get_chr_read_counts(\%chr_sizes, $samFileName);
+    
+    #Adaptive mode: rounds over random chunks of the reads until the phase fractions converge
+    my $summary = new_qc_summary($pos_bins);
+    my $rounds = (defined $adaptive) ? $adaptive_chunks : 1;
+    my $previous_fractions;
+    for (my $round = 0; $round < $rounds; $round++){
+        my $chunk = (defined $adaptive) ? $round : undef;
+        if (defined $adaptive){
+            print "   Round ".($round + 1)." of at most ".$rounds." (chunk ".($round + 1)."/".$adaptive_chunks." of the reads)\n";
+        }
         
-        ### Start parallel process
-        $pm->start and next;
+        # Init multi core, largest chromosomes (in reads) first
+        my %task_durations;
+        my $pm = init_worker_pool($cores, \%task_durations);
         
-        ### RIBO parsing
-        RIBO_parsing_genomic_per_chr($work_dir,$sam,$chr,$ens_db,$coord_system_id, $offset_hash, $min_length_gd, $max_length_gd);
+        foreach my $chr (schedule_chromosomes(\%chr_sizes, $read_counts)){
+            
+            ### Start parallel process
+            $pm->start($chr) and next;
+            
+            ### Fused analysis
+            fused_analysis_per_chr($sam,$chr,$annotation->{$chr}, $offset_hash, $min_length_gd, $max_length_gd, $biotypes, $chunk);
+            
+            ### Finish
+            print "* Finished chromosome ".$chr."\n";
+            $pm->finish;
+        }
         
-        ### Finish
-        print "* Finished chromosome ".$chr."\n";
-        $pm->finish;
-    }
-
-    # Finish all subprocesses
-    $pm->wait_all_children;
-    print "\n\n";
-
-
-
-
-
-    print "PREPARE DATA FOR PLOTTING MODULES\n";
-
-    ## RPF PHASE TABLE ##
-    print "\tRPF phase table\n";
-    #Count rpf phase table of all chromosomes together
-    my $temp_csv_rpf_phase = $TMP."/mappingqc/rpf_phase.csv";
-    system("touch ".$temp_csv_rpf_phase);
-
-    my $rpf_phase = {};
-    for (my $i=$offset_hash->{'min'};$i<=$offset_hash->{'max'};$i++){
-        for (my $j=0;$j<=2;$j++){
-            $rpf_phase->{$i}->{$j} = 0;
+        # Finish all subprocesses
+        $pm->wait_all_children;
+        report_task_durations("Fused chromosomal analysis", \%task_durations);
+        print "\n\n";
+        
+        #Merge the chromosomal QC summaries
+        foreach my $chr (sort keys %chr_sizes){
+            my $chr_summary_file = $TMP."/mappingqc/qc_summary_".$chr.".bin";
+            merge_qc_summaries($summary, read_qc_summary($chr_summary_file));
+            system("rm -rf ".$chr_summary_file);
         }
-    }
-    foreach my $chr (keys %chr_sizes){
-        my $infile = $TMP."/mappingqc/rpf_phase_".$chr.".csv";
-        open(IN,"<".$infile) or die $!;
-        while(my $line = <IN>){
-            my @linesplit = split(',',$line);
-            $rpf_phase->{$linesplit[0]}->{0} = $rpf_phase->{$linesplit[0]}->{0} + $linesplit[1];
-            $rpf_phase->{$linesplit[0]}->{1} = $rpf_phase->{$linesplit[0]}->{1} + $linesplit[2];
-            $rpf_phase->{$linesplit[0]}->{2} = $rpf_phase->{$linesplit[0]}->{2} + $linesplit[3];
+        
+        #Stop when no phase fraction changed more than the tolerance since the previous round
+        if (defined $adaptive){
+            $analysed_fraction = ($round + 1) / $adaptive_chunks;
+            my $fractions = phase_fractions($summary->{'rpf_phase'});
+            if (defined $previous_fractions){
+                my $change = phase_fractions_change($previous_fractions, $fractions);
+                printf("   Largest phase fraction change: %.5f (tolerance %.5f)\n\n", $change, $adaptive);
+                if ($change < $adaptive){
+                    print "   Phase fractions converged after ".($round + 1)." of ".$adaptive_chunks." chunks\n\n";
+                    last;
+                }
+            }
+            $previous_fractions = $fractions;
         }
-        close(IN);
-        system("rm -rf ".$infile);
-    }
-
-    #Write rpf phase table to temp csv
-    open(OUT_PHASE, "+>>".$temp_csv_rpf_phase);
-    foreach my $rpf (keys %{$rpf_phase}){
-        print OUT_PHASE $rpf.",".$rpf_phase->{$rpf}->{0}.",".$rpf_phase->{$rpf}->{1}.",".$rpf_phase->{$rpf}->{2}."\n";
-    }
-    close(OUT_PHASE);
-
-    ## PHASE RELATIVE POSITION DISTRIBUTION
-    print "\tPhase - relative position distribution\n";
-    #Cat phase-position tmp files
-    my $temp_csv_all_pos = $TMP."/mappingqc/pos_table_all.csv";
-    system("touch ".$temp_csv_all_pos);
-
-    foreach my $chr (keys %chr_sizes){
-        my $temp_csv_chr_pos = $TMP."/mappingqc/phase_position_".$chr.".csv";
-        system("cat ".$temp_csv_chr_pos." >> ".$temp_csv_all_pos);
-        system("rm -rf ".$temp_csv_chr_pos);
     }
-
-    ## TRIPLET IDENTITY PHASE FILE
-    print "\tTriplet identity distributions\n";
-    my $all_codons = all_codons();
-    my $all_phases = ['0', '1', '2'];
-    #Read in chr tmp files
-    #Init hash
-    my $triplet_phase = {};
-    foreach my $triplet (@$all_codons){
-        foreach my $phase (@$all_phases){
-            $triplet_phase->{$triplet}->{$phase} = 0;
-        }
-    }
-    foreach my $chr (keys %chr_sizes){
-        my $infile = $TMP."/mappingqc/triplet_phase_".$chr.".csv";
-        open(IN, "< ".$infile) or die $!;
-        while(my $line = <IN>){
-            chomp($line);
-            my @linesplit = split(',',$line);
-            my $triplet = $linesplit[0];
-            my $phase = $linesplit[1];
-            my $count = $linesplit[2];
-            $triplet_phase->{$triplet}->{$phase} = $triplet_phase->{$triplet}->{$phase} + $count;
-        }
-        close(IN);
-        system("rm -rf ".$infile);
+    if (defined $adaptive){
+        write_phase_estimates($summary->{'rpf_phase'}, $TMP."/mappingqc/phase_estimates.csv");
+        system("rm -f ".$TMP."/mappingqc/".$samFileName."_*_chunk*.sam");
     }
-
-    #Write total file for triplet identity
-    my $temp_total_triplet = $TMP."/mappingqc/total_triplet.csv";
-    open(OUT_TOTAL_TRIPLET, "+>> ".$temp_total_triplet);
-    foreach my $triplet (keys %{$triplet_phase}){
-        foreach my $phase (keys %{$triplet_phase->{$triplet}}){
-            print OUT_TOTAL_TRIPLET $triplet.",".$phase.",".$triplet_phase->{$triplet}->{$phase}."\n";
+    $summary->{'inputs'}->{$input_fingerprint} = {'name' => $input_name, 'alignments' => get_primary_alignments($samFileName, $sam)};
+    
+    if ($mode eq "shard"){
+        #Save the shard result in the shard directory, the manifest marks the shard as finished
+        print "SAVE SHARD RESULTS\n";
+        write_qc_summary($summary, $shard_dir."/".$shard_base.".bin");
+        my $offset_img = "";
+        if ($offset_option eq "plastid" || $offset_option eq "native"){
+            $offset_img = $shard_base."_p_offsets.png";
+            system("cp ".$TMP."/plastid/".$exp_name."_p_offsets.png ".$shard_dir."/".$offset_img);
         }
-    }
-    close(OUT_TOTAL_TRIPLET);
-    
-    ## NORMALIZED TRIPLET COUNTS FILE
-    print "\tNormalized triplet counts";
-    #Cat norm triplet count file
-    #Init hash
-    my $total_norm_triplet = {};
-    foreach my $triplet (@$all_codons){
-        $total_norm_triplet->{$triplet} = 0;
-    }
-    foreach my $chr (keys %chr_sizes){
-        my $infile = $TMP."/mappingqc/triplet_phase_norm_".$chr.".csv";
-        open(IN, "< ".$infile) or die $!;
-        while(my $line = <IN>){
-            chomp($line);
-            my @linesplit = split(',', $line);
-            my $triplet = $linesplit[0];
-            my $norm_count = $linesplit[1];
-            $total_norm_triplet->{$triplet} = $total_norm_triplet->{$triplet} + $norm_count;
+        write_shard_manifest($shard_dir."/".$shard_base.".manifest", $shard_base.".bin", \%chr_sizes, $offset_hash, $offset_img);
+    } else {
+        if ($mode eq "append"){
+            #Add the counts of the new input to the QC summary of the previous run(s)
+            print "Append to the QC summary of the previous run\n";
+            merge_qc_summaries($summary, read_qc_summary($TMP."/mappingqc/qc_summary.bin"));
         }
-        close(IN);
-    }
-    #Write total file for norm triplet counts
-    my $temp_total_norm_triplet = $TMP."/mappingqc/norm_triplet.csv";
-    open(OUT_NORM_TRIPLET, "+>> ".$temp_total_norm_triplet);
-    foreach my $triplet (keys %{$total_norm_triplet}){
-        print OUT_NORM_TRIPLET $triplet.",".$total_norm_triplet->{$triplet}."\n";
+        write_qc_summary($summary, $TMP."/mappingqc/qc_summary.bin");
+        print "PREPARE DATA FOR PLOTTING MODULES\n";
+        prepare_plot_data($summary, $offset_hash, $biotypes);
     }
-    close(OUT_NORM_TRIPLET);
-
-} else {
-    print "Ribosomal parsing already done\n"
-}
 
-###########
-## Gene distributions
-###########
-
-if((!-e $TMP."/mappingqc/rankedgenes.png") || (!-e $TMP."/mappingqc/cumulative.png") || (!-e $TMP."/mappingqc/density.png")){
-    print "\nGene distribution\n";
-    gene_distribution($db_ENS, $us_ENS, $pw_ENS, \%chr_sizes, $cores, $coord_system_id, $tool_dir);
 } else {
-    print "\nGene distribution already constructed\n";
+    print "Fused chromosomal analysis already done\n"
 }
 
-###########
-## Metagenic classification
-###########
-
-if((!-e $TMP."/mappingqc/annotation_coding.png") || (!-e $TMP."/mappingqc/annotation_noncoding.png")){
-    print "\nMetagenic classification\n";
-    metagenic_analysis($db_ENS, $us_ENS, $pw_ENS, \%chr_sizes, $cores, $coord_system_id, $tool_dir);
+if ($mode eq "shard"){
+    #Plotting and output are done by the merge
+    print "Shard ".$shard." finished, merge all shards with --mode merge\n";
 } else {
-    print "\nMetagenic classification already done\n";
+    #Run python plotting script
+    run_plotting_script($TMP."/plastid/".$exp_name."_p_offsets.png");
 }
 
-#Run python plotting script
-print "\n\n\n\n";
-print "Run python plotting script\n";
-if ($ext eq "bam"){
-    $sam = $original_bam;
-}
-my $python_command = "python ".$tool_dir."/mQC.py -g ".$galaxy." -a ".$galaxysam." -y ".$galaxytest." -t ".$TMP." -s ".$sam." -n ".$exp_name." -c ".$comp_logo." -o ".$outfolder." -h ".$outhtml." -z ".$outzip." -p \"".$offset_option."\" -e ".$ens_db." -d ".$species." -v ".$version." -u ".$unique." -x ".$plotrpftool;
-if ($offset_option eq "plastid"){
-    my $offset_img = $TMP."/plastid/".$exp_name."_p_offsets.png";
-    $python_command = $python_command." -i ".$offset_img;
-}
-print "Python command:\n\t";
-print $python_command."\n";
-system($python_command);
-
 
 # End time
 print "   DONE! \n";
@@ -812,841 +949,1712 @@ printf("Runtime: %02d:%02d:%02d\n\n",int($end/3600), int(($end % 3600)/60), int(
 sub gene_distribution_chr{
     
     #Catch
-    my $db_ens = $_[0];
-    my $us_ens = $_[1];
-    my $pw_ens = $_[2];
-    my $chr = $_[3];
-    my $coord_system_id = $_[4];
-    
-    #Open files
-    my $out_chr_table = $TMP."/mappingqc/genedistribution_".$chr.".txt";
-    open OUT_CHR_GD,"+>>".$out_chr_table or die $!;
-    
-    #Connect to ensembl db
-    my $dsn_ens = "DBI:SQLite:dbname=".$db_ens;
-    my $dbh = dbh($dsn_ens, $us_ens, $pw_ens);
-    
-    #Get seq region id
-    my $seq_region = get_seq_region_id($dbh, $chr, $coord_system_id);
-    
-    #Get all genes with start and stop position
-    my $query1 = "SELECT stable_id,seq_region_start,seq_region_end,seq_region_strand FROM gene WHERE seq_region_id = '$seq_region'";
-    my $execute1 = $dbh->prepare($query1);
-    $execute1->execute();
-    
-    my %genes;
-    while(my @result1 = $execute1->fetchrow_array()){
-        #$result1[0]: gene stable_id
-        #$result1[1]: gene seq_region_start
-        #$result1[2]: gene seq_region_end
-        #$result1[3]: gene seq_region_strand
-        
-        $genes{$chr.":".$result1[3]}{$result1[0]} = [$result1[1],$result1[2]];
-    }
-    $execute1->finish();
-    
-    #Disconnect from ensembl
-    $dbh->disconnect();
-    
-    #Make lists of genes (forward and reverse) sorted based on coordinates
-    my %for_genes = %{$genes{$chr.":1"}};
-    my %rev_genes = %{$genes{$chr.":-1"}};
-    my(@genes_for,@genes_rev);
-    foreach my $gene_id (sort { $genes{$chr.":1"}{$a}[0] <=> $genes{$chr.":1"}{$b}[0] } keys(%for_genes)){
-        push(@genes_for,$gene_id);
-    }
-    foreach my $gene_id (sort { $genes{$chr.":-1"}{$a}[0] <=> $genes{$chr.":-1"}{$b}[0] } keys(%rev_genes)){
-        push(@genes_rev,$gene_id);
-    }
+    my $annotation = $_[0];
+    my $chr = $_[1];
+    my $summary = $_[2];
+    my $psites = $_[3];
     
     ##############
     ## RIBO-SEQ -> READs (~A-site position): determine gene distribution
     ##############
-    print "\t\tAnnotating ribo-seq reads of chr ".$chr."\n";
-    
-    # Get ribo-seq reads, split per strand
-    my ($ribo_for, $pos_for) = get_reads($chr,1);
-    my ($ribo_rev, $pos_rev) = get_reads($chr,-1);
+    print "\t\tGene distribution of ribo-seq reads of chr ".$chr."\n";
     
     #Init
-    my %gene_count;
+    my $gene_count = $summary->{'genes'};
     my $intergenic_count;
     
-    # Loop over forward ribo-seq reads
-    my @window_genes_for = (); # Init window with genes
-    foreach my $pos (@{$pos_for}){
-        #Push all genes into window where start<window_pos
-        my $last_added_index_g = -1;
-        foreach my $gene_id (@genes_for){
-            if($genes{$chr.":1"}{$gene_id}[0] <= $pos){
-                $last_added_index_g++;
-                push(@window_genes_for,$gene_id);
-            }else{
-                #Don't unnecessarily loop over all genes
-                last;
-            }
-        }
+    foreach my $strand (1, -1){
+        my $genes = $annotation->{'genes'}->{$strand};
+        my $next_psite = psite_reader($psites->{$strand});
         
-        #Get rid of gene ids in gene list already in the window
-        splice(@genes_for, 0, $last_added_index_g+1);
-        
-        #Get rid of gene ids in window where end coordinate < window position
-        @window_genes_for = grep {$genes{$chr.":1"}{$_}[1] >= $pos} @window_genes_for;
-        
-        #Annotate read count for all genes in the window
-        my $def = 0;
-        foreach my $gene_id (@window_genes_for){
-            $def++; #defined in genes
-            $gene_count{$gene_id} += $ribo_for->{$pos}{'count'};
-        }
-        
-        if($def==0){
-            $intergenic_count += $ribo_for->{$pos}{'count'};
-        }
-    }#Close forward loop
-    
-    my @window_genes_rev = ();
-    #Loop over reverse ribo-seq reads
-    foreach my $pos (@{$pos_rev}){
-        #Push all genes into window where start<window_pos
-        my $last_added_index_g = -1;
-        foreach my $gene_id (@genes_rev){
-            if($genes{$chr.":-1"}{$gene_id}[0] <= $pos){
-                $last_added_index_g++;
-                push(@window_genes_rev,$gene_id);
-            }else{
-                #Don't unnecessarily loop over all genes
-                last;
+        # Loop over ribo-seq reads (genes are sorted on start coordinate)
+        my @window_genes = (); # Init window with genes
+        my $next_gene = 0;
+        while (my ($pos, $count) = $next_psite->()){
+            #Push all genes into window where start<window_pos
+            while($next_gene < $genes->{'n'} && vec($genes->{'starts'}, $next_gene, 32) <= $pos){
+                push(@window_genes, $next_gene);
+                $next_gene++;
+            }
+            
+            #Get rid of genes in window where end coordinate < window position
+            @window_genes = grep {vec($genes->{'ends'}, $_, 32) >= $pos} @window_genes;
+            
+            #Annotate read count for all genes in the window
+            if(@window_genes){
+                foreach my $gene (@window_genes){
+                    $gene_count->{$genes->{'ids'}->[$gene]} += $count;
+                }
+            } else {
+                $intergenic_count += $count;
             }
         }
-        
-        #Get rid of gene ids in gene list already in the window
-        splice(@genes_rev, 0, $last_added_index_g+1);
-        
-        #Get rid of gene ids in window where end coordinate < window position
-        @window_genes_rev = grep {$genes{$chr.":-1"}{$_}[1] >= $pos} @window_genes_rev;
-        
-        #Annotate read count for all genes in the window
-        my $def = 0;
-        foreach my $gene_id (@window_genes_rev){
-            $def++; #defined in genes
-            $gene_count{$gene_id} += $ribo_rev->{$pos}{'count'};
-        }
-        
-        if($def==0){
-            $intergenic_count += $ribo_rev->{$pos}{'count'};
-        }
-    }#Close reverse loop
-    
-    ##############
-    ## RESULTS: Make table
-    ##############
-    
-    foreach my $id (keys(%gene_count)){
-        print OUT_CHR_GD $id."\t".$gene_count{$id}."\n";
     }
-    close(OUT_CHR_GD);
     
     print "\t*) Finished gene distribution construction for chromosome ".$chr."\n";
     
     return;
 }
 
-## Gene distribution ##
-sub gene_distribution{
+## Metagenic analysis: chromosomal ##
+sub metagenic_analysis_chr{
     
     #Catch
-    my $db_ens = $_[0];
-    my $us_ens = $_[1];
-    my $pw_ens = $_[2];
-    my %chr_sizes = %{$_[3]};
-    my $cores = $_[4];
-    my $coord_system_id = $_[5];
-    my $tool_dir = $_[6];
-    
-    # Open files
-    my $out_table = $TMP."/mappingqc/genedistribution.txt";
-    system("rm -rf ".$out_table);
-    system("touch ".$out_table);
-    open(OUT_GD,"+>>".$out_table);
-    print OUT_GD "GeneID\tread_count\n";
-    close(OUT_GD);
-    
-    #Init multi core
-    my $processes = $cores; # Nr of processes
-    my $pm = new Parallel::ForkManager($processes); # Open fork
+    my $annotation = $_[0];
+    my $chr = $_[1];
+    my $biotypes = $_[2];
+    my $summary = $_[3];
+    my $psites = $_[4];
     
-    # Loop through chromosomes
-    foreach my $chr(keys(%chr_sizes)){
-        print "\tStarting analysis for chr ".$chr."...\n";
-        # Start parallel process
-        $pm->start and next;
-        
-        #Chromosomal gene distribution construction
-        gene_distribution_chr($db_ens, $us_ens, $pw_ens, $chr, $coord_system_id);
-        
-        # Close process
-        $pm->finish;
+    # Init biotype counts
+    my %biotypes_nc;
+    foreach my $biotype (keys %{$biotypes}){
+        $biotypes_nc{$biotype} = 0;
     }
     
-    # Finish forking
-    $pm->wait_all_children;
+    ###########
+    ## ANNOTATE RIBO-SEQ READS
+    ###########
+    print "\t\tMetagenic classification of ribo-seq reads of chr ".$chr."\n";
+    
+    # Init values
+    my ($ribo_reads,$ribo_readsnc) = (0,0);
+    my ($ribo_exon,$ribo_intron,$ribo_5utr,$ribo_3utr,$ribo_intergenic) = (0,0,0,0,0);
     
-    #Concatenate all chromosomal out tables
-    foreach my $chr(keys(%chr_sizes)){
-        my $chr_out_table = $TMP."/mappingqc/genedistribution_".$chr.".txt";
-        my $tmp_file = $TMP."/mappingqc/tmp.txt";
-        system("cat ".$out_table." ".$chr_out_table." > ".$tmp_file);
-        system("mv ".$tmp_file." ".$out_table);
-        system("rm -rf ".$chr_out_table);
+    foreach my $strand (1, -1){
+        my $coding = $annotation->{'coding'}->{$strand};
+        my $utr5 = $annotation->{'5UTR'}->{$strand};
+        my $utr3 = $annotation->{'3UTR'}->{$strand};
+        my $exon = $annotation->{'exon'}->{$strand};
+        my $trs_nc = $annotation->{'noncoding'}->{$strand};
+        my $next_psite = psite_reader($psites->{$strand});
+        
+        # Loop over ribo-seq reads
+        my @window_nc = (); # Init window with non protein-coding transcripts
+        my $next_nc = 0;
+        while (my ($pos, $count) = $next_psite->()){
+            #####
+            ## NON-CODING WINDOW
+            #####
+            # Push all transcripts to @window_nc where tr_start < window_pos
+            while($next_nc < $trs_nc->{'n'} && vec($trs_nc->{'starts'}, $next_nc, 32) <= $pos){
+                push(@window_nc, $next_nc);
+                $next_nc++;
+            }
+            
+            # Get rid of transcripts in @window_nc where tr_end < window_pos
+            @window_nc = grep {vec($trs_nc->{'ends'}, $_, 32) >= $pos} @window_nc;
+            
+            #####
+            ## ANNOTATE
+            #####
+            $ribo_reads = $ribo_reads + $count;
+            if(find_interval($coding, $pos) >= 0){
+                # Annotate reads in PROTEIN-CODING transcripts
+                
+                # Check 5'UTR
+                if(find_interval($utr5, $pos) >= 0){
+                    $ribo_5utr = $ribo_5utr + $count;
+                }
+                
+                # Check 3'UTR
+                elsif(find_interval($utr3, $pos) >= 0){
+                    $ribo_3utr = $ribo_3utr + $count;
+                }
+                
+                # Check Exons
+                elsif(find_interval($exon, $pos) >= 0){
+                    $ribo_exon = $ribo_exon + $count;
+                }
+                
+                # If still not defined -> intronic region
+                else{
+                    $ribo_intron = $ribo_intron + $count;
+                }
+            }elsif(@window_nc){
+                # Annotate reads in NON PROTEIN-CODING transcripts
+                $ribo_readsnc = $ribo_readsnc + $count;
+                
+                # Define biotype (if #biotypes>0, take a random/first one)
+                my $random = int(rand(@window_nc));
+                my $biotype = $trs_nc->{'biotypes'}->[$window_nc[$random]];
+                $biotypes_nc{$biotype} = $biotypes_nc{$biotype} + $count;
+            }else{
+                $ribo_intergenic = $ribo_intergenic + $count;
+            }
+        }
     }
     
-    #Make plots
-    print "Make gene distribution plots\n";
-    my $out_png1 = $TMP."/mappingqc/rankedgenes.png";
-    my $out_png2 = $TMP."/mappingqc/cumulative.png";
-    my $out_png3 = $TMP."/mappingqc/density.png";
-    make_plots_gd($out_table, $out_png1, $out_png2, $out_png3, $tool_dir);
+    # Save results in the QC summary
+    my %counts;
+    @counts{@metagenic_classes} = ($ribo_reads,$ribo_exon,$ribo_5utr,$ribo_3utr,$ribo_intron,$ribo_readsnc,$ribo_intergenic);
+    $counts{'biotypes'} = \%biotypes_nc;
+    $summary->{'metagenic'}->{$chr} = \%counts;
+    
+    print "\t*) Finished metagenic analysis for chromosome ".$chr."\n";
     
     return;
+    
 }
 
-## Make plots in R ##
-sub make_plots_gd{
+
+## QC summary: init an empty summary ##
+# A QC summary holds all counts of one shard (chromosome, lane, byte range, node...):
+#   rpf_phase:           {rpf length}{phase} = count
+#   pos_hist:            {phase}{bin} = count (relative position in CDS)
+#   triplet_phase:       {triplet}{phase} = count
+#   triplet_transcript:  {transcript}{triplet} = count (normalized triplet counts are derived at output)
+#   genes:               {gene id} = count
+#   metagenic:           {chr}{class} = count and {chr}{'biotypes'}{biotype} = count
+#   inputs:              {input fingerprint}{'name', 'alignments'} of the input files that were counted
+# Only raw counts are kept, so merging is a plain sum and shards can be merged in any order.
+# Inputs are merged as a set (shards of the same input file carry the same fingerprint).
+sub new_qc_summary {
     
     #Catch
-    my $out_table = $_[0];
-    my $out_png1 = $_[1];
-    my $out_png2 = $_[2];
-    my $out_png3 = $_[3];
-    my $tool_dir = $_[4];
-    
-    #Execute R script
-    system("Rscript ".$tool_dir."/quality_plots.R ".$out_table." ".$out_png1." ".$out_png2." ".$out_png3);
+    my $bins = $_[0];
+    
+    my $summary = {
+        'pos_bins' => $bins,
+        'rpf_phase' => {},
+        'pos_hist' => {},
+        'triplet_phase' => {},
+        'triplet_transcript' => {},
+        'genes' => {},
+        'metagenic' => {},
+        'inputs' => {}
+    };
+    for (my $phase=0;$phase<=2;$phase++){
+        for (my $bin=0;$bin<$bins;$bin++){
+            $summary->{'pos_hist'}->{$phase}->{$bin} = 0;
+        }
+    }
     
-    return;
+    return $summary;
 }
 
-## Metagenic analysis: chromosomal ##
-sub metagenic_analysis_chr{
+## QC summary: merge a summary into another one ##
+sub merge_qc_summaries {
     
     #Catch
-    my $db_ens = $_[0];
-    my $us_ens = $_[1];
-    my $pw_ens = $_[2];
-    my $chr = $_[3];
-    my $coord_system_id = $_[4];
-    
-    #####
-    # Ensembl info
-    ####
+    my $summary = $_[0];
+    my $other = $_[1];
     
-    #Connect to ensembl
-    my $dbh = DBI->connect('DBI:SQLite:'.$db_ens,$us_ens,$pw_ens,
-                    {RaiseError => 1},) || die "Database connection not made: $DBI::errstr";
+    if ($summary->{'pos_bins'} != $other->{'pos_bins'}){
+        die "ERROR: cannot merge QC summaries with a different number of position bins (".$summary->{'pos_bins'}." vs ".$other->{'pos_bins'}.")\n";
+    }
     
-    #chr nomenclature ens
-    if (uc($species) eq "FRUITFLY"){
-        if($chr eq "M"){
-            $chr = "dmel_mitochondrion_genome";
-        }
-    } elsif (uc($species) eq "YEAST") {
-        if($chr eq "MT"){
-            $chr = "Mito";
+    foreach my $rpf (keys %{$other->{'rpf_phase'}}){
+        for (my $phase=0;$phase<=2;$phase++){
+            $summary->{'rpf_phase'}->{$rpf}->{$phase} += $other->{'rpf_phase'}->{$rpf}->{$phase} // 0;
         }
-    } elsif (uc($species) eq "ZEBRAFISH"){
-        if($chr eq "MT"){
-            $chr = "MtDNA";
+    }
+    for (my $phase=0;$phase<=2;$phase++){
+        for (my $bin=0;$bin<$summary->{'pos_bins'};$bin++){
+            $summary->{'pos_hist'}->{$phase}->{$bin} += $other->{'pos_hist'}->{$phase}->{$bin};
         }
     }
-    
-    #Get seq_region_id
-    my $query = "SELECT seq_region_id FROM seq_region WHERE coord_system_id = '$coord_system_id' AND name = '$chr'";
-    my $execute = $dbh->prepare($query);
-    $execute->execute();
-    my $seq_region;
-    while(my @result = $execute->fetchrow_array()){
-        $seq_region = $result[0];
+    foreach my $triplet (keys %{$other->{'triplet_phase'}}){
+        for (my $phase=0;$phase<=2;$phase++){
+            $summary->{'triplet_phase'}->{$triplet}->{$phase} += $other->{'triplet_phase'}->{$triplet}->{$phase} // 0;
+        }
     }
-    $execute->finish();
-    
-    #change back chr nomenclature ens
-    if (uc($species) eq "FRUITFLY"){
-        if($chr eq "dmel_mitochondrion_genome"){
-            $chr = "M";
+    foreach my $transcript (keys %{$other->{'triplet_transcript'}}){
+        foreach my $triplet (keys %{$other->{'triplet_transcript'}->{$transcript}}){
+            $summary->{'triplet_transcript'}->{$transcript}->{$triplet} += $other->{'triplet_transcript'}->{$transcript}->{$triplet};
         }
-    } elsif (uc($species) eq "YEAST") {
-        if($chr eq "Mito"){
-            $chr = "MT";
+    }
+    foreach my $gene (keys %{$other->{'genes'}}){
+        $summary->{'genes'}->{$gene} += $other->{'genes'}->{$gene};
+    }
+    foreach my $chr (keys %{$other->{'metagenic'}}){
+        foreach my $class (@metagenic_classes){
+            $summary->{'metagenic'}->{$chr}->{$class} += $other->{'metagenic'}->{$chr}->{$class};
         }
-    } elsif (uc($species) eq "ZEBRAFISH"){
-        if($chr eq "MtDNA"){
-            $chr = "MT";
+        foreach my $biotype (keys %{$other->{'metagenic'}->{$chr}->{'biotypes'}}){
+            $summary->{'metagenic'}->{$chr}->{'biotypes'}->{$biotype} += $other->{'metagenic'}->{$chr}->{'biotypes'}->{$biotype};
         }
     }
+    foreach my $fingerprint (keys %{$other->{'inputs'}}){
+        $summary->{'inputs'}->{$fingerprint} //= {%{$other->{'inputs'}->{$fingerprint}}};
+    }
     
-    #######
-    # Transcripts
-    #######
+    return $summary;
+}
+
+## QC summary: write in compact binary form ##
+# Layout: magic "MQCS", format version, then every table as BER compressed integers
+# and length-prefixed strings. Keys are sorted, so equal summaries give identical files.
+sub write_qc_summary {
     
-    #Init
-    my $trs_c = {};
-    my $trs_nc = {};
+    #Catch
+    my $summary = $_[0];
+    my $file = $_[1];
     
-    #Get coding transcripts
-    my $query1 = "SELECT transcript_id,gene_id,seq_region_start,seq_region_end,seq_region_strand,biotype,stable_id FROM transcript WHERE seq_region_id = '$seq_region' AND biotype = 'protein_coding'";
-    my $execute1 = $dbh->prepare($query1);
-    $execute1->execute();
+    my ($template, @values) = ("a4 N w", "MQCS", $qc_summary_version, $summary->{'pos_bins'});
     
-    $trs_c = $execute1->fetchall_hashref('transcript_id');
-    $execute1->finish();
+    my @rpfs = sort {$a <=> $b} keys %{$summary->{'rpf_phase'}};
+    $template .= " w".(" w w w w" x @rpfs);
+    push(@values, scalar(@rpfs), map { ($_, @{$summary->{'rpf_phase'}->{$_}}{0,1,2}) } @rpfs);
     
-    # Get all other transcripts
-    my $query2 = "SELECT transcript_id,gene_id,seq_region_start,seq_region_end,seq_region_strand,biotype,stable_id FROM transcript WHERE seq_region_id = '$seq_region' AND biotype NOT LIKE '%protein_coding%'";
-    my $execute2 = $dbh->prepare($query2);
-    $execute2->execute();
+    $template .= " w" x (3 * $summary->{'pos_bins'});
+    for (my $phase=0;$phase<=2;$phase++){
+        push(@values, map { $summary->{'pos_hist'}->{$phase}->{$_} } (0..$summary->{'pos_bins'}-1));
+    }
     
-    $trs_nc = $execute2->fetchall_hashref('transcript_id');
-    $execute2->finish();
+    my @triplets = sort keys %{$summary->{'triplet_phase'}};
+    $template .= " w".(" w/a w w w" x @triplets);
+    push(@values, scalar(@triplets), map { ($_, @{$summary->{'triplet_phase'}->{$_}}{0,1,2}) } @triplets);
+    
+    my @transcripts = sort keys %{$summary->{'triplet_transcript'}};
+    $template .= " w";
+    push(@values, scalar(@transcripts));
+    foreach my $transcript (@transcripts){
+        my $counts = $summary->{'triplet_transcript'}->{$transcript};
+        my @tr_triplets = sort keys %{$counts};
+        $template .= " w/a w".(" w/a w" x @tr_triplets);
+        push(@values, $transcript, scalar(@tr_triplets), map { ($_, $counts->{$_}) } @tr_triplets);
+    }
     
-    # Split transcripts in forward and reverse arrays
-    my ($tr_c_for,$tr_c_rev);
-    foreach my $tr_id (sort { $trs_c->{$a}{'seq_region_start'} <=> $trs_c->{$b}{'seq_region_start'} } keys %{$trs_c}){
-        if($trs_c->{$tr_id}{'seq_region_strand'} eq '1'){	# Forward
-            push(@$tr_c_for,$tr_id);
-        }else{	# Reverse
-            push(@$tr_c_rev,$tr_id);
+    my @genes = sort keys %{$summary->{'genes'}};
+    $template .= " w".(" w/a w" x @genes);
+    push(@values, scalar(@genes), map { ($_, $summary->{'genes'}->{$_}) } @genes);
+    
+    my @chrs = sort keys %{$summary->{'metagenic'}};
+    $template .= " w";
+    push(@values, scalar(@chrs));
+    foreach my $chr (@chrs){
+        my $counts = $summary->{'metagenic'}->{$chr};
+        my @biotypes = sort keys %{$counts->{'biotypes'}};
+        $template .= " w/a".(" w" x @metagenic_classes)." w".(" w/a w" x @biotypes);
+        push(@values, $chr, @{$counts}{@metagenic_classes}, scalar(@biotypes), map { ($_, $counts->{'biotypes'}->{$_}) } @biotypes);
+    }
+    
+    my @inputs = sort keys %{$summary->{'inputs'}};
+    $template .= " w".(" w/a w/a w" x @inputs);
+    push(@values, scalar(@inputs), map { ($_, $summary->{'inputs'}->{$_}->{'name'}, $summary->{'inputs'}->{$_}->{'alignments'}) } @inputs);
+    
+    open(my $out, ">", $file.".tmp") or die "Cannot write QC summary ".$file.": $!\n";
+    binmode($out);
+    print $out pack($template, @values);
+    close($out);
+    rename($file.".tmp", $file) or die $!;
+    
+    return;
+}
+
+## QC summary: read from binary form ##
+sub read_qc_summary {
+    
+    #Catch
+    my $file = $_[0];
+    
+    open(my $in, "<", $file) or die "Cannot open QC summary ".$file.": $!\n";
+    binmode($in);
+    my $data = do { local $/; <$in> };
+    close($in);
+    
+    #Sequential reader over the packed data
+    my $offset = 0;
+    my $next = sub {
+        my @fields = unpack("\@".$offset." ".$_[0]." .*", $data);
+        $offset = pop(@fields);
+        return (wantarray) ? @fields : $fields[0];
+    };
+    
+    my ($magic, $version) = $next->("a4 N");
+    if ($magic ne "MQCS" || $version != $qc_summary_version){
+        die "ERROR: ".$file." is not a QC summary of format version ".$qc_summary_version."\n";
+    }
+    my $summary = new_qc_summary($next->("w"));
+    
+    for (my $n = $next->("w"); $n > 0; $n--){
+        my ($rpf, @counts) = $next->("w w w w");
+        @{$summary->{'rpf_phase'}->{$rpf}}{0,1,2} = @counts;
+    }
+    for (my $phase=0;$phase<=2;$phase++){
+        for (my $bin=0;$bin<$summary->{'pos_bins'};$bin++){
+            $summary->{'pos_hist'}->{$phase}->{$bin} = $next->("w");
+        }
+    }
+    for (my $n = $next->("w"); $n > 0; $n--){
+        my ($triplet, @counts) = $next->("w/a w w w");
+        @{$summary->{'triplet_phase'}->{$triplet}}{0,1,2} = @counts;
+    }
+    for (my $n = $next->("w"); $n > 0; $n--){
+        my ($transcript, $m) = $next->("w/a w");
+        for (; $m > 0; $m--){
+            my ($triplet, $count) = $next->("w/a w");
+            $summary->{'triplet_transcript'}->{$transcript}->{$triplet} = $count;
         }
     }
-    my ($tr_nc_for,$tr_nc_rev);
-    foreach my $tr_id (sort { $trs_nc->{$a}{'seq_region_start'} <=> $trs_nc->{$b}{'seq_region_start'} } keys %{$trs_nc}){
-        if($trs_nc->{$tr_id}{'seq_region_strand'} eq '1'){	# Forward strand
-            push(@$tr_nc_for,$tr_id);
-        }else{	# Reverse strand
-            push(@$tr_nc_rev,$tr_id);
+    for (my $n = $next->("w"); $n > 0; $n--){
+        my ($gene, $count) = $next->("w/a w");
+        $summary->{'genes'}->{$gene} = $count;
+    }
+    for (my $n = $next->("w"); $n > 0; $n--){
+        my $chr = $next->("w/a");
+        @{$summary->{'metagenic'}->{$chr}}{@metagenic_classes} = $next->(join(" ", ("w") x @metagenic_classes));
+        $summary->{'metagenic'}->{$chr}->{'biotypes'} = {};
+        for (my $m = $next->("w"); $m > 0; $m--){
+            my ($biotype, $count) = $next->("w/a w");
+            $summary->{'metagenic'}->{$chr}->{'biotypes'}->{$biotype} = $count;
         }
     }
+    for (my $n = $next->("w"); $n > 0; $n--){
+        my ($fingerprint, $name, $alignments) = $next->("w/a w/a w");
+        $summary->{'inputs'}->{$fingerprint} = {'name' => $name, 'alignments' => $alignments};
+    }
     
-    ###########
-    ## EXONs & UTRs
-    ###########
-    ## PROTEIN-CODING TRANSCRIPTS
-    ###########
-    # Init
-    my $exon = {};
-    my (%cds_for,%cds_rev); # CDS = UTRs + EXONs
-    
-    foreach my $tr_id(keys %{$trs_c}){
-        # Get all exons for obtained transcripts from tables exon and exon_transcript
-        my $query3 = "SELECT a.exon_id,b.seq_region_start,b.seq_region_end,b.seq_region_strand,a.rank FROM exon_transcript a JOIN exon b ON a.exon_id = b.exon_id WHERE a.transcript_id = '$tr_id'";
-        my $execute3 = $dbh->prepare($query3);
-        $execute3->execute();
-        $exon = $execute3->fetchall_hashref('exon_id');
-        
-        $execute3->execute();
-        my $highest_rank=0;
-        while(my @result3 = $execute3->fetchrow_array()){
-            #$result3[0]: exon_id
-            #$result3[1]: seq_region_start
-            #$result3[2]: seq_region_end
-            #$result3[3]: seq_region_strand
-            #$result3[4]: rank
-            
-            for(my $i1=$result3[1];$i1<=$result3[2];$i1++){
-                if($result3[3] == 1){	# Forward strand
-                    $cds_for{$chr.':'.$i1}{'exon'}++;
-                }else{	# Reverse strand
-                    $cds_rev{$chr.':'.$i1}{'exon'}++;
-                }
-            }
-            
-            #Search highest rank
-            if($result3[4]>$highest_rank){
-                $highest_rank = $result3[4];
+    return $summary;
+}
+
+## QC summary: write the tables used by the plotting modules ##
+sub qc_summary_to_tables {
+    
+    #Catch
+    my $summary = $_[0];
+    my $offset_hash = $_[1];
+    my $biotypes = $_[2];
+    
+    ## RPF PHASE TABLE ##
+    print "\tRPF phase table\n";
+    my %rpfs = map { $_ => 1 } keys %{$summary->{'rpf_phase'}};
+    for (my $i=$offset_hash->{'min'};$i<=$offset_hash->{'max'};$i++){
+        $rpfs{$i} = 1;
+    }
+    open(OUT_PHASE, ">".$TMP."/mappingqc/rpf_phase.csv") or die $!;
+    foreach my $rpf (sort {$a <=> $b} keys %rpfs){
+        print OUT_PHASE $rpf.",".join(",", map { $summary->{'rpf_phase'}->{$rpf}->{$_} // 0 } (0,1,2))."\n";
+    }
+    close(OUT_PHASE);
+    
+    ## PHASE RELATIVE POSITION DISTRIBUTION ##
+    print "\tPhase - relative position distribution\n";
+    open(OUT_POS, ">".$TMP."/mappingqc/pos_table_all.csv") or die $!;
+    for (my $phase=0;$phase<=2;$phase++){
+        for (my $bin=0;$bin<$summary->{'pos_bins'};$bin++){
+            print OUT_POS $phase.",".$bin.",".$summary->{'pos_hist'}->{$phase}->{$bin}."\n";
+        }
+    }
+    close(OUT_POS);
+    
+    ## TRIPLET IDENTITY PHASE FILE ##
+    print "\tTriplet identity distributions\n";
+    my %triplets = map { $_ => 1 } (@{all_codons()}, keys %{$summary->{'triplet_phase'}});
+    open(OUT_TOTAL_TRIPLET, ">".$TMP."/mappingqc/total_triplet.csv") or die $!;
+    foreach my $triplet (sort keys %triplets){
+        for (my $phase=0;$phase<=2;$phase++){
+            print OUT_TOTAL_TRIPLET $triplet.",".$phase.",".($summary->{'triplet_phase'}->{$triplet}->{$phase} // 0)."\n";
+        }
+    }
+    close(OUT_TOTAL_TRIPLET);
+    
+    ## NORMALIZED TRIPLET COUNTS FILE ##
+    # Triplet counts per transcript are normalized over the transcript expression
+    print "\tNormalized triplet counts\n";
+    my %norm_triplets = map { $_ => 0 } @{all_codons()};
+    foreach my $transcript (sort keys %{$summary->{'triplet_transcript'}}){
+        my $counts = $summary->{'triplet_transcript'}->{$transcript};
+        my $transcript_count = 0;
+        $transcript_count += $_ foreach (values %{$counts});
+        foreach my $triplet (sort keys %{$counts}){
+            $norm_triplets{$triplet} += $counts->{$triplet} / $transcript_count;
+        }
+    }
+    open(OUT_NORM_TRIPLET, ">".$TMP."/mappingqc/norm_triplet.csv") or die $!;
+    foreach my $triplet (sort keys %norm_triplets){
+        print OUT_NORM_TRIPLET $triplet.",".$norm_triplets{$triplet}."\n";
+    }
+    close(OUT_NORM_TRIPLET);
+    
+    ## GENE DISTRIBUTION TABLE ##
+    print "\tGene distribution table\n";
+    open(OUT_GD, ">".$TMP."/mappingqc/genedistribution.txt") or die $!;
+    print OUT_GD "GeneID\tread_count\n";
+    foreach my $gene (sort keys %{$summary->{'genes'}}){
+        print OUT_GD $gene."\t".$summary->{'genes'}->{$gene}."\n";
+    }
+    close(OUT_GD);
+    
+    ## METAGENIC CLASSIFICATION TABLES ##
+    print "\tMetagenic classification tables\n";
+    my %all_biotypes = %{$biotypes};
+    foreach my $chr (keys %{$summary->{'metagenic'}}){
+        $all_biotypes{$_} = 0 foreach (keys %{$summary->{'metagenic'}->{$chr}->{'biotypes'}});
+    }
+    open(OUT1, ">", $TMP."/mappingqc/annotation_coding.txt") or die $!;
+    open(OUT2, ">", $TMP."/mappingqc/annotation_noncoding.txt") or die $!;
+    print OUT1 "chr\tribo\texon\t5utr\t3utr\tintron\tnon_protein_coding\tintergenic\n";
+    print OUT2 "chr\tnon_protein_coding";
+    foreach my $biotype (sort keys %all_biotypes){
+        print OUT2 "\t".$biotype;
+    }
+    print OUT2 "\n";
+    foreach my $chr (sort keys %{$summary->{'metagenic'}}){
+        my $counts = $summary->{'metagenic'}->{$chr};
+        print OUT1 $chr."\t".join("\t", @{$counts}{@metagenic_classes})."\n";
+        print OUT2 $chr."\t".$counts->{'nc'};
+        foreach my $biotype (sort keys %all_biotypes){
+            print OUT2 "\t".($counts->{'biotypes'}->{$biotype} // 0);
+        }
+        print OUT2 "\n";
+    }
+    close(OUT1);
+    close(OUT2);
+    
+    return;
+}
+
+## P-site counts: init a collector for one chromosome strand ##
+# P sites are collected in chunks of packed 32 bit positions. Every full chunk is sorted and
+# run-length encoded into a run of sorted (position, count) pairs. Runs are merged two by two
+# like a binary counter, so all merging stays O(n log n). Merged runs larger than
+# $psite_spill_bytes are written to disk, which bounds the memory use for deep libraries.
+sub new_psite_collector {
+    
+    #Catch
+    my $spill_base = $_[0];
+    
+    return {'chunk' => '', 'n' => 0, 'levels' => [], 'spill_base' => $spill_base, 'spills' => 0};
+}
+
+## P-site counts: sort the current chunk into a run ##
+sub flush_psite_chunk {
+    
+    #Catch
+    my $collector = $_[0];
+    
+    return if ($collector->{'n'} == 0);
+    
+    #Sort and run-length encode
+    my @positions = sort {$a <=> $b} unpack("N*", $collector->{'chunk'});
+    $collector->{'chunk'} = '';
+    $collector->{'n'} = 0;
+    my $pairs = '';
+    my ($prev, $count) = ($positions[0], 0);
+    foreach my $pos (@positions){
+        if ($pos == $prev){
+            $count++;
+        } else {
+            $pairs .= pack("NN", $prev, $count);
+            ($prev, $count) = ($pos, 1);
+        }
+    }
+    $pairs .= pack("NN", $prev, $count);
+    
+    #Merge with the runs of the same level
+    my $run = {'data' => $pairs};
+    my $level = 0;
+    while (defined $collector->{'levels'}->[$level]){
+        $run = merge_psite_runs($collector, $collector->{'levels'}->[$level], $run);
+        $collector->{'levels'}->[$level] = undef;
+        $level++;
+    }
+    $collector->{'levels'}->[$level] = $run;
+    
+    return;
+}
+
+## P-site counts: get the final sorted run of a collector ##
+sub finish_psite_collector {
+    
+    #Catch
+    my $collector = $_[0];
+    
+    flush_psite_chunk($collector);
+    my $final;
+    foreach my $run (grep { defined $_ } @{$collector->{'levels'}}){
+        $final = (defined $final) ? merge_psite_runs($collector, $run, $final) : $run;
+    }
+    $collector->{'levels'} = [];
+    
+    return $final // {'data' => ''};
+}
+
+## P-site counts: merge two sorted runs, summing counts of equal positions ##
+sub merge_psite_runs {
+    
+    #Catch
+    my $collector = $_[0];
+    my $run_a = $_[1];
+    my $run_b = $_[2];
+    
+    #Large runs are spilled to disk
+    my $size = 0;
+    foreach my $run ($run_a, $run_b){
+        $size += (exists $run->{'file'}) ? -s $run->{'file'} : length($run->{'data'});
+    }
+    my ($out, $file, $fh) = ('');
+    if ($size > $psite_spill_bytes){
+        $collector->{'spills'}++;
+        $file = $collector->{'spill_base'}."_".$collector->{'spills'}.".bin";
+        open($fh, ">", $file) or die "Cannot spill P sites to ".$file.": $!\n";
+        binmode($fh);
+    }
+    
+    my $next_a = psite_reader($run_a);
+    my $next_b = psite_reader($run_b);
+    my ($pos_a, $count_a) = $next_a->();
+    my ($pos_b, $count_b) = $next_b->();
+    while (defined $pos_a || defined $pos_b){
+        if (!defined $pos_b || (defined $pos_a && $pos_a < $pos_b)){
+            $out .= pack("NN", $pos_a, $count_a);
+            ($pos_a, $count_a) = $next_a->();
+        } elsif (!defined $pos_a || $pos_b < $pos_a){
+            $out .= pack("NN", $pos_b, $count_b);
+            ($pos_b, $count_b) = $next_b->();
+        } else {
+            $out .= pack("NN", $pos_a, $count_a + $count_b);
+            ($pos_a, $count_a) = $next_a->();
+            ($pos_b, $count_b) = $next_b->();
+        }
+        if (defined $fh && length($out) >= 1048576){
+            print $fh $out;
+            $out = '';
+        }
+    }
+    delete_psite_run($run_a);
+    delete_psite_run($run_b);
+    
+    if (defined $fh){
+        print $fh $out;
+        close($fh);
+        return {'file' => $file};
+    }
+    return {'data' => $out};
+}
+
+## P-site counts: sequential reader over a sorted run, returns (position, count) ##
+sub psite_reader {
+    
+    #Catch
+    my $run = $_[0];
+    
+    my $offset = 0;
+    if (exists $run->{'data'}){
+        my $data = \$run->{'data'};
+        return sub {
+            return () if ($offset >= length($$data));
+            $offset += 8;
+            return unpack("NN", substr($$data, $offset - 8, 8));
+        };
+    }
+    
+    #Spilled run: read in blocks
+    open(my $fh, "<", $run->{'file'}) or die "Cannot read spilled P sites ".$run->{'file'}.": $!\n";
+    binmode($fh);
+    my $buffer = '';
+    return sub {
+        if ($offset >= length($buffer)){
+            $offset = 0;
+            if (!read($fh, $buffer, 1048576)){
+                close($fh);
+                return ();
             }
         }
-        $execute3->finish();
-        
-        # Get first and last exon of each transcript from table translation
-        my $query4 = "SELECT start_exon_id,end_exon_id,seq_start,seq_end FROM translation WHERE transcript_id = '$tr_id'";
-        my $execute4 = $dbh->prepare($query4);
-        $execute4->execute();
-        
-        while(my @result4 = $execute4->fetchrow_array()){
-            #$result4[0]: start_exon_id
-            #$result4[1]: end_exon_id
-            #$result4[2]: seq_start (offset position translation start)
-            #$result4[3]: seq_end (offset position translation stop)
-            
-            my ($start_id,$end_id,$seq_start,$seq_end) = ($result4[0],$result4[1],$result4[2],$result4[3]);
-            my ($start_first_exon,$stop_first_exon,$start_last_exon,$stop_last_exon,$rank_first_exon,$rank_last_exon);
-            my ($start_codon,$stop_codon);
-            
-            # Determine start codon and stop codon
-            # Determine 5' and 3' UTRs
-            
-            if($trs_c->{$tr_id}{'seq_region_strand'} eq '1'){ # Forward strand
-                $start_first_exon = $exon->{$start_id}{'seq_region_start'};
-                $stop_first_exon = $exon->{$start_id}{'seq_region_end'};
-                $rank_first_exon = $exon->{$start_id}{'rank'};
-                $start_last_exon = $exon->{$end_id}{'seq_region_start'};
-                $stop_last_exon = $exon->{$end_id}{'seq_region_end'};
-                $rank_last_exon = $exon->{$end_id}{'rank'};
-                $start_codon = $start_first_exon + $seq_start - 1;
-                $stop_codon = $start_last_exon + $seq_end - 1;
-                
-                for(my $l1=$start_first_exon;$l1<$start_codon;$l1++){
-                    $cds_for{$chr.':'.$l1}{'5UTR'}++;
-                }
-                #5UTR also in exons before first translated exon
-                if ($rank_first_exon>1){
-                    foreach my $exon_id (keys(%{$exon})){
-                        if ($exon->{$exon_id}->{'rank'} < $rank_first_exon){
-                            for(my $l1a = $exon->{$exon_id}->{'seq_region_start'};$l1a<=$exon->{$exon_id}->{'seq_region_end'};$l1a++){
-                                $cds_for{$chr.':'.$l1a}{'5UTR'}++;
-                            }
-                        }
-                    }
-                }
-                
-                #3UTR also in exons after the last translated exon
-                for(my $l2=($stop_codon+1);$l2<=$stop_last_exon;$l2++){
-                    $cds_for{$chr.':'.$l2}{'3UTR'}++;
-                }
-                if ($rank_last_exon < $highest_rank){
-                    foreach my $exon_id (keys(%{$exon})){
-                        if ($exon->{$exon_id}->{'rank'} > $rank_last_exon){
-                            for (my $l2a = $exon->{$exon_id}->{'seq_region_start'};$l2a<=$exon->{$exon_id}->{'seq_region_end'};$l2a++){
-                                $cds_for{$chr.':'.$l2a}{'3UTR'}++;
-                            }
-                        }
-                    }
-                }
-                
-            }elsif($trs_c->{$tr_id}{'seq_region_strand'} eq '-1'){ # Reverse strand
-                $start_first_exon = $exon->{$start_id}{'seq_region_end'};
-                $stop_first_exon = $exon->{$start_id}{'seq_region_start'};
-                $rank_first_exon = $exon->{$start_id}{'rank'};
-                $start_last_exon = $exon->{$end_id}{'seq_region_end'};
-                $stop_last_exon = $exon->{$end_id}{'seq_region_start'};
-                $rank_last_exon = $exon->{$end_id}{'rank'};
-                $start_codon = $start_first_exon - $seq_start + 1;
-                $stop_codon = $start_last_exon - $seq_end + 1;
-                
-                #5UTR also in exons before first translated exon
-                for(my $l3=($start_codon+1);$l3<=$start_first_exon;$l3++){
-                    $cds_rev{$chr.':'.$l3}{'5UTR'}++;
-                }
-                if ($rank_first_exon>1){
-                    foreach my $exon_id (keys(%{$exon})){
-                        if ($exon->{$exon_id}->{'rank'} < $rank_first_exon){
-                            for (my $l3a=$exon->{$exon_id}->{'seq_region_start'}; $l3a<=$exon->{$exon_id}->{'seq_region_end'};$l3a++){
-                                $cds_rev{$chr.':'.$l3a}{'5UTR'}++;
-                            }
-                        }
-                    }
-                }
-                
-                #3UTR also in exons after the last translated exon
-                for(my $l4=$stop_last_exon;$l4<$stop_codon;$l4++){
-                    $cds_rev{$chr.':'.$l4}{'3UTR'}++;
-                }
-                
-                
-                if ($rank_last_exon < $highest_rank){
-                    foreach my $exon_id (keys(%{$exon})){
-                        if ($exon->{$exon_id}->{'rank'} > $rank_last_exon){
-                            for (my $l4a=$exon->{$exon_id}->{'seq_region_start'};$l4a<=$exon->{$exon_id}->{'seq_region_end'};$l4a++){
-                                $cds_rev{$chr.':'.$l4a}{'3UTR'}++;
-                            }
-                        }
-                    }
-                }
+        $offset += 8;
+        return unpack("NN", substr($buffer, $offset - 8, 8));
+    };
+}
+
+## P-site counts: remove a run ##
+sub delete_psite_run {
+    
+    #Catch
+    my $run = $_[0];
+    
+    if (exists $run->{'file'}){
+        unlink($run->{'file'});
+    }
+    
+    return;
+}
+
+## Adaptive mode: split the alignments of a chromosome in chunks ##
+# The chunk of an alignment is a hash of its read name, so every chunk is a random part of the reads
+# and all alignments of a read end up in the same chunk.
+sub partition_chr_sam {
+    
+    #Catch
+    my $base = $_[0];
+    my $chunks = $_[1];
+    
+    #The last chunk file is moved into place last, it marks a finished partition
+    return if (-e $base."_chunk".($chunks - 1).".sam");
+    
+    my @fhs;
+    for (my $i = 0; $i < $chunks; $i++){
+        open($fhs[$i], ">", $base."_chunk".$i.".sam.tmp") or die "Cannot write chunk ".$i." of ".$base.": $!\n";
+    }
+    open(my $fr, "<", $base.".sam") or die "Cannot open ".$base.".sam\n";
+    while (my $line = <$fr>){
+        my $qname = substr($line, 0, index($line, "\t"));
+        print {$fhs[hex(substr(md5_hex($qname), 0, 8)) % $chunks]} $line;
+    }
+    close($fr);
+    for (my $i = 0; $i < $chunks; $i++){
+        close($fhs[$i]);
+        system("mv ".$base."_chunk".$i.".sam.tmp ".$base."_chunk".$i.".sam");
+    }
+    
+    return;
+}
+
+## Adaptive mode: phase fractions per RPF length ##
+sub phase_fractions {
+    
+    #Catch
+    my $rpf_phase = $_[0];
+    
+    my $fractions = {};
+    foreach my $rpf (keys %{$rpf_phase}){
+        my $total = 0;
+        $total += $rpf_phase->{$rpf}->{$_} // 0 foreach (0..2);
+        next if ($total == 0);
+        $fractions->{$rpf}->{'n'} = $total;
+        foreach my $phase (0..2){
+            $fractions->{$rpf}->{$phase} = ($rpf_phase->{$rpf}->{$phase} // 0) / $total;
+        }
+    }
+    
+    return $fractions;
+}
+
+## Adaptive mode: largest change of a phase fraction between two rounds ##
+# RPF lengths with less than 100 reads are too noisy to follow and are left out
+sub phase_fractions_change {
+    
+    #Catch
+    my $previous = $_[0];
+    my $current = $_[1];
+    
+    my $change = 0;
+    foreach my $rpf (keys %{$current}){
+        next if ($current->{$rpf}->{'n'} < 100);
+        foreach my $phase (0..2){
+            my $diff = abs($current->{$rpf}->{$phase} - (exists $previous->{$rpf} ? $previous->{$rpf}->{$phase} : 0));
+            $change = $diff if ($diff > $change);
+        }
+    }
+    
+    return $change;
+}
+
+## Adaptive mode: write the phase fractions with their 95% confidence intervals ##
+sub write_phase_estimates {
+    
+    #Catch
+    my $rpf_phase = $_[0];
+    my $file = $_[1];
+    
+    my $fractions = phase_fractions($rpf_phase);
+    open(my $fw, ">", $file) or die "Cannot write ".$file.": $!\n";
+    print $fw "RPF,phase,fraction,ci_low,ci_high,reads\n";
+    print "   Phase fraction estimates (95% confidence interval):\n";
+    foreach my $rpf (sort {$a <=> $b} keys %{$fractions}){
+        my $n = $fractions->{$rpf}->{'n'};
+        my @estimates;
+        foreach my $phase (0..2){
+            my $p = $fractions->{$rpf}->{$phase};
+            my $margin = 1.96 * sqrt($p * (1 - $p) / $n);
+            my ($low, $high) = (($p - $margin < 0) ? 0 : $p - $margin, ($p + $margin > 1) ? 1 : $p + $margin);
+            printf $fw "%d,%d,%.5f,%.5f,%.5f,%d\n", $rpf, $phase, $p, $low, $high, $n;
+            push(@estimates, sprintf("%.3f [%.3f-%.3f]", $p, $low, $high));
+        }
+        print "\t".$rpf." (".$n." reads): ".join("  ", @estimates)."\n";
+    }
+    close($fw);
+    
+    return;
+}
+
+## Select the chromosomes of one shard ##
+# Chromosomes are divided over the shards largest first, each time to the shard with the least
+# total size so far. Every node gets the same division out of the same ChromInfo file.
+sub select_shard_chromosomes {
+    
+    #Catch
+    my $chr_sizes = $_[0];
+    my $shard_index = $_[1];
+    my $shard_count = $_[2];
+    
+    my @loads = (0) x $shard_count;
+    my %shard_chrs;
+    foreach my $chr (schedule_chromosomes($chr_sizes, $chr_sizes)){
+        my $least_loaded = 0;
+        for (my $i=1; $i<$shard_count; $i++){
+            $least_loaded = ($loads[$i] < $loads[$least_loaded]) ? $i : $least_loaded;
+        }
+        $loads[$least_loaded] += $chr_sizes->{$chr};
+        if ($least_loaded + 1 == $shard_index){
+            $shard_chrs{$chr} = $chr_sizes->{$chr};
+        }
+    }
+    
+    return \%shard_chrs;
+}
+
+## Write the manifest of a finished shard ##
+sub write_shard_manifest {
+    
+    #Catch
+    my $manifest_file = $_[0];
+    my $summary_file = $_[1];
+    my $chrs = $_[2];
+    my $offset_hash = $_[3];
+    my $offset_img = $_[4];
+    
+    my @offsets;
+    for (my $rpf=$offset_hash->{'min'}; $rpf<=$offset_hash->{'max'}; $rpf++){
+        push(@offsets, $rpf.":".$offset_hash->{$rpf});
+    }
+    
+    open(my $fw, ">", $manifest_file.".tmp") or die "Cannot write shard manifest ".$manifest_file.": $!\n";
+    print $fw "experiment\t".$exp_name."\n";
+    print $fw "shard\t".$shard."\n";
+    print $fw "chromosomes\t".join(",", sort keys %{$chrs})."\n";
+    print $fw "summary\t".$summary_file."\n";
+    print $fw "offset_option\t".$offset_option."\n";
+    print $fw "offsets\t".join(",", @offsets)."\n";
+    print $fw "offset_img\t".$offset_img."\n";
+    print $fw "finished\t".localtime()."\n";
+    close($fw);
+    #Manifest is only in place once the shard is complete
+    rename($manifest_file.".tmp", $manifest_file) or die $!;
+    
+    return;
+}
+
+## Merge all shards of an experiment ##
+sub merge_shards {
+    
+    #Catch
+    my $shard_dir = $_[0];
+    my $exp_name = $_[1];
+    
+    #Read in all shard manifests
+    my @manifest_files = glob($shard_dir."/".$exp_name."_shard_*_of_*.manifest");
+    if (!@manifest_files){
+        die "ERROR: no shard manifests of experiment ".$exp_name." found in ".$shard_dir."!\n";
+    }
+    my %manifests;
+    my $shard_count;
+    foreach my $manifest_file (@manifest_files){
+        my %manifest;
+        open(my $fr, "<", $manifest_file) or die "Cannot open shard manifest ".$manifest_file.": $!\n";
+        while(my $line = <$fr>){
+            chomp($line);
+            my ($key, $value) = split(/\t/, $line, 2);
+            $manifest{$key} = $value // "";
+        }
+        close($fr);
+        my ($index, $count) = split(/\//, $manifest{'shard'});
+        $shard_count //= $count;
+        if ($count != $shard_count){
+            die "ERROR: shard manifests in ".$shard_dir." do not agree on the number of shards!\n";
+        }
+        $manifests{$index} = \%manifest;
+    }
+    
+    #All shards should be finished, on disjoint chromosomes and with the same offsets
+    my @missing = grep { !exists $manifests{$_} } (1..$shard_count);
+    if (@missing){
+        die "ERROR: shard(s) ".join(",", @missing)." of ".$shard_count." not finished yet (no manifest in ".$shard_dir.")!\n";
+    }
+    my %chr_shard;
+    foreach my $index (1..$shard_count){
+        foreach my $chr (split(/,/, $manifests{$index}->{'chromosomes'})){
+            if (exists $chr_shard{$chr}){
+                die "ERROR: chromosome ".$chr." is part of shard ".$chr_shard{$chr}." and shard ".$index."!\n";
             }
+            $chr_shard{$chr} = $index;
         }
-        $execute4->finish();
-        
-    } #close transcript id loop
+        if ($manifests{$index}->{'offsets'} ne $manifests{1}->{'offsets'}){
+            die "ERROR: shard ".$index." used other P site offsets than shard 1!\n";
+        }
+    }
     
-    ###########
-    ## NON-CODING TRANSCRIPTS
-    ###########
-    # Get biotypes
-    my $query5 = "SELECT biotype FROM transcript WHERE biotype NOT LIKE '%protein_coding%' GROUP BY biotype";
-    my $execute5 = $dbh->prepare($query5);
-    $execute5->execute();
+    #Merge the shard summaries
+    my $summary;
+    foreach my $index (1..$shard_count){
+        print "\tShard ".$index."/".$shard_count.": chromosome(s) ".$manifests{$index}->{'chromosomes'}."\n";
+        my $shard_summary = read_qc_summary($shard_dir."/".$manifests{$index}->{'summary'});
+        $summary = (defined $summary) ? merge_qc_summaries($summary, $shard_summary) : $shard_summary;
+    }
+    write_qc_summary($summary, $TMP."/mappingqc/qc_summary.bin");
+    
+    #Offsets
+    my $offset_hash = {'min' => 1000, 'max' => 0};
+    foreach my $rpf_offset (split(/,/, $manifests{1}->{'offsets'})){
+        my ($rpf, $offset) = split(/:/, $rpf_offset);
+        $offset_hash->{$rpf} = $offset;
+        $offset_hash->{'min'} = ($rpf < $offset_hash->{'min'}) ? $rpf : $offset_hash->{'min'};
+        $offset_hash->{'max'} = ($rpf > $offset_hash->{'max'}) ? $rpf : $offset_hash->{'max'};
+    }
+    my $offset_img = ($manifests{1}->{'offset_img'} ne "") ? $shard_dir."/".$manifests{1}->{'offset_img'} : "";
     
-    my %biotypes_nc;
-    while(my @results5 = $execute5->fetchrow_array()){
-        $biotypes_nc{$results5[0]} = 0;
+    #Keep one manifest of the merged run
+    open(my $fw, ">", $shard_dir."/".$exp_name."_manifest.txt") or die $!;
+    print $fw "shard\tchromosomes\tsummary\tfinished\n";
+    foreach my $index (1..$shard_count){
+        print $fw $manifests{$index}->{'shard'}."\t".$manifests{$index}->{'chromosomes'}."\t".$manifests{$index}->{'summary'}."\t".$manifests{$index}->{'finished'}."\n";
     }
-    $execute5->finish();
-    # Disconnect
-    $dbh->disconnect();
+    close($fw);
     
-    ###########
-    ## RIBO-DATA
-    ###########
-    ###########
-    ## ANNOTATE RIBO-SEQ READS
-    ###########
-    print "\t\tAnnotating ribo-seq reads of chr ".$chr."\n";
+    return ($summary, $offset_hash, $manifests{1}->{'offset_option'}, $offset_img);
+}
+
+## Write the tables of a (merged) QC summary for the plotting script ##
+sub prepare_plot_data {
     
-    # Get ribo-seq reads, split per strand
-    my ($ribo_for, $pos_for) = get_reads($chr,1);
-    my ($ribo_rev, $pos_rev) = get_reads($chr,-1);
+    #Catch
+    my $summary = $_[0];
+    my $offset_hash = $_[1];
+    my $biotypes = $_[2];
     
-    # Init values
-    my ($ribo_reads,$ribo_readsnc) = (0,0);
-    my ($ribo_exon,$ribo_intron,$ribo_5utr,$ribo_3utr,$ribo_intergenic) = (0,0,0,0,0);
+    #Write the tables for the plotting script
+    qc_summary_to_tables($summary, $offset_hash, $biotypes);
     
-    # Loop over forward ribo-seq reads
-    my @window_c = (); # Init window with protein-coding transcripts
-    my @window_nc = (); # Init window with non protein-coding transcripts
-    foreach my $pos (@{$pos_for}){
-        #####
-        ## PROTEIN-CODING WINDOW
-        ######
-        # Push all tr_ids to @window_c where tr_start < window_pos
-        my $last_added_index_c = -1;
-        foreach my $tr_for_id (@$tr_c_for){
-            if($trs_c->{$tr_for_id}{'seq_region_start'} <= $pos){
-                $last_added_index_c++;
-                push(@window_c,$tr_for_id);
-            }else{last;} # Don't unnecessarily loop over all transcripts
+    return;
+}
+
+## Run the python plotting script for the output html and zip ##
+sub run_plotting_script {
+    
+    #Catch
+    my $offset_img = $_[0];
+    my $plot_work_dir = $_[1] // "";
+    my $refresh = $_[2] // 0;
+    my $figure_cores = $_[3] // $cores;
+    my $profile = $_[4] // $render_profile;
+    
+    print "\n\n\n\n";
+    print "Run python plotting script\n";
+    my $input_file = ($ext eq "bam") ? $original_bam : $sam;
+    #The QC summary knows all counted inputs and their alignments (more than one after shards or appends)
+    my $total_maps = "";
+    my $summary_file = $TMP."/mappingqc/qc_summary.bin";
+    if (-e $summary_file){
+        my $inputs = read_qc_summary($summary_file)->{'inputs'};
+        if (%{$inputs}){
+            my @fingerprints = sort { $inputs->{$a}->{'name'} cmp $inputs->{$b}->{'name'} } keys %{$inputs};
+            $input_file = join(",", map { $inputs->{$_}->{'name'} } @fingerprints);
+            $total_maps = 0;
+            $total_maps += $inputs->{$_}->{'alignments'} foreach (@fingerprints);
         }
+    }
+    my $python_command = "python ".$tool_dir."/mQC.py -g ".$galaxy." -a ".$galaxysam." -y ".$galaxytest." -t ".$TMP." -s ".$input_file." -n ".$exp_name." -c ".$comp_logo." -o ".$outfolder." -h ".$outhtml." -z ".$outzip." -p \"".$offset_option."\" -e ".$ens_db." -d ".$species." -v ".$version." -u ".$unique." -x ".$plotrpftool." -j ".$figure_cores." -q ".$profile." -k ".$report." -b ".$single_file;
+    if ($total_maps ne ""){
+        $python_command = $python_command." -m ".$total_maps;
+    }
+    if ($plot_work_dir ne ""){
+        $python_command = $python_command." -w ".$plot_work_dir;
+    }
+    if ($refresh > 0){
+        $python_command = $python_command." -r ".$refresh;
+    }
+    if ($preview_fraction * $analysed_fraction < 1){
+        $python_command = $python_command." -f ".($preview_fraction * $analysed_fraction);
+    }
+    if ($offset_option eq "plastid" || $offset_option eq "native"){
+        $python_command = $python_command." -i ".$offset_img;
+    }
+    print "Python command:\n\t";
+    print $python_command."\n";
+    system($python_command);
+    
+    return;
+}
+
+## Read the sample sheet of a batch run ##
+# Tab-separated: experiment name, SAM/BAM file and optionally a bam file for plastid (default: convert)
+sub read_samplesheet {
+    
+    #Catch
+    my $samplesheet = $_[0];
+    
+    my @samples;
+    my %names;
+    open(my $fr, "<", $samplesheet) or die "Could not open sample sheet ".$samplesheet."!\n";
+    while(my $line = <$fr>){
+        chomp($line);
+        next if ($line =~ m/^#/ || $line =~ m/^\s*$/);
+        my ($name, $input, $plastid_bam) = split(/\t/, $line);
+        next if (lc($name) eq "experiment_name"); #Header
+        if (!defined $input || $input eq ""){
+            die "ERROR: sample ".$name." in the sample sheet has no SAM/BAM file!\n";
+        }
+        if (exists $names{$name}){
+            die "ERROR: sample ".$name." is more than once in the sample sheet!\n";
+        }
+        if (! -e $input){
+            die "ERROR: could not find input file ".$input." of sample ".$name."!\n";
+        }
+        if ($input !~ m/\.(sam|bam)$/){
+            die "ERROR: input file ".$input." of sample ".$name." should be in bam/sam format!\n";
+        }
+        $names{$name} = 1;
+        push(@samples, {'name' => $name, 'input' => Cwd::abs_path($input), 'plastid_bam' => $plastid_bam || "convert"});
+    }
+    close($fr);
+    
+    if (!@samples){
+        die "ERROR: no samples in sample sheet ".$samplesheet."!\n";
+    }
+    
+    return \@samples;
+}
+
+## Switch the run settings to one sample of the batch ##
+sub set_batch_sample {
+    
+    #Catch
+    my $sample = $_[0];
+    
+    $TMP = $sample->{'tmp'};
+    $exp_name = $sample->{'name'};
+    $input_name = $sample->{'input'};
+    $input_fingerprint = $sample->{'fingerprint'};
+    $outfolder = $sample->{'outfolder'};
+    $outhtml = $sample->{'outhtml'};
+    $outzip = $sample->{'outzip'};
+    $bam = $sample->{'plastid_bam'};
+    ($ext) = ($sample->{'input'} =~ m/\.([^.]+)$/);
+    if ($ext eq "bam"){
+        $original_bam = $sample->{'input'};
+        $sam = $TMP."/input.sam";
+    } else {
+        $sam = $sample->{'input'};
+    }
+    my @splitsam = split(/\//, $sam);
+    $samFileName = $splitsam[$#splitsam];
+    @splitsam = split(/\./, $samFileName);
+    $samFileName = $splitsam[0];
+    
+    return;
+}
+
+## Follow mode: live QC of a growing SAM/BAM file ##
+# The input is tailed (BAM through samtools view), new records are collected in a batch file and
+# every follow interval the batch is split per chromosome, analysed and merged into the QC summary,
+# after which the report is remade. The run ends when the input did not grow for the idle time.
+sub run_follow {
+    
+    #Catch
+    my $chrs = $_[0];
+    
+    my %chr_sizes = %{$chrs};
+    my $follow_dir = $TMP."/follow";
+    system("mkdir -p ".$follow_dir." ".$TMP."/mappingqc");
+    
+    #Offsets and annotation only have to be made once
+    print "\nOFFSETS AND ANNOTATION\n";
+    my $offset_hash = construct_offsets();
+    offsets_to_csv($offset_hash, $TMP);
+    my $biotypes = get_nPCbiotypes($ens_db, "", "");
+    my $annotation = build_annotation_index($ens_db, $coord_system_id, \%chr_sizes, $cores);
+    
+    #Tail the input in its own process group, so the whole pipe can be stopped at the end
+    my $input = ($ext eq "bam") ? $original_bam : $sam;
+    my $command = "tail -c +1 -F ".$input.(($ext eq "bam") ? " 2> /dev/null | samtools view -h - 2> /dev/null" : " 2> /dev/null");
+    my $pid = open(my $stream, "-|");
+    die "Cannot follow ".$input.": $!\n" unless (defined $pid);
+    if (!$pid){
+        setpgrp(0, 0);
+        exec($command);
+    }
+    my $select = IO::Select->new($stream);
+    
+    print "\nFOLLOW ".$input."\n";
+    print "   Report every ".$follow_interval." s, stop after ".$follow_idle." s without new alignments\n";
+    my $summary = new_qc_summary($pos_bins);
+    my $state = {'round' => 0, 'alignments' => 0};
+    my $batch_file = $follow_dir."/batch.sam";
+    open(my $batch, ">", $batch_file) or die "Cannot write ".$batch_file.": $!\n";
+    my ($buffer, $batch_lines) = ("", 0);
+    my ($last_data, $last_report) = (time, time);
+    while (1){
+        if ($select->can_read(1)){
+            my $data;
+            my $n = sysread($stream, $data, 1048576);
+            last if (!$n);
+            #Only complete lines go into the batch
+            $buffer .= $data;
+            my $cut = rindex($buffer, "\n");
+            if ($cut >= 0){
+                my $lines = substr($buffer, 0, $cut + 1);
+                print $batch $lines;
+                $batch_lines += ($lines =~ tr/\n//);
+                $buffer = substr($buffer, $cut + 1);
+            }
+            $last_data = time;
+        }
+        my $idle = (time - $last_data >= $follow_idle);
+        if (time - $last_report >= $follow_interval || $idle){
+            if ($batch_lines > 0){
+                close($batch);
+                follow_update($batch_file, $state, $summary, \%chr_sizes, $annotation, $offset_hash, $biotypes, $input, 0);
+                open($batch, ">", $batch_file) or die "Cannot write ".$batch_file.": $!\n";
+                $batch_lines = 0;
+            }
+            $last_report = time;
+            last if ($idle);
+        }
+    }
+    
+    #Stop following and process the rest
+    kill('TERM', -$pid);
+    close($stream);
+    print $batch $buffer if ($buffer ne "");
+    close($batch);
+    #Last report without automatic refresh
+    follow_update($batch_file, $state, $summary, \%chr_sizes, $annotation, $offset_hash, $biotypes, $input, 1);
+    system("rm -rf ".$follow_dir);
+    print "Input did not grow for ".$follow_idle." s, follow finished after ".$state->{'round'}." update(s)\n";
+    
+    return;
+}
+
+## Follow mode: add a batch of new alignments to the QC summary and remake the report ##
+sub follow_update {
+    
+    #Catch
+    my $batch_file = $_[0];
+    my $state = $_[1];
+    my $summary = $_[2];
+    my $chrs = $_[3];
+    my $annotation = $_[4];
+    my $offset_hash = $_[5];
+    my $biotypes = $_[6];
+    my $input = $_[7];
+    my $final = $_[8];
+    
+    my %chr_sizes = %{$chrs};
+    if (! -s $batch_file){
+        #Nothing new, only the last report has to lose its automatic refresh
+        run_plotting_script($TMP."/plastid/".$exp_name."_p_offsets.png") if ($final && $state->{'round'} > 0);
+        return;
+    }
+    $state->{'round'}++;
+    my $round_sam = $TMP."/follow/batch_".$state->{'round'}.".sam";
+    system("mv ".$batch_file." ".$round_sam);
+    print "\n* Update ".$state->{'round'}."\n";
+    
+    #Split and analyse the new alignments
+    split_SAM_per_chr(\%chr_sizes, $work_dir, $round_sam, $unique, $mapper);
+    my $round_name = "batch_".$state->{'round'};
+    my $read_counts = get_chr_read_counts(\%chr_sizes, $round_name);
+    my %task_durations;
+    my $pm = init_worker_pool($cores, \%task_durations);
+    foreach my $chr (schedule_chromosomes(\%chr_sizes, $read_counts)){
+        next unless ($read_counts->{$chr});
         
-        # Get rid of tr_c_for elements brought into @window_c
-        splice(@$tr_c_for, 0, $last_added_index_c+1); #length parameter = last index (- first index (=0) ) + 1
-        
-        # Get rid of tr_ids in @window_c where tr_end < window_pos
-        @window_c = grep {$trs_c->{$_}{'seq_region_end'} >= $pos} @window_c;
+        ### Start parallel process
+        $pm->start($chr) and next;
         
-        #####
-        ## NON-CODING WINDOW
-        #####
-        # Push all tr_ids to @window_nc where tr_start < window_pos
-        my $last_added_index_nc = -1;
-        foreach my $tr_for_id (@$tr_nc_for){
-            if($trs_nc->{$tr_for_id}{'seq_region_start'} <= $pos){
-                $last_added_index_nc++;
-                push(@window_nc,$tr_for_id);
-            }else{last;} # Don't unnecessarily loop over all transcripts
-        }
+        fused_analysis_per_chr($round_sam, $chr, $annotation->{$chr}, $offset_hash, $min_length_gd, $max_length_gd, $biotypes);
         
-        # Get rid of tr_nc_for elements already in @window_nc
-        splice(@$tr_nc_for, 0, $last_added_index_nc+1);
+        ### Finish
+        $pm->finish;
+    }
+    $pm->wait_all_children;
+    
+    #Merge into the running QC summary
+    foreach my $chr (sort keys %chr_sizes){
+        my $chr_summary_file = $TMP."/mappingqc/qc_summary_".$chr.".bin";
+        next unless (-e $chr_summary_file);
+        merge_qc_summaries($summary, read_qc_summary($chr_summary_file));
+        system("rm -rf ".$chr_summary_file);
+    }
+    $state->{'alignments'} += get_primary_alignments($round_name, $round_sam);
+    $summary->{'inputs'} = {input_fingerprint($input) => {'name' => $input_name, 'alignments' => $state->{'alignments'}}};
+    write_qc_summary($summary, $TMP."/mappingqc/qc_summary.bin");
+    system("rm -f ".$round_sam." ".$TMP."/mappingqc/".$round_name."_*");
+    
+    #Remake the report, the browser reloads it until the last update
+    #Intermediate reports are drawn with the fast profile, only the last one with the chosen profile
+    prepare_plot_data($summary, $offset_hash, $biotypes);
+    run_plotting_script($TMP."/plastid/".$exp_name."_p_offsets.png", "", ($final) ? 0 : $follow_interval, $cores, ($final) ? $render_profile : "fast");
+    print "* Report updated with ".$state->{'alignments'}." alignments\n";
+    
+    return;
+}
+
+## Batch run ##
+# All samples share the chromosome files, the non-coding biotypes and the annotation index. After
+# a per-sample preparation (splitting and offsets), all sample x chromosome tasks go to one worker
+# pool, largest first, and finally every sample gets its own report.
+sub run_batch {
+    
+    #Catch
+    my $samples = $_[0];
+    my $chrs = $_[1];
+    
+    my %chr_sizes = %{$chrs};
+    
+    #Shared annotation
+    if (! -e $TMP."/mappingqc"){
+        system("mkdir ".$TMP."/mappingqc");
+    }
+    if (! -e $TMP."/Genes"){
+        system("mkdir ".$TMP."/Genes");
+    }
+    my $genes_dir = $TMP."/Genes";
+    my $index_dir = $TMP."/mappingqc/annotation_index";
+    print "\nLOAD SHARED ANNOTATION\n";
+    my $biotypes = get_nPCbiotypes($ens_db, "", "");
+    my $annotation = build_annotation_index($ens_db, $coord_system_id, \%chr_sizes, $cores);
+    
+    #Samples that already have a QC summary only need their report
+    my %done;
+    foreach my $sample (@{$samples}){
+        $done{$sample->{'name'}} = (-e $sample->{'tmp'}."/mappingqc/qc_summary.bin") ? 1 : 0;
+    }
+    
+    ## SAMPLE PREPARATION
+    print "\nPREPARE SAMPLES\n";
+    my %prep_durations;
+    my $pm_prep = init_worker_pool($cores, \%prep_durations);
+    foreach my $sample (@{$samples}){
+        next if ($done{$sample->{'name'}});
         
-        # Get rid of tr_ids in @window_nc where tr_end < window_pos
-        @window_nc = grep {$trs_nc->{$_}{'seq_region_end'} >= $pos} @window_nc;
+        ### Start parallel process
+        $pm_prep->start($sample->{'name'}) and next;
         
-        #####
-        ## ANNOTATE
-        #####
-        # Loop over windows and check functional annotation of each ribo-seq read
-        $ribo_reads = $ribo_reads + $ribo_for->{$pos}{'count'};
-        if(@window_c){
-            # Annotate reads in PROTEIN-CODING transcripts
-            my $count = $ribo_for->{$pos}{'count'};
-            
-            # Check 5'UTR
-            if(defined($cds_for{$chr.':'.$pos}{'5UTR'})){
-                $ribo_5utr = $ribo_5utr + $count;
-            }
-            
-            # Check 3'UTR
-            elsif(defined($cds_for{$chr.':'.$pos}{'3UTR'})){
-                $ribo_3utr = $ribo_3utr + $count;
-            }
-            
-            # Check Exons
-            elsif(defined($cds_for{$chr.':'.$pos}{'exon'})){
-                $ribo_exon = $ribo_exon + $count;
-            }
-            
-            # If still not defined -> intronic region
-            else{
-                $ribo_intron = $ribo_intron + $count;
-            }
-        }elsif(@window_nc){
-            # Annotate reads in NON PROTEIN-CODING transcripts
-            $ribo_readsnc = $ribo_readsnc + $ribo_for->{$pos}{'count'};
-            
-            # Define biotype (if #biotypes>0, take a random/first one)
-            my @biotypes; my $i = 0;
-            foreach my $tr_for_id (@window_nc){
-                $biotypes[$i] = $trs_nc->{$tr_for_id}{'biotype'};
-                $i++;
-            }
-            my $random = int(rand(@biotypes));
-            my $biotype = $biotypes[$random];
-            $biotypes_nc{$biotype} = $biotypes_nc{$biotype} + $ribo_for->{$pos}{'count'};
-        }else{
-            $ribo_intergenic = $ribo_intergenic + $ribo_for->{$pos}{'count'};
+        set_batch_sample($sample);
+        system("mkdir -p ".$TMP."/mappingqc");
+        #Plastid gtf file is downloaded only once for all samples
+        if (! -e $TMP."/Genes"){
+            system("ln -s ".$genes_dir." ".$TMP."/Genes");
         }
-    } #close forward loop
-        
-    # Loop over reverse ribo-seq reads
-    @window_c = (); # Empty window_c
-    @window_nc = (); # Empty window_nc
-    foreach my $pos (@{$pos_rev}){
-        ######
-        ## PROTEIN-CODING WINDOW
-        ######
-        # Push all tr_ids to @window_c where tr_start < window_pos
-        my $last_added_index_c = -1;
-        foreach my $tr_rev_id (@$tr_c_rev){
-            if($trs_c->{$tr_rev_id}{'seq_region_start'} <= $pos){
-                $last_added_index_c++;
-                push(@window_c,$tr_rev_id);
-            }else{last;} # Don't unnecessarily loop over all transcripts
+        #Start codons for native offsets come from the shared annotation index
+        if (! -e $TMP."/mappingqc/annotation_index"){
+            system("ln -s ".$index_dir." ".$TMP."/mappingqc/annotation_index");
+        }
+        if ($ext eq "bam" && ! -e $sam){
+            system("samtools view -h ".$original_bam." > ".$sam);
         }
+        if (! -e $TMP."/mappingqc/".$samFileName."_read_counts.txt"){
+            split_SAM_per_chr(\%chr_sizes, $work_dir, $sam, $unique, $mapper);
+        }
+        offsets_to_csv(construct_offsets(), $TMP);
+        print "* Prepared sample ".$exp_name."\n";
         
-        # Get rid of tr_c_rev elements already in @window_c
-        splice(@$tr_c_rev, 0, $last_added_index_c+1);
+        ### Finish
+        $pm_prep->finish;
+    }
+    $pm_prep->wait_all_children;
+    report_task_durations("Sample preparation", \%prep_durations);
+    
+    #Offsets and read counts of all samples
+    my $batch_tmp = $TMP;
+    my (%offsets, %costs, %samples_by_name);
+    foreach my $sample (@{$samples}){
+        next if ($done{$sample->{'name'}});
+        set_batch_sample($sample);
+        $samples_by_name{$exp_name} = $sample;
+        $offsets{$exp_name} = read_offsets_csv($TMP);
+        my $read_counts = get_chr_read_counts(\%chr_sizes, $samFileName);
+        foreach my $chr (keys %chr_sizes){
+            $costs{$exp_name."\t".$chr} = $read_counts->{$chr} // 0;
+        }
+    }
+    $TMP = $batch_tmp;
+    
+    ## FUSED ANALYSIS OF ALL SAMPLES x CHROMOSOMES
+    print "\nFUSED CHROMOSOMAL ANALYSIS (all samples)\n";
+    print "   Using ".$cores." core(s)\n   ---------------\n";
+    my %task_durations;
+    my $pm = init_worker_pool($cores, \%task_durations);
+    foreach my $task (schedule_chromosomes(\%costs, \%costs)){
+        my ($name, $chr) = split(/\t/, $task);
         
-        # Get rid of tr_ids in @window_c where tr_end < window_pos
-        @window_c = grep {$trs_c->{$_}{'seq_region_end'} >= $pos} @window_c;
+        ### Start parallel process
+        $pm->start($name.":".$chr) and next;
         
-        ######
-        ## NON-CODING WINDOW
-        ######
-        # Push all tr_ids to @window_nc where tr_start < window_pos
-        my $last_added_index_nc = -1;
-        foreach my $tr_rev_id (@$tr_nc_rev){
-            if($trs_nc->{$tr_rev_id}{'seq_region_start'} <= $pos){
-                $last_added_index_nc++;
-                push(@window_nc,$tr_rev_id);
-            }else{last;} # Don't unnecessarily loop over all transcripts
-        }
+        set_batch_sample($samples_by_name{$name});
+        fused_analysis_per_chr($sam, $chr, $annotation->{$chr}, $offsets{$name}, $min_length_gd, $max_length_gd, $biotypes);
+        print "* Finished sample ".$name.", chromosome ".$chr."\n";
         
-        # Get rid of tr_nc_for elements already in @window_nc
-        splice(@$tr_nc_rev, 0, $last_added_index_nc+1);
+        ### Finish
+        $pm->finish;
+    }
+    $pm->wait_all_children;
+    report_task_durations("Fused chromosomal analysis", \%task_durations);
+    
+    ## REPORT PER SAMPLE
+    print "\nREPORTS\n";
+    my %report_durations;
+    my $pm_report = init_worker_pool($cores, \%report_durations);
+    #Share the cores between the reports that run next to each other and their figure processes
+    my $report_width = (scalar(@{$samples}) < $cores) ? scalar(@{$samples}) : $cores;
+    my $figure_cores = ($report_width > 0) ? int($cores / $report_width) : $cores;
+    $figure_cores = 1 if ($figure_cores < 1);
+    foreach my $sample (@{$samples}){
         
-        # Get rid of tr_ids in @window_nc where tr_end < window_pos
-        @window_nc = grep {$trs_nc->{$_}{'seq_region_end'} >= $pos} @window_nc;
+        ### Start parallel process
+        $pm_report->start($sample->{'name'}) and next;
         
-        ######
-        ## ANNOTATE
-        ######
-        # Loop over windows and check functional annotation of each ribo-seq read
-        $ribo_reads = $ribo_reads + $ribo_rev->{$pos}{'count'};
-        if(@window_c){
-            # Annotate reads in PROTEIN-CODING transcripts
-            my $count = $ribo_rev->{$pos}{'count'};
-            
-            # Check 5'UTR
-            if(defined($cds_rev{$chr.':'.$pos}{'5UTR'})){
-                $ribo_5utr = $ribo_5utr + $count;
+        set_batch_sample($sample);
+        if (!$done{$exp_name}){
+            my $summary = new_qc_summary($pos_bins);
+            foreach my $chr (sort keys %chr_sizes){
+                my $chr_summary_file = $TMP."/mappingqc/qc_summary_".$chr.".bin";
+                merge_qc_summaries($summary, read_qc_summary($chr_summary_file));
+                system("rm -rf ".$chr_summary_file);
             }
-            
-            # Check 3'UTR
-            elsif(defined($cds_rev{$chr.':'.$pos}{'3UTR'})){
-                $ribo_3utr = $ribo_3utr + $count;
-            }
-            
-            # Check Exons
-            elsif(defined($cds_rev{$chr.':'.$pos}{'exon'})){
-                $ribo_exon = $ribo_exon + $count;
-            }
-            
-            # If still not defined -> intronic region
-            else{
-                $ribo_intron = $ribo_intron + $count;
-            }
-        }elsif(@window_nc){
-            # Annotate reads in NON PROTEIN-CODING transcripts
-            $ribo_readsnc = $ribo_readsnc + $ribo_rev->{$pos}{'count'};
-            
-            # Define biotype (if #biotypes>0, take a random/first one)
-            my @biotypes; my $i = 0;
-            foreach my $tr_rev_id (@window_nc){
-                $biotypes[$i] = $trs_nc->{$tr_rev_id}{'biotype'};
-                $i++;
-            }
-            my $random = int(rand(@biotypes));
-            my $biotype = $biotypes[$random];
-            $biotypes_nc{$biotype} = $biotypes_nc{$biotype} + $ribo_rev->{$pos}{'count'};
-            
-        }else{
-            $ribo_intergenic = $ribo_intergenic + $ribo_rev->{$pos}{'count'};
+            $summary->{'inputs'}->{$input_fingerprint} = {'name' => $input_name, 'alignments' => get_primary_alignments($samFileName, $sam)};
+            write_qc_summary($summary, $TMP."/mappingqc/qc_summary.bin");
         }
-    } # Close rev-loop
+        prepare_plot_data(read_qc_summary($TMP."/mappingqc/qc_summary.bin"), read_offsets_csv($TMP), $biotypes);
+        #Each report runs in the tmp folder of its sample, so reports can run next to each other
+        run_plotting_script($TMP."/plastid/".$exp_name."_p_offsets.png", $TMP, 0, $figure_cores);
+        
+        ### Finish
+        $pm_report->finish;
+    }
+    $pm_report->wait_all_children;
+    report_task_durations("Reports", \%report_durations);
+    
+    return;
+}
+
+## Build the annotation index of all chromosomes ##
+# Every chromosome is indexed once (in parallel) and stored, after which the parent loads all of them.
+# The index only holds packed interval arrays and CDS sequences, so forked workers share it
+# copy-on-write instead of each building its own phase library and position hashes.
+sub build_annotation_index {
+    
+    #Catch
+    my $ens_db = $_[0];
+    my $coord_system_id = $_[1];
+    my $chrs = $_[2];
+    my $cores = $_[3];
     
-    # Print results
-    print OUT1 $chr."\t".$ribo_reads."\t".$ribo_exon."\t".$ribo_5utr."\t".$ribo_3utr."\t".$ribo_intron."\t".$ribo_readsnc."\t".$ribo_intergenic."\n";
-    print OUT2 $chr."\t".$ribo_readsnc;
-    foreach my $biotype(sort keys %biotypes_nc){
-        print OUT2 "\t".$biotypes_nc{$biotype};
+    #Init
+    my $index_dir = $TMP."/mappingqc/annotation_index";
+    if (! -e $index_dir){
+        system("mkdir -p ".$index_dir);
     }
-    print OUT2 "\n";
+    my $annotation = {};
     
-    print "\t*) Finished metagenic analysis for chromosome ".$chr."\n";
+    ## Init multi core, largest chromosomes first
+    my %task_durations;
+    my $pm = init_worker_pool($cores, \%task_durations);
     
-    return;
+    foreach my $chr (schedule_chromosomes($chrs, \%chr_sizes)){
+        
+        ## Start parallel process
+        $pm->start($chr) and next;
+        
+        if (! -e $index_dir."/".$chr.".sto"){
+            my $dbh = dbh("DBI:SQLite:dbname=".$ens_db, "", "");
+            my $seq_region_id = get_seq_region_id($dbh, $chr, $coord_system_id);
+            my $chr_index = build_annotation_index_chr($dbh, $chr, $seq_region_id);
+            $dbh->disconnect();
+            nstore($chr_index, $index_dir."/".$chr.".sto.tmp");
+            system("mv ".$index_dir."/".$chr.".sto.tmp ".$index_dir."/".$chr.".sto");
+        }
+        
+        $pm->finish;
+    }
+    
+    # Finish all subprocesses
+    $pm->wait_all_children;
+    report_task_durations("Annotation index", \%task_durations);
     
+    #Load all chromosomes in the parent
+    foreach my $chr (keys %{$chrs}){
+        $annotation->{$chr} = retrieve($index_dir."/".$chr.".sto");
+    }
+    
+    #Start codons of all canonical transcripts (for native offset estimation)
+    open(my $fw, ">", $index_dir."/start_codons.txt") or die "Cannot write start codons: $!\n";
+    foreach my $chr (sort keys %{$annotation}){
+        my $cds_start = $annotation->{$chr}->{'cds_start'} // [];
+        foreach my $start (@{$cds_start}){
+            print $fw $chr."\t".$start->[0]."\t".$start->[1]."\n";
+        }
+    }
+    close($fw);
+    
+    return $annotation;
 }
 
-## Metagenic analysis: total ##
-sub metagenic_analysis {
+## Build the annotation index of one chromosome ##
+sub build_annotation_index_chr {
     
     #Catch
-    my $db_ens = $_[0];
-    my $us_ens = $_[1];
-    my $pw_ens = $_[2];
-    my %chr_sizes = %{$_[3]};
-    my $cores = $_[4];
-    my $coord_system_id = $_[5];
-    my $tool_dir = $_[6];
+    my $dbh = $_[0];
+    my $chr = $_[1];
+    my $seq_region_id = $_[2];
     
-    #Get Non coding biotypes out of ensembl
-    my %biotypes = %{get_nPCbiotypes($db_ens, $us_ens, $pw_ens)};
+    #Init
+    my $index = {};
+    
+    ########
+    # CANONICAL CDS (phase, triplet and transcript of each coding position)
+    ########
+    my $transcripts = get_can_transcripts($dbh, $seq_region_id);
+    my $segments = {1 => [], -1 => []};
+    $index->{'transcripts'} = [];
+    $index->{'cds_seq'} = [];
+    $index->{'cds_len'} = [];
+    $index->{'cds_start'} = [];
+    foreach my $transcript (@$transcripts){
+        my($exon_struct,$strand,$max_tr_rank) = get_exon_struct_transcript($dbh, $transcript, $chr);
+        next unless ($strand eq '1' || $strand eq '-1');
+        my $tr_idx = scalar(@{$index->{'transcripts'}});
+        my $cur_transcriptomic_pos = 1;
+        for(my $i=1;$i<=$max_tr_rank;$i++){
+            #Segments are kept on genomic coordinates (lo-hi) with the transcriptomic position at lo
+            my ($lo, $hi, $tlo);
+            if($strand eq '1'){
+                ($lo, $hi) = ($exon_struct->{$i}->{'start'}, $exon_struct->{$i}->{'end'});
+                $tlo = $cur_transcriptomic_pos;
+            } else {
+                ($lo, $hi) = ($exon_struct->{$i}->{'end'}, $exon_struct->{$i}->{'start'});
+                $tlo = $cur_transcriptomic_pos + $hi - $lo;
+            }
+            next if ($hi < $lo);
+            push(@{$segments->{$strand}}, [$lo, $hi, $tr_idx, $tlo]);
+            $cur_transcriptomic_pos = $cur_transcriptomic_pos + $hi - $lo + 1;
+        }
+        push(@{$index->{'transcripts'}}, $transcript);
+        push(@{$index->{'cds_seq'}}, $exon_struct->{'sequence'} // "");
+        push(@{$index->{'cds_len'}}, $cur_transcriptomic_pos - 1);
+        #First nucleotide of the start codon (highest coordinate on the reverse strand)
+        push(@{$index->{'cds_start'}}, [$strand, $exon_struct->{1}->{'start'}]) if ($max_tr_rank >= 1);
+    }
+    foreach my $strand (1, -1){
+        $index->{'cds'}->{$strand} = pack_intervals(flatten_cds_segments($segments->{$strand}, $strand), ['trs', 'tlos']);
+    }
     
-    #Open files
-    my $out_table1 = $TMP."/mappingqc/annotation_coding.txt";
-    my $out_table2 = $TMP."/mappingqc/annotation_noncoding.txt";
-    if(-e $out_table1){
-        system("rm -rf ".$out_table1);
+    ########
+    # GENES (gene distribution)
+    ########
+    my $query = "SELECT stable_id,seq_region_start,seq_region_end,seq_region_strand FROM gene WHERE seq_region_id = '$seq_region_id'";
+    my $sth = $dbh->prepare($query);
+    $sth->execute();
+    my $genes = {1 => [], -1 => []};
+    while(my @result = $sth->fetchrow_array()){
+        push(@{$genes->{($result[3] eq '1') ? 1 : -1}}, [$result[1], $result[2], $result[0]]);
     }
-    if(-e $out_table2){
-        system("rm -rf ".$out_table2);
+    $sth->finish();
+    foreach my $strand (1, -1){
+        my @sorted = sort { $a->[0] <=> $b->[0] } @{$genes->{$strand}};
+        $index->{'genes'}->{$strand} = pack_intervals(\@sorted);
+        $index->{'genes'}->{$strand}->{'ids'} = [map { $_->[2] } @sorted];
     }
-    open(OUT1,"+>>",$out_table1) or die $!;
-    open(OUT2,"+>>",$out_table2) or die $!;
     
-    print OUT1 "chr\tribo\texon\t5utr\t3utr\tintron\tnon_protein_coding\tintergenic\n";
-    print OUT2 "chr\tnon_protein_coding";
-    foreach my $biotype(sort keys %biotypes){
-        print OUT2 "\t".$biotype;
+    ########
+    # TRANSCRIPTS, EXONS & UTRs (metagenic classification)
+    ########
+    my $regions = {};
+    foreach my $class ('coding', '5UTR', '3UTR', 'exon'){
+        $regions->{$class} = {1 => [], -1 => []};
     }
-    print OUT2 "\n";
     
-    #Init multi core
-    my $pm = new Parallel::ForkManager($cores);
+    #Protein-coding transcripts
+    $query = "SELECT transcript_id,seq_region_start,seq_region_end,seq_region_strand FROM transcript WHERE seq_region_id = '$seq_region_id' AND biotype = 'protein_coding'";
+    $sth = $dbh->prepare($query);
+    $sth->execute();
+    my $trs_c = $sth->fetchall_hashref('transcript_id');
+    $sth->finish();
+    foreach my $tr_id (keys %{$trs_c}){
+        my $strand = ($trs_c->{$tr_id}{'seq_region_strand'} eq '1') ? 1 : -1;
+        push(@{$regions->{'coding'}->{$strand}}, [$trs_c->{$tr_id}{'seq_region_start'}, $trs_c->{$tr_id}{'seq_region_end'}]);
+    }
     
-    foreach my $chr (keys(%chr_sizes)){
-        
-        #Start parallel process for each chromosome
-        $pm->start and next;
-        
-        #main loop
-        metagenic_analysis_chr($db_ens, $us_ens, $pw_ens, $chr, $coord_system_id);
+    #Exons of all protein-coding transcripts at once
+    $query = "SELECT et.transcript_id,e.exon_id,e.seq_region_start,e.seq_region_end,e.seq_region_strand,et.rank FROM exon_transcript et JOIN exon e ON et.exon_id = e.exon_id JOIN transcript t ON et.transcript_id = t.transcript_id WHERE t.seq_region_id = '$seq_region_id' AND t.biotype = 'protein_coding'";
+    $sth = $dbh->prepare($query);
+    $sth->execute();
+    my $exons = {};
+    while(my @result = $sth->fetchrow_array()){
+        $exons->{$result[0]}->{$result[1]} = {'seq_region_start' => $result[2], 'seq_region_end' => $result[3], 'rank' => $result[5]};
+        push(@{$regions->{'exon'}->{($result[4] == 1) ? 1 : -1}}, [$result[2], $result[3]]);
+    }
+    $sth->finish();
+    
+    #Translations: 5' and 3' UTRs
+    $query = "SELECT tl.transcript_id,tl.start_exon_id,tl.end_exon_id,tl.seq_start,tl.seq_end FROM translation tl JOIN transcript t ON tl.transcript_id = t.transcript_id WHERE t.seq_region_id = '$seq_region_id' AND t.biotype = 'protein_coding'";
+    $sth = $dbh->prepare($query);
+    $sth->execute();
+    while(my @result = $sth->fetchrow_array()){
+        my ($tr_id,$start_id,$end_id,$seq_start,$seq_end) = @result;
+        my $exon = $exons->{$tr_id};
+        next unless (exists $exon->{$start_id} && exists $exon->{$end_id});
+        my $highest_rank = 0;
+        foreach my $exon_id (keys %{$exon}){
+            $highest_rank = ($exon->{$exon_id}->{'rank'} > $highest_rank) ? $exon->{$exon_id}->{'rank'} : $highest_rank;
+        }
+        my $rank_first_exon = $exon->{$start_id}{'rank'};
+        my $rank_last_exon = $exon->{$end_id}{'rank'};
         
-        #Finish process
-        $pm->finish;
+        if($trs_c->{$tr_id}{'seq_region_strand'} eq '1'){ # Forward strand
+            my $start_codon = $exon->{$start_id}{'seq_region_start'} + $seq_start - 1;
+            my $stop_codon = $exon->{$end_id}{'seq_region_start'} + $seq_end - 1;
+            push(@{$regions->{'5UTR'}->{1}}, [$exon->{$start_id}{'seq_region_start'}, $start_codon - 1]);
+            push(@{$regions->{'3UTR'}->{1}}, [$stop_codon + 1, $exon->{$end_id}{'seq_region_end'}]);
+        } elsif($trs_c->{$tr_id}{'seq_region_strand'} eq '-1'){ # Reverse strand
+            my $start_codon = $exon->{$start_id}{'seq_region_end'} - $seq_start + 1;
+            my $stop_codon = $exon->{$end_id}{'seq_region_end'} - $seq_end + 1;
+            push(@{$regions->{'5UTR'}->{-1}}, [$start_codon + 1, $exon->{$start_id}{'seq_region_end'}]);
+            push(@{$regions->{'3UTR'}->{-1}}, [$exon->{$end_id}{'seq_region_start'}, $stop_codon - 1]);
+        } else {
+            next;
+        }
+        my $strand = ($trs_c->{$tr_id}{'seq_region_strand'} eq '1') ? 1 : -1;
+        #5UTR also in exons before first translated exon, 3UTR also in exons after the last translated exon
+        foreach my $exon_id (keys %{$exon}){
+            if ($exon->{$exon_id}->{'rank'} < $rank_first_exon){
+                push(@{$regions->{'5UTR'}->{$strand}}, [$exon->{$exon_id}->{'seq_region_start'}, $exon->{$exon_id}->{'seq_region_end'}]);
+            } elsif ($exon->{$exon_id}->{'rank'} > $rank_last_exon && $rank_last_exon < $highest_rank){
+                push(@{$regions->{'3UTR'}->{$strand}}, [$exon->{$exon_id}->{'seq_region_start'}, $exon->{$exon_id}->{'seq_region_end'}]);
+            }
+        }
+    }
+    $sth->finish();
+    foreach my $class (keys %{$regions}){
+        foreach my $strand (1, -1){
+            $index->{$class}->{$strand} = pack_intervals(merge_intervals($regions->{$class}->{$strand}));
+        }
+    }
+    
+    #Non protein-coding transcripts, sorted on start
+    $query = "SELECT seq_region_start,seq_region_end,seq_region_strand,biotype FROM transcript WHERE seq_region_id = '$seq_region_id' AND biotype NOT LIKE '%protein_coding%'";
+    $sth = $dbh->prepare($query);
+    $sth->execute();
+    my $trs_nc = {1 => [], -1 => []};
+    while(my @result = $sth->fetchrow_array()){
+        push(@{$trs_nc->{($result[2] eq '1') ? 1 : -1}}, [$result[0], $result[1], $result[3]]);
+    }
+    $sth->finish();
+    foreach my $strand (1, -1){
+        my @sorted = sort { $a->[0] <=> $b->[0] } @{$trs_nc->{$strand}};
+        $index->{'noncoding'}->{$strand} = pack_intervals(\@sorted);
+        $index->{'noncoding'}->{$strand}->{'biotypes'} = [map { $_->[2] } @sorted];
+    }
+    
+    return $index;
+}
+
+## Resolve overlapping CDS segments ##
+# Where canonical CDSs overlap, the transcript that comes last owns the position (as in the former phase lib)
+sub flatten_cds_segments {
+    
+    #Catch
+    my $segments = $_[0]; # [lo, hi, transcript index, transcriptomic position at lo]
+    my $strand = $_[1];
+    
+    #Elementary intervals between all segment boundaries
+    my %bounds;
+    foreach my $segment (@{$segments}){
+        $bounds{$segment->[0]} = 1;
+        $bounds{$segment->[1]+1} = 1;
+    }
+    my @bounds = sort {$a <=> $b} keys %bounds;
+    my @by_lo = sort { $segments->[$a]->[0] <=> $segments->[$b]->[0] } (0..$#{$segments});
+    
+    my @flat;
+    my %active;
+    my $next = 0;
+    for (my $i=0; $i<$#bounds; $i++){
+        my ($from, $to) = ($bounds[$i], $bounds[$i+1] - 1);
+        while ($next < @by_lo && $segments->[$by_lo[$next]]->[0] <= $from){
+            $active{$by_lo[$next]} = 1;
+            $next++;
+        }
+        my $owner = -1;
+        foreach my $s (keys %active){
+            if ($segments->[$s]->[1] < $from){
+                delete $active{$s};
+            } elsif ($s > $owner) {
+                $owner = $s;
+            }
+        }
+        next if ($owner < 0);
         
+        my $segment = $segments->[$owner];
+        if (@flat && $flat[-1]->[4] == $owner && $flat[-1]->[1] == $from - 1){
+            $flat[-1]->[1] = $to;
+        } else {
+            my $tlo = ($strand == 1) ? $segment->[3] + ($from - $segment->[0]) : $segment->[3] - ($from - $segment->[0]);
+            push(@flat, [$from, $to, $segment->[2], $tlo, $owner]);
+        }
     }
     
-    #Finish all processes
-    $pm->wait_all_children;
+    return \@flat;
+}
+
+## Merge overlapping and adjacent intervals ##
+sub merge_intervals {
     
-    #Close output stream
-    close(OUT1);
-    close(OUT2);
+    #Catch
+    my $intervals = $_[0];
     
-    #output figures
-    my $out_png1 = $TMP."/mappingqc/annotation_coding.png";
-    my $out_png2 = $TMP."/mappingqc/annotation_noncoding.png";
-    if(-e $out_png1){
-        system("rm -rf ".$out_png1);
+    my @merged;
+    foreach my $interval (sort { $a->[0] <=> $b->[0] } @{$intervals}){
+        next if ($interval->[1] < $interval->[0]);
+        if (@merged && $interval->[0] <= $merged[-1]->[1] + 1){
+            $merged[-1]->[1] = ($interval->[1] > $merged[-1]->[1]) ? $interval->[1] : $merged[-1]->[1];
+        } else {
+            push(@merged, [$interval->[0], $interval->[1]]);
+        }
     }
-    if(-e $out_png2){
-        system("rm -rf ".$out_png2);
+    
+    return \@merged;
+}
+
+## Pack sorted intervals in 32 bit vectors ##
+# Fields: starts, ends and optionally extra integer columns (3rd, 4th,... element of each interval)
+sub pack_intervals {
+    
+    #Catch
+    my $intervals = $_[0];
+    my $extra = $_[1] // [];
+    
+    my $packed = {'n' => scalar(@{$intervals}), 'starts' => '', 'ends' => ''};
+    foreach my $field (@{$extra}){
+        $packed->{$field} = '';
+    }
+    for (my $i=0; $i<@{$intervals}; $i++){
+        vec($packed->{'starts'}, $i, 32) = $intervals->[$i]->[0];
+        vec($packed->{'ends'}, $i, 32) = $intervals->[$i]->[1];
+        for (my $j=0; $j<@{$extra}; $j++){
+            vec($packed->{$extra->[$j]}, $i, 32) = $intervals->[$i]->[$j+2];
+        }
     }
     
-    # Make Pie Charts
-    piecharts($out_table1,$out_table2,$out_png1,$out_png2,$tool_dir);
+    return $packed;
+}
+
+## Find the interval containing a position (binary search on packed, sorted intervals) ##
+sub find_interval {
     
-    return;
+    #Catch
+    my $intervals = $_[0];
+    my $pos = $_[1];
+    
+    my ($lo, $hi) = (0, $intervals->{'n'} - 1);
+    my $found = -1;
+    while ($lo <= $hi){
+        my $mid = ($lo + $hi) >> 1;
+        if (vec($intervals->{'starts'}, $mid, 32) <= $pos){
+            $found = $mid;
+            $lo = $mid + 1;
+        } else {
+            $hi = $mid - 1;
+        }
+    }
+    
+    return ($found >= 0 && vec($intervals->{'ends'}, $found, 32) >= $pos) ? $found : -1;
 }
 
-#Startup R for plotting pie charts
-sub piecharts{
-    print "Make Pie Charts...\n";
+## Look up phase, triplet, transcript and relative position of a P site in the canonical CDSs ##
+sub cds_lookup {
     
-    # Catch
-    my $out_table1 = $_[0];
-    my $out_table2 = $_[1];
-    my $out_png1 = $_[2];
-    my $out_png2 = $_[3];
-    my $tooldir = $_[4];
+    #Catch
+    my $annotation = $_[0];
+    my $strand = $_[1];
+    my $pos = $_[2];
+    
+    my $cds = $annotation->{'cds'}->{$strand};
+    my $i = find_interval($cds, $pos);
+    return () if ($i < 0);
+    
+    my $tr_idx = vec($cds->{'trs'}, $i, 32);
+    my $tpos = ($strand == 1) ? vec($cds->{'tlos'}, $i, 32) + ($pos - vec($cds->{'starts'}, $i, 32)) : vec($cds->{'tlos'}, $i, 32) - ($pos - vec($cds->{'starts'}, $i, 32));
+    my $phase = ($tpos - 1) % 3;
+    my $sequence = $annotation->{'cds_seq'}->[$tr_idx];
+    my $triplet = ($tpos - 1 - $phase < length($sequence)) ? substr($sequence, $tpos - 1 - $phase, 3) : "";
+    my $rel_pos = $tpos / ($annotation->{'cds_len'}->[$tr_idx] + 1);
     
-    # Execute Rscript
-    system("Rscript ".$tooldir."/metagenic_piecharts.R ".$out_table1." ".$out_table2." ".$out_png1." ".$out_png2);
+    return ($phase, $triplet, $annotation->{'transcripts'}->[$tr_idx], $rel_pos);
 }
 
-#Get reads out of tmp files
-sub get_reads{
+## Fused chromosomal analysis ##
+# Uses the (shared) annotation index of the chromosome and derives the RPF phase table, triplet tables,
+# phase-position histogram, gene counts and metagenic classes out of one pass over its reads.
+# All of them are saved together as the QC summary of the chromosome.
+sub fused_analysis_per_chr {
+    
+    #Catch
+    my $sam = $_[0];
+    my $chr = $_[1];
+    my $annotation = $_[2];
+    my $offset_hash = $_[3];
+    my $min_l_parsing = $_[4];
+    my $max_l_parsing = $_[5];
+    my $biotypes = $_[6];
+    my $chunk = $_[7]; #Only used in adaptive mode
+    
+    #Adaptive mode: split the chromosome in read chunks in the first round
+    if (defined $chunk){
+        partition_chr_sam($TMP."/mappingqc/".$samFileName."_".$chr, $adaptive_chunks);
+    }
+    
+    #All counts of this chromosome go into one QC summary
+    my $summary = new_qc_summary($pos_bins);
+    
+    #Phase and triplet analysis, keep sorted P site counts per strand for the other analyses
+    my $psites = RIBO_parsing_genomic_per_chr($annotation, $sam, $chr, $offset_hash, $min_l_parsing, $max_l_parsing, $summary, $chunk);
+    
+    #Gene distribution
+    gene_distribution_chr($annotation, $chr, $summary, $psites);
     
-    # Catch
-    my $chr = $_[0];
-    my $strand = $_[1];
+    #Metagenic classification
+    metagenic_analysis_chr($annotation, $chr, $biotypes, $summary, $psites);
     
-    # Init
-    my $ribo_reads = {};
-    my $read_keys = [];
+    #Remove spilled P site runs
+    delete_psite_run($psites->{1});
+    delete_psite_run($psites->{-1});
     
-    #Open chromosomal read tmp file
-    my $reads_file = "";
-    if($strand eq 1){
-        $reads_file = $TMP."/counts/reads_".$chr."_FOR.csv";
-    } else {
-        $reads_file = $TMP."/counts/reads_".$chr."_REV.csv";
-    }
-    open(READS,"<",$reads_file);
-    while(my $line = <READS>){
-        chomp $line;
-        my @elements = split(/,/, $line);
-        $ribo_reads->{$elements[0]}->{'count'} = $elements[1];
-        push(@{$read_keys}, $elements[0]);
-    }
-    close(READS);
+    #Save the chromosomal QC summary
+    write_qc_summary($summary, $TMP."/mappingqc/qc_summary_".$chr.".bin");
     
-    # Return
-    return($ribo_reads, $read_keys);
+    return;
 }
 
 ### RIBO PARSE PER CHR ###
 sub RIBO_parsing_genomic_per_chr {
     
     #Catch
-    my $work_dir = $_[0];
+    my $annotation = $_[0];
     my $sam = $_[1];
     my $chr = $_[2];
-    my $ens_db = $_[3];
-    my $coord_system_id = $_[4];
-    my $offset_hash = $_[5];
-    my $min_l_parsing = $_[6];
-    my $max_l_parsing = $_[7];
+    my $offset_hash = $_[3];
+    my $min_l_parsing = $_[4];
+    my $max_l_parsing = $_[5];
+    my $summary = $_[6];
+    my $chunk = $_[7];
     
     my @splitsam = split(/\//, $sam );
     my $samFileName = $splitsam[$#splitsam];
     @splitsam = split(/\./,$samFileName);
     $samFileName = $splitsam[0];
     
-    #Construct phase library
-    my ($phase_lib, $triplet_lib, $transcript_lib) = construct_phase_lib($chr, $ens_db, $coord_system_id);
-    
     #Initialize
     my ($genmatchL,$offset,$start,$intron_total,$extra_for_min_strand);
-    my $phase_count_RPF = {};
+    my $phase_count_RPF = $summary->{'rpf_phase'};
     for (my $i=$offset_hash->{'min'};$i<=$offset_hash->{'max'};$i++){
         for (my $j=0;$j<=2;$j++){
-            $phase_count_RPF->{$i}->{$j} = 0;
+            $phase_count_RPF->{$i}->{$j} //= 0;
         }
     }
-    my $phase_count_file = $TMP."/mappingqc/rpf_phase_".$chr.".csv";
-    my $phase_count_triplet = {};
-    my $count_triplet_transcript = {};
-    my $triplet_count_file = $TMP."/mappingqc/triplet_phase_".$chr.".csv";
-    my $norm_triplet_count_file = $TMP."/mappingqc/triplet_phase_norm_".$chr.".csv";
-    my $chr_sam_file = $TMP."/mappingqc/".$samFileName."_".$chr.".sam";
-    my $pos_file = $TMP."/mappingqc/phase_position_".$chr.".csv";
-    my $hits_genomic = {};
-    my $counts_per_transcript = {};
+    my $phase_count_triplet = $summary->{'triplet_phase'};
+    my $count_triplet_transcript = $summary->{'triplet_transcript'};
+    my $pos_hist = $summary->{'pos_hist'};
+    my $pos_bins = $summary->{'pos_bins'};
+    my $chr_sam_file = $TMP."/mappingqc/".$samFileName."_".$chr.((defined $chunk) ? "_chunk".$chunk : "").".sam";
+    my %psite_collectors = (
+        1 => new_psite_collector($TMP."/mappingqc/psites_".$chr."_for"),
+        -1 => new_psite_collector($TMP."/mappingqc/psites_".$chr."_rev")
+    );
     
     open (I,"<".$chr_sam_file) || die "Cannot open ".$chr_sam_file."\n";
-    open (OUT_POS, "+>>".$pos_file) or die $!;
 
     
     while(my $line=<I>){
@@ -1672,18 +2680,14 @@ sub RIBO_parsing_genomic_per_chr {
         $start = ($strand eq "+") ? $mapping_store[3] + $offset + $intron_total : ($strand eq "-") ? $mapping_store[3] - $offset - $intron_total + $extra_for_min_strand -1 : "";
         
         if($genmatchL>=$offset_hash->{"min"} && $genmatchL<=$offset_hash->{"max"}){
-            if(exists $phase_lib->{$strandAlt}->{$start}->{"phase"}){
+            my ($read_phase, $read_triplet, $transcript, $rel_pos) = cds_lookup($annotation, $strandAlt, $start);
+            if(defined $read_phase){
                 #Add for RPF-splitted phase distribution
-                $phase_count_RPF->{$genmatchL}->{$phase_lib->{$strandAlt}->{$start}->{"phase"}}++;
-                #Print to tmp chr phase-position distribbution
-                if(exists $phase_lib->{$strandAlt}->{$start}->{"transcriptomic_pos"}){
-                    my $read_phase = $phase_lib->{$strandAlt}->{$start}->{"phase"};
-                    print OUT_POS $read_phase.",".$phase_lib->{$strandAlt}->{$start}->{"transcriptomic_pos"}."\n";
-                }
-            }
-            if(exists $triplet_lib->{$strandAlt}->{$start}){
-                my $read_phase = $phase_lib->{$strandAlt}->{$start}->{"phase"};
-                my $read_triplet = $triplet_lib->{$strandAlt}->{$start};
+                $phase_count_RPF->{$genmatchL}->{$read_phase}++;
+                #Add to chr phase-position histogram
+                my $bin = int($rel_pos * $pos_bins);
+                $bin = ($bin < $pos_bins) ? $bin : $pos_bins - 1;
+                $pos_hist->{$read_phase}->{$bin}++;
                 if(length($read_triplet)==3){
                     if(exists $phase_count_triplet->{$read_triplet}){
                         $phase_count_triplet->{$read_triplet}->{$read_phase}++;
@@ -1694,106 +2698,32 @@ sub RIBO_parsing_genomic_per_chr {
                         $phase_count_triplet->{$read_triplet}->{2} = 0;
                         $phase_count_triplet->{$read_triplet}->{$read_phase}++;
                     }
-                    #Count triplets also per transcript, but do not include phase stratifier
-                    if(exists $transcript_lib->{$strandAlt}->{$start}){
-                        my $transcript = $transcript_lib->{$strandAlt}->{$start};
-                        if(exists $count_triplet_transcript->{$transcript}->{$read_triplet}){
-                            $count_triplet_transcript->{$transcript}->{$read_triplet}++;
-                        } else {
-                            $count_triplet_transcript->{$transcript}->{$read_triplet} = 1;
-                        }
-                    }
-                    #Count reads per ORF for normalizing afterwards
-                    if(exists $transcript_lib->{$strandAlt}->{$start}){
-                        my $read_transcript = $transcript_lib->{$strandAlt}->{$start};
-                        if(exists $counts_per_transcript->{$read_transcript}){
-                            $counts_per_transcript->{$read_transcript}++;
-                        } else {
-                            $counts_per_transcript->{$read_transcript} = 1;
-                        }
-                    }
+                    #Count triplets also per transcript, but do not include phase stratifier (normalized afterwards)
+                    $count_triplet_transcript->{$transcript}->{$read_triplet}++;
                 }
             }
             
             #Save counts for gene distribution and metagenic classification
             if($genmatchL >= $min_l_parsing && $genmatchL <= $max_l_parsing){
-                if(exists $hits_genomic->{$start}->{$strandAlt}){
-                    $hits_genomic->{$start}->{$strandAlt}++;
-                } else {
-                    $hits_genomic->{$start}->{$strandAlt} = 0;
-                    $hits_genomic->{$start}->{$strandAlt}++;
+                my $collector = $psite_collectors{$strandAlt};
+                $collector->{'chunk'} .= pack("N", $start);
+                if(++$collector->{'n'} >= $psite_chunk_size){
+                    flush_psite_chunk($collector);
                 }
             }
         }
 
     }
     
-    #Normalize triplet counts per transcript over the transcript expression
-    my $norm_triplet_counts = {};
-    foreach my $transcript (keys %{$count_triplet_transcript}){
-        foreach my $triplet (keys %{$count_triplet_transcript->{$transcript}}){
-            my $norm_triplet_count = $count_triplet_transcript->{$transcript}->{$triplet}/$counts_per_transcript->{$transcript};
-            if(exists $norm_triplet_counts->{$triplet}){
-                $norm_triplet_counts->{$triplet} = $norm_triplet_counts->{$triplet} + $norm_triplet_count;
-            } else {
-                $norm_triplet_counts->{$triplet} = $norm_triplet_count;
-            }
-        }
-    }
-    
     #Stop reading out of input files
     close(I);
     
-    #Write read counts to files for later use in gene distributions and metagenic classification
-    my $chr_for_reads_file = $TMP."/counts/reads_".$chr."_FOR.csv";
-    my $chr_rev_reads_file = $TMP."/counts/reads_".$chr."_REV.csv";
-    system("rm -rf ".$chr_for_reads_file);
-    system("rm -rf ".$chr_rev_reads_file);
-    open (CHR_FOR_READS,"+>>".$chr_for_reads_file) or die $!;
-    open (CHR_REV_READS,"+>>".$chr_rev_reads_file) or die $!;
-    
-    foreach my $pos (sort {$a <=> $b} keys %{$hits_genomic}){
-        if(exists $hits_genomic->{$pos}->{1}){
-            print CHR_FOR_READS $pos.",".$hits_genomic->{$pos}->{1}."\n";
-        }
-        if(exists $hits_genomic->{$pos}->{-1}){
-            print CHR_REV_READS $pos.",".$hits_genomic->{$pos}->{-1}."\n";
-        }
-    }
-    
-    #Stop writing reads out
-    close(CHR_FOR_READS);
-    close(CHR_REV_READS);
-    
-    #Write to chromosomal rpf phase tmp file
-    open (OUT_RPF_PHASE, "+>>".$phase_count_file) or die $!;
-    
-    for (my $i=$offset_hash->{'min'};$i<=$offset_hash->{'max'};$i++){
-        print OUT_RPF_PHASE $i.",".$phase_count_RPF->{$i}->{0}.",".$phase_count_RPF->{$i}->{1}.",".$phase_count_RPF->{$i}->{2}."\n";
-    }
-    close(OUT_RPF_PHASE);
-    
-    #Write to chromosomal triplet phase tmp file
-    open (OUT_TRIPLET_PHASE, "+>>".$triplet_count_file) or die $!;
-    
-    foreach my $triplet (keys %{$phase_count_triplet}){
-        foreach my $phase (keys %{$phase_count_triplet->{$triplet}}){
-            print OUT_TRIPLET_PHASE $triplet.",".$phase.",".$phase_count_triplet->{$triplet}->{$phase}."\n";
-        }
-    }
-    
-    close(OUT_TRIPLET_PHASE);
-    
-    #Write to chromosomal norm triplet tmp file
-    open (OUT_NORM_TRIPLET, "+>>".$norm_triplet_count_file) or die $!;
-    
-    foreach my $triplet (keys %{$norm_triplet_counts}){
-        print OUT_NORM_TRIPLET $triplet.",".$norm_triplet_counts->{$triplet}."\n";
+    #Sorted (position, count) runs per strand are kept for gene distribution and metagenic classification
+    my $psites = {};
+    foreach my $strandAlt (1, -1){
+        $psites->{$strandAlt} = finish_psite_collector($psite_collectors{$strandAlt});
     }
-    
-    close(OUT_NORM_TRIPLET);
-    
-    return;
+    return $psites;
 }
 
 #Get non coding biotypes
@@ -1945,125 +2875,6 @@ sub parse_RIBO_CIGAR {
     return($offset,$genmatchL,$intron_total,$extra_for_min_strand)
 }
 
-#Construct phase lib out of ensembl info
-sub construct_phase_lib{
-    
-    #Catch
-    my $chr = $_[0];
-    my $eDB = $_[1];
-    my $coord_system_id = $_[2];
-    
-    #Init
-    my $phase_lib = {};
-    my $triplet_lib = {};
-    my $transcript_lib = {};
-    my $dsn_sqlite_ens = "DBI:SQLite:dbname=$eDB";
-    my $us_sqlite_ens  = "";
-    my $pw_sqlite_ens  = "";
-    
-    #Init dbh
-    my $dbh_ens = dbh($dsn_sqlite_ens,$us_sqlite_ens,$pw_sqlite_ens);
-    
-    #Get seq_region_id
-    my $seq_region_id = get_seq_region_id($dbh_ens, $chr, $coord_system_id);
-    
-    #Get transcripts (canonical protein-coding)
-    my $transcripts = get_can_transcripts($dbh_ens, $seq_region_id);
-    
-    #Get exon structure of each transcript
-    foreach my $transcript (@$transcripts){
-        my($exon_struct,$strand,$max_tr_rank) = get_exon_struct_transcript($dbh_ens, $transcript, $chr);
-        ($phase_lib, $triplet_lib, $transcript_lib) = add_transcript_to_phase_lib($phase_lib, $triplet_lib, $transcript_lib, $exon_struct, $strand, $max_tr_rank, $transcript);
-    }
-    
-    #Disconnect
-    $dbh_ens->disconnect;
-    
-    return ($phase_lib, $triplet_lib, $transcript_lib);
-}
-
-#Add transcript to phase lib
-sub add_transcript_to_phase_lib{
-    
-    #Catch
-    my $phase_lib = $_[0];
-    my $triplet_lib = $_[1];
-    my $transcript_lib = $_[2];
-    my $exon_struct = $_[3];
-    my $strand = $_[4];
-    my $max_tr_rank = $_[5];
-    my $transcript = $_[6];
-    
-    my $cur_phase = 0;
-    my $cur_transcriptomic_pos = 1;
-    my $cur_triplet = "";
-    if($strand eq '1'){
-        for(my $i=1;$i<=$max_tr_rank;$i++){
-            my $position = $exon_struct->{$i}->{'start'};
-            while($position<=$exon_struct->{$i}->{'end'}){
-                $phase_lib->{$strand}->{$position}->{"phase"} = $cur_phase; #Phase lib
-                #Get new triplet for phase 0
-                if($cur_phase==0){
-                    $cur_triplet = substr($exon_struct->{'sequence'},$cur_transcriptomic_pos-1,3);
-                }
-                $triplet_lib->{$strand}->{$position} = $cur_triplet;#Add triplet to triplet lib
-                $phase_lib->{$strand}->{$position}->{"transcriptomic_pos"} = $cur_transcriptomic_pos; #For rel position calculation
-                $transcript_lib->{$strand}->{$position} = $transcript; #For each position in the canonical coding ORF: keep its transcript ID from Ensembl
-                #Get ready for next position
-                $cur_phase++;
-                if($cur_phase == 3){
-                    $cur_phase = 0;
-                }
-                $cur_transcriptomic_pos++;
-                $position++;
-            }
-        }
-        #Save the last position as the sequence length
-        my $seq_length = $cur_transcriptomic_pos;
-        #Then use this length to calculate normalized positions in the sequence
-        for(my $i=1;$i<=$max_tr_rank;$i++){
-            my $position2 = $exon_struct->{$i}->{'start'};
-            while($position2<=$exon_struct->{$i}->{'end'}){
-                $phase_lib->{$strand}->{$position2}->{"transcriptomic_pos"} = $phase_lib->{$strand}->{$position2}->{"transcriptomic_pos"} / $seq_length;
-                $position2++;
-            }
-        }
-    } elsif ($strand eq '-1'){
-        for(my $i=1; $i<=$max_tr_rank; $i++){
-            my $position = $exon_struct->{$i}->{'start'}; #strand relative
-            while($position>=$exon_struct->{$i}->{'end'}){
-                $phase_lib->{$strand}->{$position}->{"phase"} = $cur_phase;
-                if($cur_phase==0){
-                    $cur_triplet = substr($exon_struct->{'sequence'},$cur_transcriptomic_pos-1,3);
-                }
-                $triplet_lib->{$strand}->{$position} = $cur_triplet;
-                $phase_lib->{$strand}->{$position}->{"transcriptomic_pos"} = $cur_transcriptomic_pos;
-                $transcript_lib->{$strand}->{$position} = $transcript;
-                #Set for next position
-                $cur_phase++;
-                if($cur_phase == 3){
-                    $cur_phase = 0;
-                }
-                
-                $cur_transcriptomic_pos++;
-                $position--;
-            }
-        }
-        #Save the last position as the sequence length
-        my $seq_length = $cur_transcriptomic_pos;
-        #Calculate normalized positions
-        for(my $i=1; $i<=$max_tr_rank; $i++){
-            my $position = $exon_struct->{$i}->{'start'}; #strand relative
-            while($position>=$exon_struct->{$i}->{'end'}){
-                $phase_lib->{$strand}->{$position}->{"transcriptomic_pos"} = $phase_lib->{$strand}->{$position}->{"transcriptomic_pos"} / $seq_length;
-                $position--;
-            }
-        }
-    }
-    
-    return $phase_lib, $triplet_lib, $transcript_lib;
-}
-
 ## Construct exon structure for certain transcript
 sub get_exon_struct_transcript{
     
@@ -2223,7 +3034,68 @@ sub run_plastid{
         $bam = $bam_adress;
     }
     
-    #Get genes.gtf file
+    #Regions of interest only depend on the annotation, so they are cached per annotation fingerprint
+    my $fingerprint = md5_hex(join("\t", $spec, $assembly, $version));
+    my $cache_dir = $annotation_cache."/".$fingerprint;
+    my $rois = $cache_dir."/rois.txt";
+    if (! -e $rois){
+        system("mkdir -p ".$cache_dir);
+        #Only one run generates the regions of interest, concurrent runs wait for the lock
+        open(my $lock, ">", $cache_dir."/rois.lock") or die "Cannot open lock file in ".$cache_dir.": $!\n";
+        flock($lock, LOCK_EX) or die "Cannot lock ".$cache_dir."/rois.lock: $!\n";
+        if (! -e $rois){
+            download_genes_gtf($TMP, $version, $spec, $assembly);
+            print "Generate metagene\n";
+            my $outbase = $cache_dir."/rois_tmp_".$$;
+            my $command_metagene = "metagene generate -q ".$outbase." --landmark cds_start --annotation_files ".$TMP."/Genes/genes.gtf 2> /dev/null";
+            system($command_metagene);
+            open(my $fw, ">", $cache_dir."/annotation.txt") or die "Cannot write ".$cache_dir."/annotation.txt: $!\n";
+            print $fw "species\t".$spec."\nassembly\t".$assembly."\nensembl_version\t".$version."\n";
+            close($fw);
+            #The rois.txt file marks the cache entry as finished, so move it last
+            system("mv ".$outbase."_rois.bed ".$cache_dir."/rois.bed");
+            system("mv ".$outbase."_rois.txt ".$rois);
+        } else {
+            print "Plastid metagene generated by a concurrent run\n";
+        }
+        flock($lock, LOCK_UN);
+        close($lock);
+    } else {
+        print "Plastid metagene already present in annotation cache (".$cache_dir.")\n";
+    }
+    
+    #Generate tmp folder for plastid
+    if (! -e $TMP."/plastid"){
+        system("mkdir ".$TMP."/plastid");
+    }
+    
+    #Calculate offsets
+    if (! -e $TMP."/plastid/".$exp_name."_p_offsets.txt"){
+        print "Index bam file\n";
+        system("samtools index ".$bam);
+        
+        print "Calculate offsets with plastid\n";
+        my $command_offsets = "psite -q ".$rois." ".$exp_name." --min_length ".$min_l." --max_length ".$max_l." --require_upstream --count_files ".$bam." 2> /dev/null";
+        system($command_offsets);
+        system("mv ".$exp_name."_metagene_profiles.txt ".$TMP."/plastid");
+        system("mv ".$exp_name."_p_offsets.txt ".$TMP."/plastid");
+        system("mv ".$exp_name."_p_offsets.png ".$TMP."/plastid");
+    } else {
+        print "Plastid offsets already present\n";
+    }
+    
+    return read_plastid_offsets($TMP, $exp_name, $min_l, $max_l);
+}
+
+##Download the genes gtf file for plastid
+sub download_genes_gtf{
+    
+    #Catch
+    my $TMP = $_[0];
+    my $version = $_[1];
+    my $spec = $_[2];
+    my $assembly = $_[3];
+    
     if (! -e $TMP."/Genes"){
         system("mkdir ".$TMP."/Genes");
     }
@@ -2265,41 +3137,85 @@ sub run_plastid{
         print "Genes gtf file for plastid already present\n";
     }
     
-    #Generate tmp folder for plastid
+    return;
+}
+
+##Estimate p site offsets out of the reads around the start codons of the annotation index
+sub run_native_offsets{
+    
+    #Catch
+    my $bam = $_[0];
+    my $TMP = $_[1];
+    my $exp_name = $_[2];
+    my $min_l = $_[3];
+    my $max_l = $_[4];
+    
+    print "NATIVE OFFSET ESTIMATION\n";
+    
+    #Check bam file. A coordinate sorted bam input is used as is, otherwise a sorted bam file is made out of the input
+    if ($bam eq "convert"){
+        my $sorted = "N";
+        if (defined $original_bam){
+            my $header = `samtools view -H $original_bam`;
+            if ($header =~ m/^\@HD\t.*SO:coordinate/m){
+                $sorted = "Y";
+            }
+        }
+        if ($sorted eq "Y"){
+            $bam = $original_bam;
+        } else {
+            my $input = (defined $original_bam) ? $original_bam : $sam;
+            my $bam_adress = $TMP."/mappingqc/".$samFileName.".bam";
+            if (! -e $bam_adress){
+                print "Convert input file to sorted bam file with samtools sort\n";
+                system("samtools sort -o ".$bam_adress." ".$input) == 0 or die "ERROR: samtools sort of ".$input." failed\n";
+            } else {
+                print "Bam file for offset estimation already present\n";
+            }
+            $bam = $bam_adress;
+        }
+    }
+    
+    #Offset files are written in plastid format
     if (! -e $TMP."/plastid"){
         system("mkdir ".$TMP."/plastid");
     }
-    
-    #Generate metagene
-    if (! -e $TMP."/plastid/".$exp_name."_rois.txt"){
-        print "Generate metagene\n";
-        my $command_metagene = "metagene generate -q ".$exp_name." --landmark cds_start --annotation_files ".$TMP."/Genes/genes.gtf 2> /dev/null";
-        system($command_metagene);
-        system("mv ".$exp_name."_rois.bed ".$TMP."/plastid");
-        system("mv ".$exp_name."_rois.txt ".$TMP."/plastid");
+    if (! -e $TMP."/plastid/".$exp_name."_p_offsets.txt"){
+        print "Calculate offsets out of the start codon metagene\n";
+        my $command_offsets = "python ".$tool_dir."/psite_offsets.py -b ".$bam." -c ".$TMP."/mappingqc/annotation_index/start_codons.txt -n ".$exp_name." -o ".$TMP."/plastid -l ".$min_l." -u ".$max_l." -t ".$offset_target_reads;
+        system($command_offsets) == 0 or die "ERROR: offset estimation failed, no offsets written for ".$exp_name."\n";
     } else {
-        print "Plastid metagene already present\n";
+        print "Offsets already present\n";
     }
     
-    #Calculate offsets
-    if (! -e $TMP."/plastid/".$exp_name."_p_offsets.txt"){
-        print "Index bam file\n";
-        system("samtools index ".$bam);
-        
-        print "Calculate offsets with plastid\n";
-        my $command_offsets = "psite -q ".$TMP."/plastid/".$exp_name."_rois.txt ".$exp_name." --min_length ".$min_l." --max_length ".$max_l." --require_upstream --count_files ".$bam." 2> /dev/null";
-        system($command_offsets);
-        system("mv ".$exp_name."_metagene_profiles.txt ".$TMP."/plastid");
-        system("mv ".$exp_name."_p_offsets.txt ".$TMP."/plastid");
-        system("mv ".$exp_name."_p_offsets.png ".$TMP."/plastid");
-    } else {
-        print "Plastid offsets already present\n";
+    #Report the confidence of each offset
+    my $confidence_file = $TMP."/plastid/".$exp_name."_offset_confidence.txt";
+    if (-e $confidence_file){
+        print "Offset confidence (RPF length, offset, reads, peak fraction, peak ratio, confidence):\n";
+        open(my $fr, "<", $confidence_file) or die "Cannot open ".$confidence_file.": $!\n";
+        while(my $line = <$fr>){
+            next if ($line =~ m/^length/);
+            print "\t".$line;
+        }
+        close($fr);
     }
     
+    return read_plastid_offsets($TMP, $exp_name, $min_l, $max_l);
+}
+
+##Read offsets in plastid psite format
+sub read_plastid_offsets{
+    
+    #Catch
+    my $TMP = $_[0];
+    my $exp_name = $_[1];
+    my $min_l = $_[2];
+    my $max_l = $_[3];
+    
     #Read in offsets
     my $offset_hash = {};
     
-    open(OFFSET, "<", $TMP."/plastid/".$exp_name."_p_offsets.txt");
+    open(OFFSET, "<", $TMP."/plastid/".$exp_name."_p_offsets.txt") or die "Cannot open ".$TMP."/plastid/".$exp_name."_p_offsets.txt: $!\n";
     while(my $line = <OFFSET>){
         if($line =~ /^(\d+)\s+(\d+)$/){
             my $length = $1;
@@ -2350,6 +3266,96 @@ sub offsets_to_csv {
     close($fw);
 }
 
+## Construct the P site offset hash of the offset option of the run ##
+sub construct_offsets {
+    
+    my $offset_hash = {};
+    if($offset_option eq "plastid"){
+    
+        $offset_hash = run_plastid($bam, $TMP, $version, $spec, $assembly, $exp_name, $min_length_plastid, $max_length_plastid);
+    
+    } elsif($offset_option eq "native"){
+    
+        $offset_hash = run_native_offsets($bam, $TMP, $exp_name, $min_length_plastid, $max_length_plastid);
+    
+    } elsif($offset_option eq "from_file"){
+        #Init
+        $offset_hash->{"min"} = 1000;
+        $offset_hash->{"max"} = 0;
+        #Read in file
+        open(my $FR, $offset_file) or die "Could not open $offset_file";
+    
+        #Parse
+        while(my $line = <$FR>){
+            if($line =~ /^(\d+)\s+(\d+)$/){
+                my $length = $1;
+                my $offset = $2;
+                $offset_hash->{$length} = $offset;
+                if($length<$offset_hash->{"min"}){
+                    $offset_hash->{"min"} = $length;
+                }
+                if($length>$offset_hash->{"max"}){
+                    $offset_hash->{"max"} = $length;
+                }
+            }
+        }
+    } elsif($offset_option eq "cst_3prime"){
+    
+        #Translate constant 3 prime offsets into 5 prime offsets
+        $offset_hash->{"min"} = $min_cst_3prime_offset;
+        $offset_hash->{"max"} = $max_cst_3prime_offset;
+        for(my $rpf = $offset_hash->{"min"}; $rpf<=$offset_hash->{"max"}; $rpf++){
+            $offset_hash->{$rpf} = $rpf - $cst_3prime_offset - 1
+        }
+    
+    } else {
+        #Standard P site offset options from Ingolia paper (2012) (cfr. suppl methods in that paper)
+        if(uc($species) eq 'FRUITFLY'){
+            $offset_hash->{25} = 12;
+        }
+        $offset_hash->{26} = 12;
+        $offset_hash->{27} = 12;
+        $offset_hash->{28} = 12;
+        $offset_hash->{29} = 12;
+        $offset_hash->{30} = 12;
+        $offset_hash->{31} = 13;
+        $offset_hash->{32} = 13;
+        $offset_hash->{33} = 13;
+        $offset_hash->{34} = 14;
+    
+        #Boundaries
+        if(uc($species) eq 'FRUITFLY'){
+            $offset_hash->{"min"} = 25;
+        } else {
+            $offset_hash->{"min"} = 26;
+        }
+        $offset_hash->{"max"} = 34;
+    }
+    
+    return $offset_hash;
+}
+
+## Read offsets of a previous run ##
+sub read_offsets_csv {
+    
+    #Catch
+    my $TMP = $_[0];
+    
+    my $infile = $TMP."/mappingqc/mappingqc_offsets.csv";
+    my $offset_hash = {'min' => 1000, 'max' => 0};
+    open(my $fr, "<", $infile) or die "Could not open the offsets of the previous run (".$infile.")!\n";
+    while(my $line = <$fr>){
+        if($line =~ /^(\d+),(\d+)$/){
+            $offset_hash->{$1} = $2;
+            $offset_hash->{'min'} = ($1 < $offset_hash->{'min'}) ? $1 : $offset_hash->{'min'};
+            $offset_hash->{'max'} = ($1 > $offset_hash->{'max'}) ? $1 : $offset_hash->{'max'};
+        }
+    }
+    close($fr);
+    
+    return $offset_hash;
+}
+
 ### SPLIT SAM PER CHR ###
 sub split_SAM_per_chr {
     
@@ -2377,14 +3383,20 @@ sub split_SAM_per_chr {
     
     ## Split files into chromosomes
     
-    # Open
-    open (I,"<".$sam) || die "Cannot open ".$sam." file\n";
+    # Open (a streaming input goes through samtools, which reads both SAM and BAM)
+    if (defined $stream_input){
+        open (I,"samtools view -h ".$stream_input." |") || die "Cannot read the streaming input\n";
+    } else {
+        open (I,"<".$sam) || die "Cannot open ".$sam." file\n";
+    }
     
     
     #For unsorted SAM file (genomic location)
     my $prev_chr="0";
     my $lines = 0;
     my $count_uniq = 0;
+    my $primary_alignments = 0;
+    my %read_counts;
     
     while(my $line=<I>){
         
@@ -2395,6 +3407,9 @@ sub split_SAM_per_chr {
         
         #Process alignment line
         @mapping_store = split(/\t/,$line);
+        
+        #Count primary alignments (bit flag 0x100 not set) for the output report
+        $primary_alignments++ unless ($mapping_store[1] & 256);
         $chr = $mapping_store[2];
         
         #For STAR: flag 255 means that there is only 1 alignment
@@ -2415,7 +3430,11 @@ sub split_SAM_per_chr {
             next unless ( $line !~ m/NH:i:$maxmultimap/ );
         }
         
+        #Only chromosomes of the analysis (e.g. of this shard)
+        next unless (exists $chr_sizes{$chr});
+        
         # Write off
+        $read_counts{$chr}++;
         if ($prev_chr ne $chr) {
             if ($prev_chr ne "0") { close(A);}
             $file_out = $TMP."/mappingqc/".$samFileName;
@@ -2439,6 +3458,174 @@ sub split_SAM_per_chr {
     # Close
     close(A);
     close(I);
+    
+    #Keep the read count per chromosome as cost estimate for scheduling
+    open(my $fw, ">", $TMP."/mappingqc/".$samFileName."_read_counts.txt") or die $!;
+    foreach $chr (keys %chr_sizes){
+        print $fw $chr."\t".($read_counts{$chr} // 0)."\n";
+    }
+    close($fw);
+    open($fw, ">", $TMP."/mappingqc/".$samFileName."_alignments.txt") or die $!;
+    print $fw $primary_alignments."\n";
+    close($fw);
+}
+
+## Get the number of primary alignments of the input file ##
+sub get_primary_alignments {
+    
+    #Catch
+    my $samFileName = $_[0];
+    my $sam = $_[1];
+    
+    my $count_file = $TMP."/mappingqc/".$samFileName."_alignments.txt";
+    my $alignments;
+    if (-e $count_file){
+        open(my $fr, "<", $count_file) or die $!;
+        $alignments = <$fr>;
+        close($fr);
+    } else {
+        #Splitted sam files of an older run
+        $alignments = `samtools view -c -F 0x100 $sam 2> /dev/null`;
+    }
+    chomp($alignments);
+    
+    return ($alignments =~ m/^\d+$/) ? $alignments : 0;
+}
+
+## Count the alignments of an input file, through the index of an indexed bam file ##
+sub count_input_alignments {
+    
+    #Catch
+    my $file = $_[0];
+    
+    my $alignments = 0;
+    if ($file =~ m/\.bam$/ && (-e $file.".bai" || -e $file.".csi")){
+        #Mapped reads per chromosome out of the index, no need to read the alignments
+        foreach my $line (split(/\n/, `samtools idxstats $file 2> /dev/null`)){
+            my @fields = split(/\t/, $line);
+            $alignments += $fields[2] if (defined $fields[2]);
+        }
+    } else {
+        $alignments = `samtools view -c -F 0x100 $file 2> /dev/null`;
+        chomp($alignments);
+        $alignments = 0 unless ($alignments =~ m/^\d+$/);
+    }
+    
+    return $alignments;
+}
+
+## Fingerprint of an input file ##
+# Size and MD5 of the first and last MB, so large BAM files do not have to be read completely
+sub input_fingerprint {
+    
+    #Catch
+    my $file = $_[0];
+    
+    my $size = -s $file;
+    if (!defined $size){
+        die "Cannot find input file ".$file."\n";
+    }
+    my $block = 1048576;
+    my ($head, $tail) = ("", "");
+    open(my $fr, "<", $file) or die "Cannot open input file ".$file.": $!\n";
+    binmode($fr);
+    read($fr, $head, $block);
+    if ($size > $block){
+        seek($fr, $size - $block, 0);
+        read($fr, $tail, $block);
+    }
+    close($fr);
+    
+    return $size."-".md5_hex($head.$tail);
+}
+
+## Get read counts per chromosome out of the SAM splitting pass ##
+sub get_chr_read_counts {
+    
+    #Catch
+    my %chr_sizes = %{$_[0]};
+    my $samFileName = $_[1];
+    
+    #Init
+    my $read_counts = {};
+    
+    my $count_file = $TMP."/mappingqc/".$samFileName."_read_counts.txt";
+    if (-e $count_file){
+        open(my $fr, "<", $count_file) or die $!;
+        while(my $line = <$fr>){
+            chomp($line);
+            my @linesplit = split(/\t/, $line);
+            $read_counts->{$linesplit[0]} = $linesplit[1];
+        }
+        close($fr);
+    } else {
+        #Splitted sam files of an older run: file size is proportional to the read count
+        foreach my $chr (keys %chr_sizes){
+            my $chr_sam_file = $TMP."/mappingqc/".$samFileName."_".$chr.".sam";
+            $read_counts->{$chr} = (-e $chr_sam_file) ? -s $chr_sam_file : 0;
+        }
+    }
+    
+    return $read_counts;
+}
+
+## Order chromosomes on estimated cost ##
+# Longest processing time first: the most expensive chromosomes are handed out first,
+# so that no large chromosome starts last and sets the wall-clock time
+sub schedule_chromosomes {
+    
+    #Catch
+    my $chrs = $_[0];
+    my $cost = $_[1];
+    
+    my @schedule = sort { ($cost->{$b} // 0) <=> ($cost->{$a} // 0) || $a cmp $b } keys %{$chrs};
+    
+    return @schedule;
+}
+
+## Init a worker pool that keeps track of the duration of each task ##
+sub init_worker_pool {
+    
+    #Catch
+    my $processes = $_[0];
+    my $durations = $_[1];
+    
+    #Init
+    my $pm = new Parallel::ForkManager($processes);
+    my %started;
+    
+    $pm->run_on_start(sub {
+        my ($pid, $task) = @_;
+        $started{$task} = Time::HiRes::time();
+    });
+    $pm->run_on_finish(sub {
+        my ($pid, $exit_code, $task) = @_;
+        $durations->{$task} = Time::HiRes::time() - $started{$task};
+    });
+    
+    return $pm;
+}
+
+## Report per-task durations of a worker pool ##
+sub report_task_durations {
+    
+    #Catch
+    my $stage = $_[0];
+    my %durations = %{$_[1]};
+    
+    my @tasks = sort { $durations{$b} <=> $durations{$a} } keys %durations;
+    return unless @tasks;
+    
+    my $total = 0;
+    foreach my $task (@tasks){
+        $total = $total + $durations{$task};
+    }
+    printf("   %s: %d task(s), longest %s (%.1fs), total %.1fs\n", $stage, scalar(@tasks), $tasks[0], $durations{$tasks[0]}, $total);
+    foreach my $task (@tasks){
+        printf("\t%-12s %8.1fs\n", $task, $durations{$task});
+    }
+    
+    return;
 }
 
 ### Create Bin Chromosomes ##
@@ -2458,13 +3645,14 @@ sub create_BIN_chromosomes {
     }
     
     # Create binary chrom files
-    ## Init multi core
-    my $pm = new Parallel::ForkManager($cores);
+    ## Init multi core, largest chromosomes first
+    my %task_durations;
+    my $pm = init_worker_pool($cores, \%task_durations);
     
-    foreach my $chr (keys %{$chrs}){
+    foreach my $chr (schedule_chromosomes($chrs, \%chr_sizes)){
         
         ## Start parallel process
-        $pm->start and next;
+        $pm->start($chr) and next;
         
         if (! -e $BIN_chrom_dir."/".$chr.".fa"){
             open (CHR,"<".$TMP."/Chromosomes/".$chr.".fa") || die "Cannot open chr fasta input\n";
@@ -2489,6 +3677,7 @@ sub create_BIN_chromosomes {
     
     # Finish all subprocesses
     $pm->wait_all_children;
+    report_task_durations("Binary chromosome files", \%task_durations);
     
 }
 
@@ -2970,12 +4159,15 @@ sub print_help_text {
     --offset                the offset determination method.
                                 Possible options:
                                 - plastid: calculate the offsets with Plastid (Dunn et al. 2016)
+                                - native: estimate the offsets out of the reads around the annotated start codons, without Plastid (not in shard mode)
                                 - standard: use the standard offsets from the paper of Ingolia et al. (2012) (default option)
                                 - from_file: use offsets from an input file
                                 - cst_3prime: use offsets with constant 3prime distance
-    --plastid_bam           the mapping bam file for Plastid offset generation (default: convert)
-    --min_length_plastid    the minimum RPF length for Plastid offset generation (default 22)
-    --max_length_plastid    the maximum RPF length for Plastid offset generation (default 34)
+    --plastid_bam           the mapping bam file for Plastid or native offset generation (default: convert)
+    --min_length_plastid    the minimum RPF length for Plastid or native offset generation (default 22)
+    --max_length_plastid    the maximum RPF length for Plastid or native offset generation (default 34)
+    --offset_target_reads   for native offsets: stop reading when each RPF length has this many reads around start codons, 0 for all reads (default: 5000)
+    --annotation_cache      shared directory in which the Plastid regions of interest are cached per annotation (species, assembly and Ensembl version), so they are only generated once (default: work_dir/mQC_annotation_cache)
     --offset_file           the offsets input file
     --cst_3prime_offset     the value for the constant 3prime offset (default: 15)
     --min_cst_3prime_offset minimum RPF length with cst 3prime offset (default: 22)
@@ -2989,8 +4181,35 @@ sub print_help_text {
                                 - grouped2D: use Seaborn to plot a grouped 2D bar chart (default)
                                 - pyplot3D: use mplot3d to plot a 3D bar chart. This tool can suffer sometimes from Escher effects, as it tries to plot a 3D plot with the 2D software of pyplot and matplotlib.
                                 - mayavi: use the mayavi package to plot a 3D bar chart. This tool only works on local systems with graphical cards.
+    --render_profile        figure size, font size and resolution of the figures, scaled together
+                                Possible options:
+                                - fast: small low-resolution figures, each rendered in about a second, for a small report (e.g. in Galaxy histories)
+                                - standard: the full-size figures (default)
+                                - print: half-size figures at 300 dpi, for publications
+    --report                the type of the output report
+                                Possible options:
+                                - static: the report shows the figures as images (default)
+                                - interactive: the report embeds the summary data as JSON and draws the charts in the browser with a small offline renderer, which allows zoom and hover. No figures are rasterised, so the report is ready faster and stays small.
+    --single_file           write a self-contained HTML report (Y/N, default: N): the figures (size-optimised: at most 2000 pixels wide and high, 256 colors) and logos are inlined in the HTML file, so the report can be served or shared as one file
     --outhtml               custom name for the output HTML file (default: work_dir/mQC_experiment_name.html)
     --outzip                custom name for output ZIP file (default: work_dir/mQC_experiment_name.zip)
+    --mode                  the run mode
+                                Possible options:
+                                - run: run the whole analysis on this host (default)
+                                - shard: only analyse the chromosomes of one shard (see --shard) and save its result in the shard directory. Every shard uses its own subfolder of the tmp folder.
+                                - merge: merge the results of all shards in the shard directory and make the output figures, HTML and ZIP
+                                - batch: run all samples of a sample sheet (see --samplesheet) at once. The annotation is loaded once and all sample x chromosome tasks share one worker pool. Every sample gets its own report (work_dir/mQC_name.html and .zip, figures in work_dir/mQC_output/name).
+                                - append: add the counts of an extra input file (e.g. a new lane) to the QC summary of a previous run with the same experiment name and tmp folder, and remake the output. The offsets of the previous run are kept.
+    --shard                 the shard to run in shard mode, as index/total number of shards (e.g. 2/4)
+    --shard_dir             shared directory for the shard results and manifests (default: work_dir/mQC_shards)
+    --samplesheet           tab-separated sample sheet for batch mode with on each line: experiment name, SAM/BAM file and optionally the bam file for plastid (default: convert)
+    --adaptive              stop processing once the phase fractions per RPF length change less than this tolerance between random read chunks (default without value: 0.005)
+    --adaptive_chunks       number of random read chunks in adaptive mode (default: 16)
+    --follow                live QC of a SAM/BAM file that is still being written by the aligner: new alignments are added and the report is remade every --follow_interval seconds
+    --follow_interval       seconds between report updates in follow mode (default: 60)
+    --follow_idle           stop following after this many seconds without new alignments (default: 600)
+    --samfile -             read the alignments (SAM or BAM) from stdin, a named pipe is read the same way. The input is read once, while splitting it per chromosome
+    --preview               quick look on a deterministic, hash-based subsample of about the given number of alignments (default without number: 2000000), with its own tmp folder and output files (work_dir/mQC_experiment_name_preview.html)
     ";
     
     print $help_string."\n";
@@ -0,0 +1,128 @@
+#####################################
+##	mQC (MappingQC): ribosome profiling mapping quality control tool
+##  Author: S. Verbruggen
+##  Supervised by: G. Menschaert
+##
+##	Copyright (C) 2017 S. Verbruggen & G. Menschaert
+##
+##	This program is free software: you can redistribute it and/or modify
+##	it under the terms of the GNU General Public License as published by
+##	the Free Software Foundation, either version 3 of the License, or
+##	(at your option) any later version.
+##
+##	This program is distributed in the hope that it will be useful,
+##	but WITHOUT ANY WARRANTY; without even the implied warranty of
+##	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##	GNU General Public License for more details.
+##
+##	You should have received a copy of the GNU General Public License
+##	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+## 	For more (contact) information visit https://github.com/Biobix/mQC
+#####################################
+
+
+__author__ = 'Steven Verbruggen'
+
+import traceback
+import getopt
+import os
+import sys
+import subprocess
+import time
+
+
+
+
+'''
+
+Benchmark of the start up time of mQC.py
+
+Each module is imported in a fresh python process, as many times as asked, and the median wall time
+is reported, next to an empty interpreter as baseline. mQC.py itself should only import light
+standard modules: the plotting modules are imported by the stages that draw figures, so e.g. the
+metrics only path starts fast. The benchmark fails if importing mQC.py loads any plotting module.
+
+ARGUMENTS
+
+    -r | --repeats                          Number of fresh python processes per module
+                                                (default 5)
+
+EXAMPLE
+
+python import_benchmark.py -r 10
+
+'''
+
+# Modules to time, mQC.py first
+MODULES = ['mQC', 'numpy', 'pandas', 'matplotlib.pyplot', 'seaborn']
+
+# Modules that importing mQC.py should not load
+HEAVY_MODULES = ['numpy', 'pandas', 'matplotlib', 'seaborn']
+
+def main():
+
+    # Catch command line with getopt
+    try:
+        myopts, args = getopt.getopt(sys.argv[1:], "r:", ["repeats="])
+    except getopt.GetoptError as err:
+        print err
+        sys.exit()
+
+    # Catch arguments
+    # o == option
+    # a == argument passed to the o
+    repeats = 5
+    for o, a in myopts:
+        if o in ('-r', '--repeats'):
+            repeats = int(a)
+
+    # Check for correct arguments
+    if repeats < 1:
+        print "ERROR: the number of repeats should be at least 1!"
+        sys.exit()
+
+    # Import out of the tool directory, like mQC.pl calls mQC.py
+    tool_dir = os.path.dirname(os.path.abspath(__file__))
+
+    baseline = time_code("pass", repeats, tool_dir)
+    print "%-20s %12s %12s" % ("Module", "Median (s)", "Import (s)")
+    print "%-20s %12.3f %12s" % ("(interpreter)", baseline, "")
+    for module in MODULES:
+        median = time_code("import " + module, repeats, tool_dir)
+        if median is None:
+            print "%-20s %12s %12s" % (module, "not found", "")
+        else:
+            print "%-20s %12.3f %12.3f" % (module, median, median - baseline)
+
+    # mQC.py should not load the plotting modules at import
+    check = "import sys, mQC; sys.exit(len([m for m in " + repr(HEAVY_MODULES) + " if m in sys.modules]))"
+    if subprocess.call([sys.executable, "-c", check], cwd=tool_dir) != 0:
+        print "ERROR: importing mQC.py loads plotting modules!"
+        sys.exit(1)
+    print "Importing mQC.py loads no plotting modules"
+
+    return
+
+
+## Median wall time of running code in a fresh python process, None if it fails ##
+def time_code(code, repeats, tool_dir):
+
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(repeats):
+            start = time.time()
+            if subprocess.call([sys.executable, "-c", code], cwd=tool_dir, stdout=devnull, stderr=devnull) != 0:
+                return None
+            times.append(time.time() - start)
+
+    return sorted(times)[len(times) // 2]
+
+
+#######Set Main##################
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception, e:
+        traceback.print_exc()
+#################################
@@ -29,18 +29,15 @@ import getopt
 from collections import defaultdict
 import os
 import sys
-import pandas as pd
-import numpy as np
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from matplotlib.gridspec import GridSpec
-from matplotlib.colors import hex2color
-from matplotlib import cm
-import seaborn as sns
-from matplotlib.ticker import ScalarFormatter
 import re
 import time
+import json
+import shutil
+import zipfile
+import base64
+import struct
+import zlib
+import multiprocessing
 
 
 
@@ -63,10 +60,10 @@ ARGUMENTS
                                                 (default mQC.html)
     -z | --outzip                           The output zip file name
                                                 (default mQC.zip)
-    -p | --plastid_option                   Origin of offsets (plastid, standard, cst_3prime or from_file)
+    -p | --plastid_option                   Origin of offsets (plastid, native, standard, cst_3prime or from_file)
                                                 (default standard)
     -i | --plastid_img                      Path to the plastid offset image
-                                                (mandatory if plastid option equals 'plastid')
+                                                (mandatory if plastid option equals 'plastid' or 'native')
     -e | --ensembl_db                       Ensembl database
                                                 (mandatory)
     -v | --ensembl_version                  The Ensembl database version
@@ -85,6 +82,22 @@ ARGUMENTS
                                                 (default Y)
     -y | --galaxytest                       Galaxy parameter (Y/N)
                                                 (default N)
+    -f | --preview_fraction                 The fraction of the alignments in the analysed subsample (preview/adaptive)
+                                                (default: all alignments)
+    -r | --refresh                          Reload the report in the browser every number of seconds (follow mode)
+                                                (default: no reload)
+    -m | --total_maps                       Total number of primary alignments of the input(s)
+                                                (default: count them out of the sam file)
+    -j | --cores                            Number of processes to draw the figures in parallel
+                                                (default: number of CPUs)
+    -q | --render_profile                   Figure size, font size and resolution of the figures (fast/standard/print)
+                                                (default: standard)
+    -k | --report                           Report type: static (images) or interactive (charts drawn in the browser
+                                                out of the embedded data) (default: static)
+    -l | --metrics_only                     Only write the QC metrics to outfolder/mQC_metrics.txt, without figures
+                                                or report (Y/N) (default: N)
+    -b | --single_file                      Self-contained html report with the size-optimised images and logos inlined
+                                                (Y/N) (default: N)
 
 EXAMPLE
 
@@ -92,13 +105,30 @@ python mQC.py -s STAR/fastq1/untreat.sam  -e ENS_hsa_86.db
 
 '''
 
+#Rendering profiles: scale of the figure and font sizes, resolution of the images and level of detail
+#Fast renders each figure in about a second and keeps the report small (e.g. for Galaxy histories)
+RENDER_PROFILES = {
+    'fast': {'scale': 0.3, 'dpi': 72, 'detail': False},
+    'standard': {'scale': 1.0, 'dpi': 100, 'detail': True},
+    'print': {'scale': 0.5, 'dpi': 300, 'detail': True}
+}
+render_profile = RENDER_PROFILES['standard']
+
+#Packaged resources (logos, codon references, report renderer) are read out of the tool directory, never downloaded
+TOOL_DIR = os.path.dirname(os.path.abspath(__file__))
+COMPANY_LOGOS = {'biobix': "BIOBIX_logo.png", 'ohmx': "ohmx_logo01_2.svg"}
+#Published company logos, only linked in the report when the logo is not packaged
+COMPANY_LOGO_URLS = {'biobix': "http://galaxy.ugent.be/static/BIOBIX_logo.png",
+                     'ohmx': "https://raw.githubusercontent.com/Biobix/proteoformer/master/LogoBanner/ohmx_logo01_2.svg"}
+resource_cache = {}
+
 def main():
 
     # Catch command line with getopt
     try:
-        myopts, args = getopt.getopt(sys.argv[1:], "w:s:n:o:h:z:p:i:e:v:u:x:t:d:g:a:y:c:", ["work_dir=", "input_samfile=", \
+        myopts, args = getopt.getopt(sys.argv[1:], "w:s:n:o:h:z:p:i:e:v:u:x:t:d:g:a:y:c:m:f:r:j:q:k:l:b:", ["work_dir=", "input_samfile=", \
                         "exp_name=","outfolder=", "outhtml=", "outzip=", "plastid_option=", "plastid_img=" ,\
-                        "ensembl_db=", "ensembl_version=", "unique=", "plotrpftool=" , "tmp_folder=", "species=", "galaxy=","galaxysam=","galaxytest=","comp_logo="])
+                        "ensembl_db=", "ensembl_version=", "unique=", "plotrpftool=" , "tmp_folder=", "species=", "galaxy=","galaxysam=","galaxytest=","comp_logo=","total_maps=","preview_fraction=","refresh=","cores=","render_profile=","report=","metrics_only=","single_file="])
     except getopt.GetoptError as err:
         print err
         sys.exit()
@@ -143,6 +173,22 @@ def main():
             galaxytest = a
         if o in ('-c', '--comp_logo'):
             comp_logo = a
+        if o in ('-m', '--total_maps'):
+            total_maps = a
+        if o in ('-f', '--preview_fraction'):
+            preview_fraction = a
+        if o in ('-r', '--refresh'):
+            refresh = a
+        if o in ('-j', '--cores'):
+            cores = a
+        if o in ('-q', '--render_profile'):
+            profile = a
+        if o in ('-k', '--report'):
+            report = a
+        if o in ('-l', '--metrics_only'):
+            metrics_only = a
+        if o in ('-b', '--single_file'):
+            single_file = a
 
     try:
         workdir
@@ -216,8 +262,45 @@ def main():
         comp_logo
     except:
         comp_logo = ''
+    try:
+        total_maps
+    except:
+        total_maps = ''
+    try:
+        preview_fraction
+    except:
+        preview_fraction = ''
+    try:
+        refresh
+    except:
+        refresh = ''
+    try:
+        cores
+    except:
+        cores = ''
+    try:
+        profile
+    except:
+        profile = ''
+    try:
+        report
+    except:
+        report = ''
+    try:
+        metrics_only
+    except:
+        metrics_only = ''
+    try:
+        single_file
+    except:
+        single_file = ''
 
     # Check for correct arguments and parse
+    if metrics_only == '':
+        metrics_only = 'N'
+    elif metrics_only != 'Y' and metrics_only != 'N':
+        print "ERROR: metrics_only should be 'Y' or 'N'!"
+        sys.exit()
     if galaxy == '':
         galaxy = 'N'
     else:
@@ -272,16 +355,16 @@ def main():
             outzip_short = outzip
     if plastid_option == '':
         plastid_option = 'standard'
-    elif plastid_option != 'standard' and plastid_option != 'plastid' and plastid_option != 'from_file' and plastid_option != 'cst_3prime':
-        print "ERROR: plastid option should be 'plastid', 'standard', 'cst_3prime' or 'from_file'!"
+    elif plastid_option != 'standard' and plastid_option != 'plastid' and plastid_option != 'native' and plastid_option != 'from_file' and plastid_option != 'cst_3prime':
+        print "ERROR: plastid option should be 'plastid', 'native', 'standard', 'cst_3prime' or 'from_file'!"
         sys.exit()
-    if plastid_option == 'plastid':
+    if plastid_option == 'plastid' or plastid_option == 'native':
         if plastid_img == '':
-            print "ERROR: do not forget to give path to plastid image if offset option equals 'plastid'!"
-    if ens_db == '':
+            print "ERROR: do not forget to give path to plastid image if offset option equals 'plastid' or 'native'!"
+    if ens_db == '' and metrics_only == 'N':
         print "ERROR: do not forget to mention the Ensembl db!"
         sys.exit()
-    if ens_version == '':
+    if ens_version == '' and metrics_only == 'N':
         print "ERROR: do not forget to mention the Ensembl version!"
         sys.exit()
     if unique == '':
@@ -292,9 +375,30 @@ def main():
             sys.exit()
     if plotrpftool == '':
         plotrpftool = "grouped2D"
-    if species == '':
+    if species == '' and metrics_only == 'N':
         print "ERROR: do not forget to mention the species!"
         sys.exit()
+    if profile == '':
+        profile = 'standard'
+    elif profile not in RENDER_PROFILES:
+        print "ERROR: render profile should be 'fast', 'standard' or 'print'!"
+        sys.exit()
+    global render_profile
+    render_profile = RENDER_PROFILES[profile]
+    if report == '':
+        report = 'static'
+    elif report != 'static' and report != 'interactive':
+        print "ERROR: report should be 'static' or 'interactive'!"
+        sys.exit()
+    if single_file == '':
+        single_file = 'N'
+    elif single_file != 'Y' and single_file != 'N':
+        print "ERROR: single_file should be 'Y' or 'N'!"
+        sys.exit()
+    if cores == '':
+        cores = multiprocessing.cpu_count()
+    else:
+        cores = int(cores)
     if (comp_logo=='') or (comp_logo!='biobbix' and comp_logo!='ohmx'):
         comp_logo = 'biobix'
 
@@ -306,113 +410,173 @@ def main():
     if not os.path.exists(outfolder):
         os.system("mkdir -p " + outfolder)
 
-    # Download biobix/ohmx and mappingqc images
-    if comp_logo == 'biobix':
-        os.system("wget --quiet \"http://galaxy.ugent.be/static/BIOBIX_logo.png\"")
-        os.system("mv BIOBIX_logo.png "+outfolder)
-    elif comp_logo == 'ohmx':
-        os.system("wget --quiet \"https://raw.githubusercontent.com/Biobix/proteoformer/master/LogoBanner/ohmx_logo01_2.svg\"")
-        os.system("mv ohmx_logo01_2.svg "+outfolder)
-    os.system("wget --no-check-certificate --quiet \"https://github.com/Biobix/mQC/raw/master/mqc_tools/logo_mqc2_whitebg.png\"")
-    os.system("mv logo_mqc2_whitebg.png " + outfolder)
-
-    #Download codon refs for human or mouse
+    #Metrics only: no figures and no report, so none of the plotting modules gets imported
+    if metrics_only == 'Y':
+        phase_distr, total_phase_distr, triplet_distr = get_plot_data(tmpfolder)
+        if total_maps != '':
+            tot_maps = int(total_maps)
+        else:
+            tot_maps = maps_out_of_sam(samfile, galaxy, galaxysam, tmpfolder)
+        write_metrics(outfolder+"/mQC_metrics.txt", tmpfolder, tot_maps, phase_distr, total_phase_distr)
+        return
+
+    #Logos out of the packaged resources, next to the report (a self-contained report inlines them)
+    if single_file == 'N':
+        write_resource("logo_mqc2_whitebg.png", outfolder)
+        if load_resource(COMPANY_LOGOS[comp_logo]) is not None:
+            write_resource(COMPANY_LOGOS[comp_logo], outfolder)
+
+    #Packaged codon refs for human or mouse, read once (the figure processes inherit the cache)
     codon_ref_file = ""
     norm_codon_ref_file = ""
     if species == 'human':
-        os.system("wget --quiet --no-check-certificate \"https://raw.githubusercontent.com/Biobix/mQC/master/mqc_tools/codon_refs/codon_reference_human.csv\"")
-        os.system("mv codon_reference_human.csv "+tmpfolder+"/mappingqc")
-        codon_ref_file = tmpfolder+"/mappingqc/codon_reference_human.csv"
-        os.system("wget --quiet --no-check-certificate \"https://raw.githubusercontent.com/Biobix/mQC/master/mqc_tools/codon_refs/norm_codon_reference_human.csv\"")
-        os.system("mv norm_codon_reference_human.csv " + tmpfolder + "/mappingqc")
-        norm_codon_ref_file = tmpfolder + "/mappingqc/norm_codon_reference_human.csv"
+        codon_ref_file = "codon_refs/codon_reference_human.csv"
+        norm_codon_ref_file = "codon_refs/norm_codon_reference_human.csv"
     if species == 'mouse':
-        os.system("wget --quiet --no-check-certificate \"https://raw.githubusercontent.com/Biobix/mQC/master/mqc_tools/codon_refs/codon_reference_mouse.csv\"")
-        os.system("mv codon_reference_mouse.csv " + tmpfolder + "/mappingqc")
-        codon_ref_file = tmpfolder + "/mappingqc/codon_reference_mouse.csv"
+        codon_ref_file = "codon_refs/codon_reference_mouse.csv"
+    for ref_file in [codon_ref_file, norm_codon_ref_file]:
+        if ref_file != '' and load_resource(ref_file) is None:
+            print "ERROR: could not find the codon reference "+ref_file+" in the tool directory!"
+            sys.exit()
 
     #Get plot data out of results DB
     phase_distr, total_phase_distr, triplet_distr = get_plot_data(tmpfolder)
 
-    #Calculate number of alignments out of SAM file
-    tot_maps = maps_out_of_sam(samfile, galaxy, galaxysam, tmpfolder)
+    #Calculate number of alignments out of SAM file (if not known yet)
+    if total_maps != '':
+        tot_maps = int(total_maps)
+    else:
+        tot_maps = maps_out_of_sam(samfile, galaxy, galaxysam, tmpfolder)
+
+    #Collect the figures, they are independent of each other
+    figures = []
 
     #Make total phase distribution plot
     outfile = outfolder+"/tot_phase.png"
-    plot_total_phase(total_phase_distr, outfile)
+    figures.append((plot_total_phase, (total_phase_distr, outfile)))
 
     #Make RPF-phase distribution plot
     outfile = outfolder+"/rpf_phase.png"
     if plotrpftool == "grouped2D":
-        plot_rpf_phase_grouped2D(phase_distr, outfile)
+        figures.append((plot_rpf_phase_grouped2D, (phase_distr, outfile)))
     elif plotrpftool == "pyplot3D":
-        plot_rpf_phase_pyplot3D(phase_distr, outfile)
+        figures.append((plot_rpf_phase_pyplot3D, (phase_distr, outfile)))
     elif plotrpftool == "mayavi":
-        plot_rpf_phase_mayavi(phase_distr, outfile)
+        figures.append((plot_rpf_phase_mayavi, (phase_distr, outfile)))
 
     #Make phase position distribution
-    phase_position_distr(tmpfolder, outfolder)
+    figures.append((phase_position_distr, (tmpfolder, outfolder)))
 
     #Make triplet identity plots
-    triplet_plots(triplet_distr, outfolder)
+    figures.append((triplet_plots, (triplet_distr, outfolder)))
+
+    #Make gene distribution plots
+    figures.append((gene_distribution_plots, (tmpfolder, outfolder)))
+
+    #Make metagenic pie charts
+    figures.append((metagenic_piecharts, (tmpfolder, outfolder)))
 
     #Make codon usage plot
     if species=='human' or species=='mouse':
-        codon_usage_plot(tmpfolder, codon_ref_file, outfolder, exp_name)
+        figures.append((codon_usage_plot, (tmpfolder, codon_ref_file, outfolder, exp_name)))
 
     #Make normalized codon plot
     if species=='human':
-        norm_codon_plot(tmpfolder, codon_ref_file, norm_codon_ref_file, outfolder, exp_name)
+        figures.append((norm_codon_plot, (tmpfolder, codon_ref_file, norm_codon_ref_file, outfolder, exp_name)))
+
+    #Draw all figures in parallel, or collect their data for the browser in an interactive report
+    chart_data = None
+    if report == 'interactive':
+        chart_data = interactive_report_data(tmpfolder, phase_distr, total_phase_distr, triplet_distr, species,\
+                                             codon_ref_file, norm_codon_ref_file, exp_name)
+    else:
+        render_figures(figures, cores)
 
     #Write to output html file
     offsets_file = tmpfolder+"/mappingqc/mappingqc_offsets.csv"
     # Copy offsets image to output folder
     offset_img = "offsets.png"
-    if plastid_option=="plastid":
-        os.system("cp " + plastid_img + " " + outfolder + "/" + offset_img)
-    #Copy metagenic pie charts to output folder
-    tmp_rankedgenes = tmpfolder+"/mappingqc/rankedgenes.png"
-    tmp_cumulative = tmpfolder+"/mappingqc/cumulative.png"
-    tmp_density = tmpfolder+"/mappingqc/density.png"
-    tmp_metagenic_plot_c = tmpfolder+"/mappingqc/annotation_coding.png"
-    tmp_metagenic_plot_nc = tmpfolder+"/mappingqc/annotation_noncoding.png"
-    os.system("cp "+tmp_cumulative+" "+outfolder)
-    os.system("cp "+tmp_rankedgenes+" "+outfolder)
-    os.system("cp "+tmp_density+" "+outfolder)
-    os.system("cp "+tmp_metagenic_plot_c+" "+outfolder)
-    os.system("cp "+tmp_metagenic_plot_nc+" "+outfolder)
-    #Write output HTML file
-    write_out_html(outhtml, outfolder, samfile, exp_name, tot_maps, plastid_option, offsets_file, offset_img,\
-                   ens_version, species, ens_db, unique, galaxytest, comp_logo)
-
-    ##Archive and collect output
-    #Make output archive
-    output_arch = "mQC_archive/"
-    #Try to fetch alternative name out of zip file name
+    if plastid_option=="plastid" or plastid_option=="native":
+        shutil.copyfile(plastid_img, outfolder + "/" + offset_img)
+    #Self-contained report: size-optimised figures to inline (only the offsets image in an interactive report)
+    images = None
+    if single_file == 'Y':
+        if report == 'interactive':
+            inline_files = [offset_img] if plastid_option=="plastid" or plastid_option=="native" else []
+        else:
+            inline_files = sorted([file_name for file_name in os.listdir(outfolder) if file_name.endswith(".png")])
+        images = inline_images(outfolder, inline_files, cores)
+
+    #Write output HTML file next to the figures, Galaxy also needs it at the given path
+    html_name = os.path.basename(outhtml)
+    if galaxy=='Y':
+        html_file = outhtml
+    else:
+        html_file = outfolder + "/" + html_name
+    write_out_html(html_file, outfolder, samfile, exp_name, tot_maps, plastid_option, offsets_file, offset_img,\
+                   ens_version, species, ens_db, unique, galaxytest, comp_logo, preview_fraction, refresh, chart_data,\
+                   images)
+    if galaxy=='Y':
+        shutil.copyfile(outhtml, outfolder + "/" + html_name)
+
+    ##Archive output
+    #Folder in the archive, alternative name out of zip file name
+    output_arch = "mQC_archive"
     m = re.search('(.+)\.zip$', outzip_short)
     if m:
         output_arch = m.group(1)
-    os.system("mkdir " + workdir + "/" + output_arch)
-    #Bring output html and output images folder to archive
-    if galaxy=='Y':
-        os.system("cp -r " + outhtml + " " + outfolder)
-    else:
-        os.system("mv " + outhtml + " " + outfolder)
-    os.system("cp -r " + outfolder + " " + output_arch)
-    #zip output archive
-    tmpZip = workdir+"/tmp.zip"
-    os.system("zip -r -q "+tmpZip+" "+output_arch)
-    os.system("rm -rf " + output_arch)
-    os.system("mv "+tmpZip+" "+outzip)
+    write_archive(outzip, output_arch, outfolder)
 
 
 ############
 ### SUBS ###
 ############
 
+## Draw independent figures in a pool of processes ##
+# Each figure gets a fresh process (with its own Agg backend), so the plot stage takes about as long as the slowest figure
+def render_figures(figures, cores):
+    get_pyplot()
+    import seaborn as sns
+
+    #Seaborn state of a sequential run, where the first plots set the style for all next ones
+    sns.set_style(style="whitegrid")
+    sns.set_palette("terrain")
+
+    start_time = time.time()
+    if cores <= 1 or len(figures) <= 1:
+        for func, args in figures:
+            render_figure(func, args)
+    else:
+        pool = multiprocessing.Pool(processes=min(cores, len(figures)), maxtasksperchild=1)
+        results = [pool.apply_async(render_figure, (func, args)) for func, args in figures]
+        pool.close()
+        #Get the results in order, an exception in a figure is raised here
+        for result in results:
+            result.get()
+        pool.join()
+    print "All figures drawn in %.1f s" % (time.time() - start_time)
+
+    return
+
+## Draw one figure ##
+def render_figure(func, args):
+    plt = get_pyplot()
+
+    start_time = time.time()
+    func(*args)
+    plt.close('all')
+    print "\t*) " + func.__name__ + " drawn in %.1f s" % (time.time() - start_time)
+
+    return
+
 ## Write output html file
 def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid, offsets_file, offsets_img,\
-                   ensembl_version, species, ens_db, unique, galaxytest, comp_logo):
+                   ensembl_version, species, ens_db, unique, galaxytest, comp_logo, preview_fraction='', refresh='', chart_data=None,\
+                   images=None):
+    import pandas as pd
+
+    #Interactive report: the charts are drawn in the browser out of the embedded data
+    interactive = chart_data is not None
 
     #Load in offsets
     offsets = pd.read_csv(offsets_file, sep=',', header=None, names=["RPF", "offset"])
@@ -429,10 +593,11 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
     #Prepare additional pieces of HTML code for eventual plastid analysis
     plastid_nav_html=""
     plastid_html=""
-    if(plastid=="plastid"):
-        plastid_nav_html = "<li><a href=\"#section2\">Plastid offset analysis</a></li>"
+    if(plastid=="plastid" or plastid=="native"):
+        offset_title = "Plastid offset analysis" if plastid=="plastid" else "Start codon offset analysis"
+        plastid_nav_html = "<li><a href=\"#section2\">"+offset_title+"</a></li>"
         plastid_html = """<span class="anchor" id="section2"></span>
-        <h2 id="plastid">Plastid offset analysis</h2>
+        <h2 id="plastid">"""+offset_title+"""</h2>
         <p>
         <table id="offset_table">
             <tr>
@@ -442,7 +607,7 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
             """+html_table+"""
         </table>
         <div class="img" id="plastid_img">
-            <img src=\""""+offsets_img+"""\" alt="Plastid analysis" id="plastid_plot">
+            <img src=\""""+image_src(offsets_img, images)+"""\" alt="Plastid analysis" id="plastid_plot">
         </div>
         </p>
         """
@@ -483,6 +648,26 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
                 <td>"""+time.strftime("%H:%M:%S")+"""</td>
             </tr>"""
 
+    #Follow mode: the browser reloads the report until the last update
+    refresh_meta = ""
+    if refresh != '':
+        refresh_meta = """<meta http-equiv="refresh" content=""""+refresh+""""></meta>"""
+
+    #Preview or adaptive early stopping on a subsample of the alignments
+    previewinfo = ""
+    if preview_fraction != '':
+        previewinfo = """<tr>
+                <td>Analysed subsample</td>
+                <td>"""+"{0:.2f}".format(100*float(preview_fraction))+"""% of the alignments (deterministic, hash-based)</td>
+            </tr>"""
+
+    #Interactive report: embedded chart data and the offline renderer
+    report_script = ""
+    if interactive:
+        renderer = load_resource("mqc_report.js")
+        json_data = json.dumps(chart_data, separators=(',', ':')).replace("</", "<\\/")
+        report_script = "<script>var MQC_DATA = "+json_data+";</script>\n    <script>\n"+renderer+"</script>"
+
     #Prepare additional pieces for codon usage plot
     codon_usage_nav = ""
     codon_usage_part = ""
@@ -493,7 +678,7 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
         <h2 id="codon_usage">Total codon count plot</h2>
         <p>
             <div class="img">
-            <img src=\"codon_usage.png" alt="codon_usage_plot" id="codon_usage_img">
+            """+figure_html("codon_usage.png", "codon_usage_plot", "codon_usage_img", "codon_usage", interactive, images)+"""
             </div>
         </p>
         """
@@ -508,12 +693,13 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
         <h2 id="norm_codon_usage">Normalized total codon count plot</h2>
         <p>
             <div class="img">
-            <img src=\"norm_codon_plot.png" alt="norm_codon_usage_plot" id="norm_codon_usage_img">
+            """+figure_html("norm_codon_plot.png", "norm_codon_usage_plot", "norm_codon_usage_img", "norm_codon_usage", interactive, images)+"""
             </div>
         </p>
         """
-        #Logo
+    #Logo, the published company logo is linked if it is not packaged
     foot_text = "BioBix lab Ghent (Belgium)"
+    logo_main_string = ""
     if comp_logo=="biobix":
         logo_header_string = """
         #biobix_logo{
@@ -523,7 +709,7 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
             top: 30px;
         }
 """
-        logo_main_string = """<img src=\"BIOBIX_logo.png\" alt="biobix_logo" id="biobix_logo">"""
+        logo_main_string = """<img src=\""""+company_logo_src(comp_logo, images)+"""\" alt="biobix_logo" id="biobix_logo">"""
     elif comp_logo=="ohmx":
         foot_text = "OHMX.bio, Ghent (Belgium)"
         logo_header_string = """
@@ -534,6 +720,7 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
             top: 2px;
         }
 """
+        logo_main_string = """<img src=\""""+company_logo_src(comp_logo, images)+"""\" alt="ohmx_logo" id="ohmx_logo">"""
 
     #Structure of html file
     html_string = """<!DOCTYPE html>
@@ -542,6 +729,7 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
    <title>Mapping QC Report """+run_name+"""</title>
    <meta charset="utf-8"></meta>
    <meta name="description" content="Overview HTML of all mappingQC results"></meta>
+   """+refresh_meta+"""
    <link href="https://fonts.googleapis.com/css?family=Indie+Flower" rel="stylesheet">
    <style media="screen">
         *{
@@ -683,6 +871,10 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
             width: 20cm;
         }
 
+        .mqc_chart {
+            max-width: 98%;
+        }
+
         #offset_table {
             float: left;
             display: block;
@@ -852,6 +1044,10 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
            width: 20cm;
        }
 
+       .mqc_chart {
+           max-width: 98%;
+       }
+
        #offset_table {
            float: left;
            display: block;
@@ -890,7 +1086,7 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
 
 <body>
     <div id="header">
-        <img src="logo_mqc2_whitebg.png" alt="mqc_logo" id="mqc_logo">
+        <img src=\""""+image_src("logo_mqc2_whitebg.png", images, True)+"""\" alt="mqc_logo" id="mqc_logo">
         <h1><span id="mappingqc">mappingQC</span><span id="run_name">"""+run_name+"""</span></h1>
         """+logo_main_string+"""
     </div>
@@ -941,6 +1137,7 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
                 <td>Total mapped genomic sequences</td>
                 <td>"""+'{0:,}'.format(totmaps).replace(',',' ')+"""</td>
             </tr>
+            """+previewinfo+"""
             """+timeinfo+"""
         </table>
         </p>
@@ -951,17 +1148,17 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
         <h2 id="gene_distributions">Gene distributions</h2>
         <p>
             <div class="img">
-            <img src=\"rankedgenes.png\" alt="Ranked genes" id="ranked_genes">
+            """+figure_html("rankedgenes.png", "Ranked genes", "ranked_genes", "ranked_genes", interactive, images)+"""
             </div>
         </p>
         <p>
             <div class="img">
-            <img src=\"cumulative.png\" alt="Cumulative genes" id="cumulative">
+            """+figure_html("cumulative.png", "Cumulative genes", "cumulative", "cumulative", interactive, images)+"""
             </div>
         </p>
         <p>
             <div class="img">
-            <img src=\"density.png\" alt="Genes density" id="genes_density">
+            """+figure_html("density.png", "Genes density", "genes_density", "genes_density", interactive, images)+"""
             </div>
         </p>
 
@@ -969,12 +1166,12 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
         <h2 id="metagenic_classification">Metagenic classification</h2>
         <p>
             <div class="img">
-            <img src=\"annotation_coding.png\" alt="Metagenic classification coding" id="annotation_coding">
+            """+figure_html("annotation_coding.png", "Metagenic classification coding", "annotation_coding", "annotation_coding", interactive, images)+"""
             </div>
         </p>
         <p>
             <div class="img">
-            <img src=\"annotation_noncoding.png\" alt="Noncoding classification" id="annotation_noncoding">
+            """+figure_html("annotation_noncoding.png", "Noncoding classification", "annotation_noncoding", "annotation_noncoding", interactive, images)+"""
             </div>
         </p>
 
@@ -982,7 +1179,7 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
         <h2 id="tot_phase">Total phase distribution</h2>
         <p>
             <div class="img">
-            <img src=\"tot_phase.png" alt="total phase plot" id="tot_phase_img">
+            """+figure_html("tot_phase.png", "total phase plot", "tot_phase_img", "tot_phase", interactive, images)+"""
             </div>
         </p>
 
@@ -990,7 +1187,7 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
         <h2 id="phase_rpf_distr">RPF phase distribution</h2>
         <p>
             <div class="img">
-            <img src=\"rpf_phase.png" alt="rpf phase plot" id="rpf_phase_img">
+            """+figure_html("rpf_phase.png", "rpf phase plot", "rpf_phase_img", "rpf_phase", interactive, images)+"""
             </div>
         </p>
 
@@ -998,7 +1195,7 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
         <h2 id="phase_relpos_distr">Phase - relative position distribution</h2>
         <p>
             <div class="img">
-            <img src=\"phase_relpos_distr.png" alt="phase relpos distr" id="phase_relpos_distr_img">
+            """+figure_html("phase_relpos_distr.png", "phase relpos distr", "phase_relpos_distr_img", "phase_relpos", interactive, images)+"""
             </div>
         </p>
 
@@ -1006,7 +1203,7 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
         <h2 id="triplet_identity">Triplet identity plots</h2>
         <p>
             <div class="img">
-            <img src=\"triplet_id.png" alt="triplet identity plots" id="triplet_id_img">
+            """+figure_html("triplet_id.png", "triplet identity plots", "triplet_id_img", "triplet_id", interactive, images)+"""
             </div>
         </p>
 
@@ -1021,16 +1218,144 @@ def write_out_html(outfile, output_folder, samfile, run_name, totmaps, plastid,
         <p id="footer_content">Generated with mQC - """+foot_text+"""- Steven Verbruggen</p>
     </div>
 
+    """+report_script+"""
+
 </body>
 </html>"""
 
-    #Generate html file
+    #Generate html file, in one write (also the self-contained report)
     html_file = open(outfile, 'w')
     html_file.write(html_string)
     html_file.close()
 
     return
 
+## Write the output folder to the zip archive, under archive_folder/<output folder name>/ ##
+# The PNG figures are compressed already and are stored, the html and other files are deflated
+def write_archive(outzip, archive_folder, outfolder):
+
+    folder = os.path.join(archive_folder, os.path.basename(os.path.normpath(outfolder)))
+    tmp_zip = outzip + ".part"
+    archive = zipfile.ZipFile(tmp_zip, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+    for root, dirs, files in os.walk(outfolder):
+        dirs.sort()
+        for file_name in sorted(files):
+            path = os.path.join(root, file_name)
+            if file_name.lower().endswith(".png"):
+                compression = zipfile.ZIP_STORED
+            else:
+                compression = zipfile.ZIP_DEFLATED
+            archive.write(path, os.path.join(folder, os.path.relpath(path, outfolder)), compression)
+    archive.close()
+    #Replace the archive of an earlier report at once
+    os.rename(tmp_zip, outzip)
+
+    return
+
+## Figure of the output html: an image, or a chart drawn in the browser in an interactive report
+def figure_html(img_src, alt, img_id, chart, interactive, images=None):
+
+    if interactive:
+        return "<div class=\"mqc_chart\" data-chart=\""+chart+"\" id=\""+img_id+"\"></div>"
+
+    if images is not None:
+        img_src = images.get(img_src, img_src)
+
+    return "<img src=\""+img_src+"\" alt=\""+alt+"\" id=\""+img_id+"\">"
+
+## Source of an image in the output html: its file name, or a base64 data URI in a self-contained report
+# Logos come out of the packaged resources
+def image_src(file_name, images, logo=False):
+
+    if images is None:
+        return file_name
+    if not logo:
+        return images.get(file_name, file_name)
+
+    data = load_resource(file_name)
+    if data is None:
+        return file_name
+    mime_type = "image/svg+xml" if file_name.endswith(".svg") else "image/png"
+
+    return "data:"+mime_type+";base64,"+base64.b64encode(data)
+
+## Source of the company logo: the packaged logo, or the published one if it is not packaged ##
+def company_logo_src(comp_logo, images):
+
+    if load_resource(COMPANY_LOGOS[comp_logo]) is None:
+        return COMPANY_LOGO_URLS[comp_logo]
+
+    return image_src(COMPANY_LOGOS[comp_logo], images, True)
+
+## Size-optimised figures of the output folder as base64 data URIs: {file name: data URI} ##
+# The figures are optimised in parallel, so this takes about as long as the largest figure
+def inline_images(outfolder, file_names, cores):
+
+    start_time = time.time()
+    input_files = [outfolder+"/"+file_name for file_name in file_names]
+    if cores <= 1 or len(input_files) <= 1:
+        optimised = map(optimise_png, input_files)
+    else:
+        pool = multiprocessing.Pool(processes=min(cores, len(input_files)), maxtasksperchild=1)
+        optimised = pool.map(optimise_png, input_files)
+        pool.close()
+        pool.join()
+    images = {}
+    for file_name, data in zip(file_names, optimised):
+        images[file_name] = "data:image/png;base64,"+base64.b64encode(data)
+    print "Figures optimised for the html report in %.1f s" % (time.time() - start_time)
+
+    return images
+
+## Size-optimised PNG of a figure for a self-contained report
+# The figure is scaled down to at most max_size pixels wide and high (averaging blocks of pixels), reduced to its 256
+# most frequent colors (the other, antialiasing, colors get the nearest of these) and written as an 8-bit palette PNG
+def optimise_png(input_file, max_size=2000):
+    import numpy as np
+    plt = get_pyplot()
+
+    #RGB values, the figures are opaque
+    image = plt.imread(input_file)
+    if image.ndim == 2:
+        image = np.dstack([image, image, image])
+    image = image[:, :, :3]
+
+    #Scale down by an integer factor
+    factor = -(-max(image.shape[:2]) // max_size)
+    if factor > 1:
+        height, width = image.shape[0] // factor, image.shape[1] // factor
+        image = sum([image[i:height*factor:factor, j:width*factor:factor] for i in range(factor) for j in range(factor)])/float(factor**2)
+    if image.dtype != np.uint8:
+        image = (image*255+0.5).astype(np.uint8)
+    rgb = image.astype(np.uint32)
+    height, width = rgb.shape[:2]
+
+    #Palette of the most frequent colors, every color is mapped on the nearest palette color
+    colors, index, counts = np.unique((rgb[:, :, 0] << 16 | rgb[:, :, 1] << 8 | rgb[:, :, 2]).ravel(),\
+                                      return_inverse=True, return_counts=True)
+    colors_rgb = np.column_stack([colors >> 16, (colors >> 8) & 255, colors & 255]).astype(np.int64)
+    palette = colors_rgb[np.argsort(-counts, kind='mergesort')[:256]]
+    nearest = np.empty(len(colors), dtype=np.int64)
+    for start in range(0, len(colors), 4096):
+        distances = ((colors_rgb[start:start+4096, None, :]-palette[None, :, :])**2).sum(axis=2)
+        nearest[start:start+4096] = np.argmin(distances, axis=1)
+    pixels = nearest[index].astype(np.uint8).reshape(height, width)
+
+    #PNG without filters (best for palette images): signature, header, palette, data and end
+    scanlines = np.hstack([np.zeros((height, 1), dtype=np.uint8), pixels]).tostring()
+    data = "\x89PNG\r\n\x1a\n"
+    data += png_chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0))
+    data += png_chunk("PLTE", palette.astype(np.uint8).tostring())
+    data += png_chunk("IDAT", zlib.compress(scanlines, 9))
+    data += png_chunk("IEND", "")
+
+    return data
+
+## PNG chunk: length, type, data and CRC
+def png_chunk(chunk_type, chunk_data):
+
+    return struct.pack(">I", len(chunk_data))+chunk_type+chunk_data+struct.pack(">I", zlib.crc32(chunk_type+chunk_data) & 0xffffffff)
+
 ## Normalized codon plot
 def norm_codon_plot(tmpfolder, codon_ref_file, norm_codon_ref_file, outfolder, exp_name):
 
@@ -1081,6 +1406,7 @@ def codon_usage_plot(tmpfolder, codon_ref_file, outfolder, exp_name):
 
 #Plot norm codon percentages
 def plot_norm_codon_perc(output_file, sorted_norm_triplets, norm_reference, norm_codon_perc, name, title):
+    plt = get_pyplot()
 
     #Parse data
     sorted_ref_values = []
@@ -1099,30 +1425,31 @@ def plot_norm_codon_perc(output_file, sorted_norm_triplets, norm_reference, norm
         labels.append(i+" ("+codontable[i]+")")
 
     #Plot
-    fig = plt.figure(figsize=(36,32))
+    fig = plt.figure(figsize=scaled_size(36, 32))
     ax = plt.axes()
-    points = ax.plot(xpos, sorted_ref_values, marker='o', linewidth=15, color='#3BBE71', markersize=20, alpha=0.7, label='Normalized reference')
+    points = ax.plot(xpos, sorted_ref_values, marker='o', linewidth=scaled(15), color='#3BBE71', markersize=scaled(20), alpha=0.7, label='Normalized reference')
     bars = ax.bar(xpos, sorted_codon_values, color='#228EDA', label=name)
     plt.xlim([0, len(sorted_ref_values)+1])
     [y1, y2] = ax.get_ylim()
     plt.ylim([0, y2])
-    ax.set_ylabel('Percentage normalized codon count [in %]', fontsize=40)
-    ax.set_xlabel('Triplet (amino acid)', fontsize=40)
-    plt.yticks(fontsize=30)
+    ax.set_ylabel('Percentage normalized codon count [in %]', fontsize=scaled(40))
+    ax.set_xlabel('Triplet (amino acid)', fontsize=scaled(40))
+    plt.yticks(fontsize=scaled(30))
     ax.set_xticks(xpos)
-    ax.set_xticklabels(labels, rotation='vertical', fontsize=30)
-    ax.set_title(title, fontsize=80)
-    plt.legend(fontsize=40)
+    ax.set_xticklabels(labels, rotation='vertical', fontsize=scaled(30))
+    ax.set_title(title, fontsize=scaled(80))
+    plt.legend(fontsize=scaled(40))
 
     plt.tight_layout()
 
-    fig.savefig(output_file)
+    fig.savefig(output_file, dpi=render_profile['dpi'])
 
 
     return
 
 #Plot codon percentages
 def plot_codon_perc(output_file, sorted_triplets, reference, codon_percs, name):
+    plt = get_pyplot()
 
     #Parse data
     sorted_ref_values = []
@@ -1141,24 +1468,24 @@ def plot_codon_perc(output_file, sorted_triplets, reference, codon_percs, name):
         labels.append(i+" ("+codontable[i]+")")
 
     #Plot
-    fig = plt.figure(figsize=(36,32))
+    fig = plt.figure(figsize=scaled_size(36, 32))
     ax = plt.axes()
-    points = ax.plot(xpos, sorted_ref_values, marker='o', linewidth=15, color='#3BBE71', markersize=20, alpha=0.7, label='Reference')
+    points = ax.plot(xpos, sorted_ref_values, marker='o', linewidth=scaled(15), color='#3BBE71', markersize=scaled(20), alpha=0.7, label='Reference')
     bars = ax.bar(xpos, sorted_codon_values, color='#228EDA', label=name)
     plt.xlim([0,len(sorted_ref_values)+1])
     [y1, y2] = ax.get_ylim()
     plt.ylim([0, y2])
-    ax.set_ylabel('Percentage codon count [in %]', fontsize=40)
-    ax.set_xlabel('Triplet (amino acid)', fontsize=40)
-    plt.yticks(fontsize=30)
+    ax.set_ylabel('Percentage codon count [in %]', fontsize=scaled(40))
+    ax.set_xlabel('Triplet (amino acid)', fontsize=scaled(40))
+    plt.yticks(fontsize=scaled(30))
     ax.set_xticks(xpos)
-    ax.set_xticklabels(labels, rotation='vertical', fontsize=30)
-    ax.set_title('Total ribosome count per codon identity', fontsize=80)
-    plt.legend(fontsize=40)
+    ax.set_xticklabels(labels, rotation='vertical', fontsize=scaled(30))
+    ax.set_title('Total ribosome count per codon identity', fontsize=scaled(80))
+    plt.legend(fontsize=scaled(40))
 
     plt.tight_layout()
 
-    fig.savefig(output_file)
+    fig.savefig(output_file, dpi=render_profile['dpi'])
 
     return
 
@@ -1217,75 +1544,115 @@ def read_codon_count(input_codon_count):
     return codon_perc
 
 #Read reference codon usage
-def read_ref(input_ref):
+def read_ref(ref_file):
 
     #Init
     ref = defaultdict()
 
-    with open(input_ref, 'r') as FR:
-        lines = FR.readlines()
-        for line in lines:
-            line.rstrip("\n")
-            (triplet, perc) = re.split(',', line)
-            ref[triplet] = float(perc)*100
+    for line in load_resource(ref_file).splitlines():
+        (triplet, perc) = re.split(',', line)
+        ref[triplet] = float(perc)*100
 
     return ref
 
 ## Plot triplet identity data
+# All 64 pie charts are drawn straight out of one 64x3 array of phase counts
 def triplet_plots(data, outputfolder):
+    import numpy as np
+    plt = get_pyplot()
+    import seaborn as sns
+    from matplotlib.gridspec import GridSpec
+    from matplotlib.colors import hex2color
+
     outfile = outputfolder+"/triplet_id.png"
 
+    #Triplets sorted on amino acid, with one codon table lookup
+    codontable = get_codontable()
+    triplets = sorted(codontable.keys(), key=lambda e: (codontable[e], e))
+
+    #Phase counts, labels, titles and title colors
+    counts = np.array([[data[triplet][phase] for phase in [0, 1, 2]] for triplet in triplets], dtype=np.int64)
+    labels = [map(format_thousands, row) for row in counts]
+    titles = [triplet+": "+codontable[triplet] for triplet in triplets]
+    title_colors = [hex2color('#00ff00') if triplet=="ATG" else hex2color("#ff0000") if codontable[triplet]=="STOP" else "k" for triplet in triplets]
+
     sns.set_palette('terrain') #Palette
-    fig = plt.figure(figsize=(36, 32))
-    grid = GridSpec(8, 9) #Construct grid for subplots
-    grid_i = -1 #Grid coordinates
-    grid_j = 0
-    for triplet in sorted(data.keys(), key=lambda e: (get_AA(e), e)):
-        grid_i += 1
-        if grid_i == 8:
-            grid_i = 0
-            grid_j += 1
-        ax = plt.subplot(grid[grid_j,grid_i]) #Define subplot axes element in grid
-        df = pd.DataFrame.from_dict(data[triplet], orient="index") #By index for right orientation
-        df = df.sort_index(axis=0)
-        labels_list = df[0].values.tolist()
-        labels_list = map(format_thousands, labels_list)
-        df.plot(kind="pie", subplots="True", autopct='%.1f%%', ax=ax, legend=None, labels=labels_list, pctdistance=0.7,
-                fontsize=16, textprops={'fontsize':16})
-        #Individual legends off, subplots="True" for evading selecting y column error, autopercentage
-        ax.set(ylabel='') #Do not plot y column label
-        if triplet=="ATG":
-            title_color=hex2color('#00ff00')
-        elif triplet=="TGA" or triplet=="TAG" or triplet=="TAA":
-            title_color=hex2color("#ff0000")
-        else:
-            title_color="k"
-        ax.set_title(triplet+": "+get_AA(triplet), {'fontsize': 38}, color=title_color) #Put triplet in title
-    handles, labels = ax.get_legend_handles_labels() #Get legend information of last ax object
-    leg = fig.legend(handles, ["Phase 0", "Phase 1", "Phase 2"], bbox_to_anchor=(1, 0.53), fontsize=38)#Define legend
+    colors = sns.color_palette()[:3] #Phase colors
+    if not render_profile['detail']:
+        triplet_pies_single_axes(counts, titles, title_colors, colors, outfile)
+        return
+    fig = plt.figure(figsize=scaled_size(36, 32))
+    grid = GridSpec(8, 9) #Construct grid for subplots, last column for the legend
+    for k in range(len(triplets)):
+        ax = fig.add_subplot(grid[k // 8, k % 8]) #Define subplot axes element in grid
+        wedges = ax.pie(counts[k], labels=labels[k], colors=colors, autopct='%.1f%%', pctdistance=0.7,
+                        textprops={'fontsize': scaled(16)})[0]
+        ax.set_aspect('equal')
+        ax.set_title(titles[k], {'fontsize': scaled(38)}, color=title_colors[k]) #Put triplet in title
+    leg = fig.legend(wedges, ["Phase 0", "Phase 1", "Phase 2"], bbox_to_anchor=(1, 0.53), fontsize=scaled(38))#Define legend
     leg.get_frame().set_edgecolor('b')
     plt.tight_layout(rect=(0.013,0,1,1)) #Prevent overlapping elements
-    fig.savefig(outfile)
+    fig.savefig(outfile, dpi=render_profile['dpi'])
+    plt.close(fig)
+
+    return
+
+## Draw the 64 triplet pie charts without labels on one axes, as one collection of coarse wedge polygons
+def triplet_pies_single_axes(counts, titles, title_colors, colors, outfile):
+    import numpy as np
+    plt = get_pyplot()
+    from matplotlib.collections import PolyCollection
+    from matplotlib.patches import Patch
+
+    #Wedge boundaries as fractions of the circle, counter-clockwise from the x axis like ax.pie
+    totals = counts.sum(axis=1).astype(float)
+    totals[totals == 0] = 1
+    bounds = np.hstack([np.zeros((len(counts), 1)), np.cumsum(counts, axis=1) / totals[:, None]])
+
+    fig = plt.figure(figsize=scaled_size(36, 32))
+    ax = fig.add_axes([0.01, 0.01, 0.86, 0.98])
+
+    #Pies on an 8x8 grid, 2.5 units apart
+    polygons = []
+    facecolors = []
+    for k in range(len(counts)):
+        x = (k % 8) * 2.5
+        y = -(k // 8) * 2.5
+        for phase in [0, 1, 2]:
+            if bounds[k, phase+1] <= bounds[k, phase]:
+                continue
+            n_points = max(2, int((bounds[k, phase+1] - bounds[k, phase]) * 36) + 1)
+            angles = 2 * np.pi * np.linspace(bounds[k, phase], bounds[k, phase+1], n_points)
+            polygons.append(np.vstack([[x, y], np.column_stack([x + np.cos(angles), y + np.sin(angles)])]))
+            facecolors.append(colors[phase])
+        ax.text(x, y + 1.15, titles[k], ha='center', va='bottom', fontsize=scaled(38), color=title_colors[k]) #Put triplet in title
+    ax.add_collection(PolyCollection(polygons, facecolors=facecolors, edgecolors='none'))
+    ax.set_xlim(-1.3, 7 * 2.5 + 1.3)
+    ax.set_ylim(-7 * 2.5 - 1.2, 1.9)
+    ax.set_aspect('equal')
+    ax.axis('off')
+    handles = [Patch(facecolor=colors[phase]) for phase in [0, 1, 2]]
+    leg = fig.legend(handles, ["Phase 0", "Phase 1", "Phase 2"], bbox_to_anchor=(1, 0.53), fontsize=scaled(38))#Define legend
+    leg.get_frame().set_edgecolor('b')
+    fig.savefig(outfile, dpi=render_profile['dpi'])
+    plt.close(fig)
 
     return
 
 ## Make plot of relative phase against RPF length
 def phase_position_distr(tmpfolder, outfolder):
+    import numpy as np
+    plt = get_pyplot()
 
-    #Input data, read in to pandas data frame
-    inputdata_adress = tmpfolder+"/mappingqc/pos_table_all.csv"
-    inputdata = pd.read_csv(inputdata_adress, sep=',', header=None, names=["phase", "rel_position"])
-
-    #Split data based on phase
-    data0 = inputdata[inputdata["phase"]==0]["rel_position"]
-    data1 = inputdata[inputdata["phase"] == 1]["rel_position"]
-    data2 = inputdata[inputdata["phase"] == 2]["rel_position"]
-    freq0, bin_edges0 = np.histogram(data0, bins=20, range=(0,1))
-    freq1, bin_edges1 = np.histogram(data1, bins=20, range=(0,1))
-    freq2, bin_edges2 = np.histogram(data2, bins=20, range=(0,1))
+    #Input data
+    freq0, freq1, freq2 = read_phase_position(tmpfolder)
+    n_bins = len(freq0)
+    bin_edges0 = np.linspace(0, 1, n_bins+1)
+    bin_edges1 = bin_edges0
+    bin_edges2 = bin_edges0
 
     #Plot data
-    fig, ax = plt.subplots(1, 1, figsize=(36,32))
+    fig, ax = plt.subplots(1, 1, figsize=scaled_size(36, 32))
     bar1 = ax.bar(bin_edges0[:-1]+0.00625, freq0, 0.0125, color='#228EDA', edgecolor='none')
     bar2 = ax.bar(bin_edges1[:-1]+0.0125+0.00625, freq1, 0.0125, color='#3BBE71', edgecolor='none')
     bar3 = ax.bar(bin_edges2[:-1]+0.025+0.00625, freq2, 0.0125, color='#B7E397', edgecolor='none')
@@ -1293,17 +1660,17 @@ def phase_position_distr(tmpfolder, outfolder):
         ax.set_facecolor("#f2f2f2")
     except:
         ax.set_axis_bgcolor("#f2f2f2")
-    lgd = ax.legend((bar1[0], bar2[0], bar3[0]),('Phase 0','Phase 1', 'Phase 2'), loc='center left', bbox_to_anchor=(1, 0.5), fontsize=38)
+    lgd = ax.legend((bar1[0], bar2[0], bar3[0]),('Phase 0','Phase 1', 'Phase 2'), loc='center left', bbox_to_anchor=(1, 0.5), fontsize=scaled(38))
 
     #Axis info
-    plt.ylabel("Counts", fontsize=38)
-    plt.xlabel("Relative position in coding sequence", fontsize=38)
+    plt.ylabel("Counts", fontsize=scaled(38))
+    plt.xlabel("Relative position in coding sequence", fontsize=scaled(38))
     plt.xlim([0, 1])
-    ax.tick_params(labelsize=34)
+    ax.tick_params(labelsize=scaled(34))
 
     #Save output
     plt.tight_layout()
-    fig.savefig(outfolder+"/phase_relpos_distr.png", bbox_extra_artists=(lgd,), bbox_inches='tight') #Make room for legend
+    fig.savefig(outfolder+"/phase_relpos_distr.png", bbox_extra_artists=(lgd,), bbox_inches='tight', dpi=render_profile['dpi']) #Make room for legend
 
     #Close matplotlib environment
     plt.close()
@@ -1311,8 +1678,31 @@ def phase_position_distr(tmpfolder, outfolder):
     return
 
 
+## Read the phase - relative position histogram: counts per bin of phase 0, 1 and 2
+def read_phase_position(tmpfolder):
+    import numpy as np
+    import pandas as pd
+
+    #Input data: phase-position histogram (phase, bin, count), read in to pandas data frame
+    inputdata_adress = tmpfolder+"/mappingqc/pos_table_all.csv"
+    inputdata = pd.read_csv(inputdata_adress, sep=',', header=None, names=["phase", "bin", "count"])
+    n_bins = inputdata["bin"].max()+1
+
+    #Split data based on phase
+    freq0 = np.zeros(n_bins)
+    freq1 = np.zeros(n_bins)
+    freq2 = np.zeros(n_bins)
+    for phase, freq in [(0, freq0), (1, freq1), (2, freq2)]:
+        data = inputdata[inputdata["phase"] == phase]
+        np.add.at(freq, data["bin"].values, data["count"].values)
+
+    return freq0, freq1, freq2
+
 ## Make plot of RPF against phase as a grouped 2D bar chart
 def plot_rpf_phase_grouped2D(phase_distr, outfile):
+    import pandas as pd
+    plt = get_pyplot()
+    import seaborn as sns
 
     #Parse data into Pandas data frame
     df = pd.DataFrame.from_dict(phase_distr, orient="index")
@@ -1346,7 +1736,7 @@ def plot_rpf_phase_grouped2D(phase_distr, outfile):
     plt.tight_layout()
 
     #Save figure
-    fig.savefig(outfile)
+    fig.savefig(outfile, dpi=render_profile['dpi'])
 
     return
 
@@ -1354,6 +1744,8 @@ def plot_rpf_phase_grouped2D(phase_distr, outfile):
 ## Make plot of RPF against phase with mayavi
 def plot_rpf_phase_mayavi(phase_distr, outfile):
     from mayavi import mlab
+    import numpy as np
+    from matplotlib import cm
 
     # Parameters
     lensoffset = 0.5
@@ -1482,10 +1874,13 @@ def plot_rpf_phase_mayavi(phase_distr, outfile):
 
 ## Make plot of RPF against phase with MPL toolkits (pyplot)
 def plot_rpf_phase_pyplot3D(phase_distr, outfile):
+    import numpy as np
+    plt = get_pyplot()
+    from matplotlib import cm
     from mpl_toolkits.mplot3d import Axes3D
 
     #Initialize fig and axes
-    fig = plt.figure(figsize=(20,13))
+    fig = plt.figure(figsize=scaled_size(20, 13))
     ax = fig.gca(projection='3d')
     axis_rate = 3 / float(len(phase_distr.keys()))
     ax.pbaspect = [axis_rate, 1, 0.5]  # Aspect ratio based on proportions of x and y axis
@@ -1565,19 +1960,19 @@ def plot_rpf_phase_pyplot3D(phase_distr, outfile):
     ticksxpos = np.arange(xmin, xmax+1, 1)
     ticksxlabs =range(xmin,xmax+1,1)
     plt.xticks(ticksxpos,ticksxlabs)
-    ax.tick_params(axis='x', which='major', labelsize=20, pad=15)
+    ax.tick_params(axis='x', which='major', labelsize=scaled(20), pad=scaled(15))
 
     ticksypos = np.arange(ymin, ymax+1,1)
     ticksylabs=range(ymin,ymax+1,1)
     plt.yticks(ticksypos,ticksylabs)
-    ax.tick_params(axis='y', which='major', labelsize=20, pad=15)
+    ax.tick_params(axis='y', which='major', labelsize=scaled(20), pad=scaled(15))
 
-    ax.tick_params(axis='z', which='major', labelsize=20, pad=40)
+    ax.tick_params(axis='z', which='major', labelsize=scaled(20), pad=scaled(40))
 
     #Axis labels
-    plt.xlabel('Phase', labelpad=60, fontsize=30)
-    plt.ylabel('RPF length', labelpad=100, fontsize=30)
-    ax.set_zlabel('counts', labelpad=90, fontsize=30)
+    plt.xlabel('Phase', labelpad=scaled(60), fontsize=scaled(30))
+    plt.ylabel('RPF length', labelpad=scaled(100), fontsize=scaled(30))
+    ax.set_zlabel('counts', labelpad=scaled(90), fontsize=scaled(30))
 
     #Camera point angle
     ax.view_init(azim=-30)
@@ -1586,7 +1981,7 @@ def plot_rpf_phase_pyplot3D(phase_distr, outfile):
     ax.set_position([-0.35, -0.15, 1.5, 1.5])
 
     #Save as output
-    fig.savefig(outfile)
+    fig.savefig(outfile, dpi=render_profile['dpi'])
 
     plt.close()
 
@@ -1594,30 +1989,32 @@ def plot_rpf_phase_pyplot3D(phase_distr, outfile):
 
 ## Make plot of total phase distribution
 def plot_total_phase(distr, outfile):
+    plt = get_pyplot()
+    import seaborn as sns
 
 
     #Define figure and axes
     sns.set_style(style="whitegrid")
     sns.set_palette("terrain")
-    fig, ax = plt.subplots(1, 1, figsize=(36,32))
+    fig, ax = plt.subplots(1, 1, figsize=scaled_size(36, 32))
 
     #Parse data into arrays
     x = [0, 1, 2]
     y = [distr[k] for k in sorted(distr.keys())]
 
     #Set exponent base of y ticks
-    majorFormatter = FixedOrderFormatter(6)
+    majorFormatter = fixed_order_formatter(6)
     ax.yaxis.set_major_formatter(majorFormatter)
-    ax.yaxis.offsetText.set_fontsize(36)
+    ax.yaxis.offsetText.set_fontsize(scaled(36))
 
     #Make plot
     sns.barplot(x, y, ax=ax, edgecolor='none')
 
 
     #Axis labels
-    plt.xlabel('Phase', fontsize=38)
-    plt.ylabel('Counts', fontsize=38)
-    ax.tick_params(labelsize=34)
+    plt.xlabel('Phase', fontsize=scaled(38))
+    plt.ylabel('Counts', fontsize=scaled(38))
+    ax.tick_params(labelsize=scaled(34))
 
     #Remove box lines around plot
     sns.despine()
@@ -1632,20 +2029,261 @@ def plot_total_phase(distr, outfile):
     plt.tight_layout()
 
     #Save output
-    fig.savefig(outfile)
+    fig.savefig(outfile, dpi=render_profile['dpi'])
+
+    return
+
+## Axis tick formatter with a fixed order of magnitude
+def fixed_order_formatter(order_of_mag=0):
+    from matplotlib.ticker import ScalarFormatter
+
+    class FixedOrderFormatter(ScalarFormatter):
+        """Formats axis ticks using scientific notation with a constant order of
+        magnitude"""
+        def __init__(self, order_of_mag=0, useOffset=True, useMathText=False):
+            self._order_of_mag = order_of_mag
+            ScalarFormatter.__init__(self, useOffset=useOffset,
+                                     useMathText=useMathText)
+        def _set_orderOfMagnitude(self, range):
+            """Over-riding this to avoid having orderOfMagnitude reset elsewhere"""
+            self.orderOfMagnitude = self._order_of_mag
+
+    return FixedOrderFormatter(order_of_mag)
+
+## Write the QC metrics: tab-separated metric and value
+def write_metrics(outfile, tmpfolder, tot_maps, phase_distr, total_phase_distr):
+
+    metrics = [("total_alignments", tot_maps)]
+
+    #Total phase distribution
+    total = sum(total_phase_distr.values())
+    for phase in ['0', '1', '2']:
+        metrics.append(("phase"+phase+"_reads", total_phase_distr[phase]))
+    for phase in ['0', '1', '2']:
+        metrics.append(("phase"+phase+"_fraction", "%.4f" % (float(total_phase_distr[phase])/total if total > 0 else 0)))
+
+    #Reads and phase 0 fraction per RPF length
+    for rpf in sorted(phase_distr.keys(), key=int):
+        rpf_total = sum(phase_distr[rpf].values())
+        metrics.append(("rpf"+rpf+"_reads", rpf_total))
+        metrics.append(("rpf"+rpf+"_phase0_fraction", "%.4f" % (float(phase_distr[rpf]['0'])/rpf_total if rpf_total > 0 else 0)))
+
+    #Genes with reads
+    gene_file = tmpfolder+"/mappingqc/genedistribution.txt"
+    if os.path.exists(gene_file):
+        with open(gene_file, 'r') as FR:
+            metrics.append(("genes_with_reads", sum(1 for line in FR)-1))
+
+    #Metagenic classification
+    coding_file = tmpfolder+"/mappingqc/annotation_coding.txt"
+    noncoding_file = tmpfolder+"/mappingqc/annotation_noncoding.txt"
+    if os.path.exists(coding_file) and os.path.exists(noncoding_file):
+        annotation_coding, annotation_noncoding = metagenic_data(coding_file, noncoding_file)
+        class_total = sum(annotation_coding['values'])
+        for label, count in zip(annotation_coding['labels'], annotation_coding['values']):
+            metric = "metagenic_"+re.sub('[^a-z0-9]+', '_', label.lower().replace("'", "")).strip('_')+"_fraction"
+            metrics.append((metric, "%.4f" % (float(count)/class_total if class_total > 0 else 0)))
+
+    #Write and show
+    with open(outfile, 'w') as FW:
+        for metric, value in metrics:
+            FW.write(metric+"\t"+str(value)+"\n")
+            print metric+"\t"+str(value)
+
+    return
+
+## Collect the data of all charts for the interactive report
+def interactive_report_data(tmpfolder, phase_distr, total_phase_distr, triplet_distr, species, codon_ref_file,\
+                            norm_codon_ref_file, exp_name):
+    import numpy as np
+
+    data = {}
+
+    #Phase distributions
+    data['tot_phase'] = [total_phase_distr[phase] for phase in ['0', '1', '2']]
+    rpfs = sorted(phase_distr.keys(), key=int)
+    data['rpf_phase'] = {'lengths': [int(rpf) for rpf in rpfs],
+                         'counts': [[phase_distr[rpf][phase] for phase in ['0', '1', '2']] for rpf in rpfs]}
+    data['phase_relpos'] = [freq.astype(np.int64).tolist() for freq in read_phase_position(tmpfolder)]
+
+    #Triplet identities (triplet, amino acid, phase counts), sorted on amino acid
+    codontable = get_codontable()
+    triplets = sorted(codontable.keys(), key=lambda e: (codontable[e], e))
+    data['triplets'] = [[triplet, codontable[triplet]]+[triplet_distr[triplet][phase] for phase in [0, 1, 2]] for triplet in triplets]
+
+    #Codon usage
+    if species=='human' or species=='mouse':
+        data['codon_usage'] = codon_usage_data(read_ref(codon_ref_file), read_codon_count(tmpfolder+"/mappingqc/total_triplet.csv"),\
+                                               exp_name, 'Total ribosome count per codon identity')
+    if species=='human':
+        data['norm_codon_usage'] = codon_usage_data(read_ref(norm_codon_ref_file), read_norm_codon_count(tmpfolder+"/mappingqc/norm_triplet.csv"),\
+                                                    exp_name, 'Normalized total ribosome count per codon identity')
+
+    #Gene distributions and metagenic classification
+    data['genes'] = gene_distribution_data(tmpfolder+"/mappingqc/genedistribution.txt")
+    data['annotation_coding'], data['annotation_noncoding'] = metagenic_data(tmpfolder+"/mappingqc/annotation_coding.txt",\
+                                                                             tmpfolder+"/mappingqc/annotation_noncoding.txt")
+
+    return data
+
+## Codon usage of the sample against the reference, sorted on the reference percentages
+def codon_usage_data(reference, codon_perc, name, title):
+
+    codontable = get_codontable()
+    sorted_triplets = sorted(reference, key=lambda k: reference[k], reverse=True)
+
+    return {'name': name, 'title': title,
+            'labels': [triplet+" ("+codontable[triplet]+")" for triplet in sorted_triplets],
+            'reference': [round(reference[triplet], 4) for triplet in sorted_triplets],
+            'sample': [round(codon_perc[triplet], 4) for triplet in sorted_triplets]}
+
+## Ranked and cumulative gene abundance and the density of log2(#reads)
+# The ranked genes are thinned out to at most max_points, so the report stays small
+def gene_distribution_data(input_file, max_points=2000):
+    import numpy as np
+
+    abundance = gene_abundance(input_file)
+    if abundance is None:
+        return {'rank': [], 'log2': [], 'cumul': [], 'density_x': [], 'density_y': []}
+    log2, cumul, grid, density = abundance
+    ranks = np.unique(np.linspace(0, len(log2)-1, min(len(log2), max_points)).astype(np.int64))
+
+    return {'rank': (ranks+1).tolist(), 'log2': np.round(log2[ranks], 3).tolist(),
+            'cumul': np.round(cumul[ranks], 4).tolist(),
+            'density_x': np.round(grid[::4], 3).tolist(), 'density_y': np.round(density[::4], 5).tolist()}
+
+## Gene abundance: log2(#reads) and cumulative fraction of the ranked genes, and the density of log2(#reads)
+# Returns None if no gene has reads
+def gene_abundance(input_file):
+    import numpy as np
+
+    #Read in data gene distribution (column 1: genes, column 2: #reads)
+    counts = []
+    with open(input_file, 'r') as FR:
+        FR.readline() #Header
+        for line in FR:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) == 2 and int(fields[1]) > 0:
+                counts.append(int(fields[1]))
+    if not counts:
+        return None
+
+    #Rank genes (descending)
+    counts = np.sort(np.array(counts, dtype=np.int64))[::-1]
+    n_genes = len(counts)
+    log2 = np.log2(counts)
+    cumul = np.cumsum(counts)/float(counts.sum())
+
+    #Gaussian kernel density with the default bandwidth of R (bw.nrd0), on a binned grid
+    spread = min(np.std(log2, ddof=1) if n_genes > 1 else 0, (np.percentile(log2, 75)-np.percentile(log2, 25))/1.34)
+    bandwidth = 0.9*spread*n_genes**-0.2 if spread > 0 else 0.5
+    binned, edges = np.histogram(log2, bins=512, range=(log2.min()-3*bandwidth, log2.max()+3*bandwidth))
+    grid = (edges[:-1]+edges[1:])/2
+    density = np.exp(-0.5*((grid[:, None]-grid[None, :])/bandwidth)**2).dot(binned)/(n_genes*bandwidth*np.sqrt(2*np.pi))
+
+    return log2, cumul, grid, density
+
+## Plot the ranked gene abundance, the cumulative abundance and the density of log2(#reads)
+def gene_distribution_plots(tmpfolder, outfolder):
+    import numpy as np
+    plt = get_pyplot()
+
+    abundance = gene_abundance(tmpfolder+"/mappingqc/genedistribution.txt")
+    if abundance is None:
+        log2, cumul, grid, density = np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0)
+    else:
+        log2, cumul, grid, density = abundance
+    ranks = np.arange(1, len(log2)+1)
+
+    plots = [("rankedgenes.png", ranks, log2, "Ranked gene abundance", "Ranked genes", "log2(#reads)", True),
+             ("cumulative.png", ranks, cumul, "Cumulative abundance", "Ranked genes", "Cumulative #reads", True),
+             ("density.png", grid, density, "Density log2(#reads)", "log2(#reads)", "Density", False)]
+    for outfile, x, y, title, xlabel, ylabel, points in plots:
+        fig, ax = plt.subplots(1, 1, figsize=scaled_size(26, 26))
+        if points:
+            ax.scatter(x, y, s=scaled(120), facecolors='none', edgecolors='#8B0000', linewidths=scaled(2))
+        else:
+            ax.plot(x, y, color='red', linewidth=scaled(3))
+        try:
+            ax.set_facecolor("white")
+        except:
+            ax.set_axis_bgcolor("white")
+        ax.grid(False)
+        for spine in ax.spines.values():
+            spine.set_color('k')
+        ax.set_title(title, fontsize=scaled(50), fontweight='bold')
+        ax.set_xlabel(xlabel, fontsize=scaled(44))
+        ax.set_ylabel(ylabel, fontsize=scaled(44))
+        ax.tick_params(labelsize=scaled(40))
+        plt.tight_layout()
+        fig.savefig(outfolder+"/"+outfile, dpi=render_profile['dpi'])
+        plt.close(fig)
 
     return
 
-class FixedOrderFormatter(ScalarFormatter):
-    """Formats axis ticks using scientific notation with a constant order of
-    magnitude"""
-    def __init__(self, order_of_mag=0, useOffset=True, useMathText=False):
-        self._order_of_mag = order_of_mag
-        ScalarFormatter.__init__(self, useOffset=useOffset,
-                                 useMathText=useMathText)
-    def _set_orderOfMagnitude(self, range):
-        """Over-riding this to avoid having orderOfMagnitude reset elsewhere"""
-        self.orderOfMagnitude = self._order_of_mag
+## Metagenic classification of the coding and other biotypes
+def metagenic_data(coding_file, noncoding_file):
+
+    #Sum the chromosomal tables per column
+    sums = []
+    for input_file in [coding_file, noncoding_file]:
+        with open(input_file, 'r') as FR:
+            header = FR.readline().rstrip("\n").split("\t")
+            column_sums = [0]*len(header)
+            for line in FR:
+                fields = line.rstrip("\n").split("\t")
+                for i in range(1, len(fields)):
+                    column_sums[i] += int(fields[i])
+        sums.append((header, dict(zip(header, column_sums))))
+    (coding_header, coding), (noncoding_header, noncoding) = sums
+
+    #Reads in protein coding transcripts
+    annotation_coding = {'labels': ["Intergenic", "Coding region", "5'UTR", "3'UTR", "Intron", "Other biotypes"],
+                         'values': [coding[column] for column in ['intergenic', 'exon', '5utr', '3utr', 'intron', 'non_protein_coding']]}
+
+    #Other biotypes, the ones under 1% together as Others
+    biotypes = [(biotype, noncoding[biotype]) for biotype in noncoding_header[2:] if noncoding[biotype] > 0]
+    total = float(sum([count for biotype, count in biotypes]))
+    majors = [(biotype, count) for biotype, count in biotypes if round(count/total*100, 2) >= 1]
+    minors = sum([count for biotype, count in biotypes if round(count/total*100, 2) < 1])
+    annotation_noncoding = {'labels': ["Others"]+[biotype for biotype, count in majors],
+                            'values': [minors]+[count for biotype, count in majors]}
+
+    return annotation_coding, annotation_noncoding
+
+## Plot the metagenic classification of the coding and other biotypes as pie charts
+def metagenic_piecharts(tmpfolder, outfolder):
+    plt = get_pyplot()
+    from matplotlib.colors import hsv_to_rgb
+
+    annotation_coding, annotation_noncoding = metagenic_data(tmpfolder+"/mappingqc/annotation_coding.txt",\
+                                                             tmpfolder+"/mappingqc/annotation_noncoding.txt")
+
+    #Coding colors as before, other biotypes get yellow and a rainbow
+    n_majors = len(annotation_noncoding['values'])-1
+    plots = [("annotation_coding.png", annotation_coding, "Metagenic classification",
+              ['#EE4000', '#C0FF3E', '#32CD32', '#0000FF', '#8B4789', '#FFFF00'], scaled(36)),
+             ("annotation_noncoding.png", annotation_noncoding, "Overview other Ensembl biotypes",
+              ['#FFFF00']+[hsv_to_rgb((float(i)/n_majors, 1, 1)) for i in range(n_majors)], scaled(26))]
+    for outfile, chart, title, colors, legend_size in plots:
+        fig, ax = plt.subplots(1, 1, figsize=scaled_size(26, 26))
+        total = float(sum(chart['values']))
+        if total > 0:
+            wedges, texts = ax.pie(chart['values'], labels=["%.2f%%" % (value/total*100) for value in chart['values']],
+                                   colors=colors, radius=0.7, wedgeprops={'linewidth': scaled(2), 'edgecolor': 'k'})
+            for text in texts:
+                text.set_fontsize(scaled(36))
+            ax.legend(wedges, chart['labels'], loc='upper left', fontsize=legend_size)
+        ax.set_xlim([-1.2, 1.2])
+        ax.set_ylim([-1, 1.4]) #Room for the legend above the pie
+        ax.set_aspect('equal')
+        ax.axis('off')
+        ax.set_title(title, fontsize=scaled(50), fontweight='bold')
+        plt.tight_layout()
+        fig.savefig(outfolder+"/"+outfile, dpi=render_profile['dpi'])
+        plt.close(fig)
+
+    return
 
 ## Get plot data out of results DB
 def get_plot_data(tmpfolder):
@@ -1685,7 +2323,8 @@ def get_plot_data(tmpfolder):
             elements = line.split(',')
             triplet_data[elements[0]][int(elements[1])] = int(elements[2])
 
-    return phase_distr, total, triplet_data
+    #Plain dictionaries, so they can be sent to the figure processes
+    return dict(phase_distr), total, dict(triplet_data)
 
 ## Get the number of primary (bit flag of 0x100)alignments out of samfile
 def maps_out_of_sam(sam, galaxy, galaxysam, tmpfolder):
@@ -1718,14 +2357,6 @@ def format_thousands(x):
     return '{:,}'.format(int(x)).replace(",", " ")
 
 
-def get_AA(item):
-
-    codontable = get_codontable()
-    AA = codontable[item]
-
-    return AA
-
-
 def get_codontable():
 
     codontable = {
@@ -1749,6 +2380,48 @@ def get_codontable():
 
     return codontable
 
+## Packaged resource out of the tool directory, read once and cached in memory (None if it is not packaged) ##
+def load_resource(name):
+
+    if name not in resource_cache:
+        resource_cache[name] = None
+        if os.path.exists(TOOL_DIR+"/"+name):
+            with open(TOOL_DIR+"/"+name, 'rb') as FR:
+                resource_cache[name] = FR.read()
+
+    return resource_cache[name]
+
+## Write a packaged resource to a folder, under its file name ##
+def write_resource(name, folder):
+
+    data = load_resource(name)
+    if data is None:
+        print "Could not find "+name+" in the tool directory, the report is made without it"
+        return
+    with open(folder+"/"+os.path.basename(name), 'wb') as FW:
+        FW.write(data)
+
+    return
+
+## Matplotlib pyplot on the Agg backend, only imported by the stages that draw figures ##
+def get_pyplot():
+    import matplotlib
+    if 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    return plt
+
+## Scale a figure or font size to the rendering profile ##
+def scaled(size):
+
+    return size * render_profile['scale']
+
+## Scale a figure size (in inches) to the rendering profile ##
+def scaled_size(width, height):
+
+    return (scaled(width), scaled(height))
+
 ## Data Dumper for recursively printing nested dictionaries and defaultDicts ##
 def print_dict(dictionary, indent='', braces=0):
     """
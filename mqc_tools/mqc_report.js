@@ -0,0 +1,432 @@
+/*
+ * mQC (MappingQC): renderer of the interactive report
+ *
+ * Draws all charts of the report as inline SVG out of the embedded MQC_DATA, without any external
+ * library, so the report works offline. Every element with a data-chart attribute gets its chart.
+ * Bar and xy charts zoom with the mouse wheel, pan by dragging and reset on a double click.
+ * Hover over a bar, point or slice to see its value.
+ *
+ * Copyright (C) 2017 S. Verbruggen & G. Menschaert, GNU General Public License v3 or later
+ */
+(function () {
+    "use strict";
+
+    var SVG_NS = "http://www.w3.org/2000/svg";
+    var PHASE_COLORS = ["#228EDA", "#3BBE71", "#B7E397"];
+    var PHASE_NAMES = ["Phase 0", "Phase 1", "Phase 2"];
+    var W = 900, H = 520;
+    var M = {top: 40, right: 170, bottom: 80, left: 90};
+
+    // SVG helpers
+    function node(name, attrs, parent) {
+        var elem = document.createElementNS(SVG_NS, name);
+        for (var key in attrs) {
+            if (attrs.hasOwnProperty(key)) {
+                elem.setAttribute(key, attrs[key]);
+            }
+        }
+        if (parent) {
+            parent.appendChild(elem);
+        }
+        return elem;
+    }
+
+    function label(parent, x, y, str, attrs) {
+        attrs = attrs || {};
+        attrs.x = x;
+        attrs.y = y;
+        var elem = node("text", attrs, parent);
+        elem.textContent = str;
+        return elem;
+    }
+
+    function tooltip(elem, str) {
+        node("title", {}, elem).textContent = str;
+    }
+
+    function clear(elem) {
+        while (elem.firstChild) {
+            elem.removeChild(elem.firstChild);
+        }
+    }
+
+    // Numbers with a space as thousands separator, like the rest of the report
+    function fmt(value) {
+        if (value !== Math.round(value)) {
+            return String(parseFloat(value.toPrecision(4)));
+        }
+        return String(value).replace(/\B(?=(\d{3})+(?!\d))/g, " ");
+    }
+
+    function niceTicks(min, max, n) {
+        if (!(max > min)) {
+            max = min + 1;
+        }
+        var step = Math.pow(10, Math.floor(Math.log((max - min) / n) / Math.LN10));
+        var err = (max - min) / n / step;
+        if (err >= 7.5) {
+            step *= 10;
+        } else if (err >= 3.5) {
+            step *= 5;
+        } else if (err >= 1.5) {
+            step *= 2;
+        }
+        var ticks = [];
+        for (var k = Math.ceil(min / step); k * step <= max + step * 1e-9; k++) {
+            ticks.push(parseFloat((k * step).toPrecision(12)));
+        }
+        return ticks;
+    }
+
+    function newSvg(container, width, height) {
+        clear(container);
+        return node("svg", {viewBox: "0 0 " + width + " " + height, width: "100%", "class": "mqc_svg",
+            "font-family": "Helvetica Neue, Helvetica, Arial, sans-serif", "font-size": 13}, container);
+    }
+
+    function legend(svg, x, y, names, colors) {
+        for (var i = 0; i < names.length; i++) {
+            node("rect", {x: x, y: y + i * 20, width: 12, height: 12, fill: colors[i]}, svg);
+            label(svg, x + 18, y + i * 20 + 11, names[i]);
+        }
+    }
+
+    // Background, y axis, grid and axis labels of an xy chart; returns the y scale
+    function yAxis(svg, spec, ymax) {
+        var ph = H - M.top - M.bottom;
+        var ticks = niceTicks(0, ymax, 6);
+        var top = ticks[ticks.length - 1];
+        var scale = function (v) { return M.top + ph - v / top * ph; };
+        node("rect", {x: M.left, y: M.top, width: W - M.left - M.right, height: ph, fill: "#f2f2f2"}, svg);
+        for (var i = 0; i < ticks.length; i++) {
+            node("line", {x1: M.left, x2: W - M.right, y1: scale(ticks[i]), y2: scale(ticks[i]), stroke: "#ffffff"}, svg);
+            label(svg, M.left - 8, scale(ticks[i]) + 4, fmt(ticks[i]), {"text-anchor": "end"});
+        }
+        label(svg, 20, M.top + ph / 2, spec.ylabel || "", {"text-anchor": "middle", transform: "rotate(-90 20 " + (M.top + ph / 2) + ")"});
+        label(svg, M.left + (W - M.left - M.right) / 2, H - 10, spec.xlabel || "", {"text-anchor": "middle"});
+        if (spec.title) {
+            label(svg, M.left + (W - M.left - M.right) / 2, 22, spec.title, {"text-anchor": "middle", "font-size": 16, "font-weight": "bold"});
+        }
+        return scale;
+    }
+
+    // Wheel zoom, drag pan and double click reset over the x domain [0, extent]
+    function zoomable(container, extent, minSpan, draw) {
+        var svg = newSvg(container, W, H);
+        var domain = [0, extent];
+        var redraw = function () {
+            clear(svg);
+            draw(svg, domain[0], domain[1]);
+        };
+        var toDomain = function (evt) {
+            var box = svg.getBoundingClientRect();
+            var x = (evt.clientX - box.left) / box.width * W;
+            return Math.min(1, Math.max(0, (x - M.left) / (W - M.left - M.right)));
+        };
+        var setDomain = function (lo, span) {
+            span = Math.min(extent, Math.max(minSpan, span));
+            lo = Math.min(extent - span, Math.max(0, lo));
+            domain = [lo, lo + span];
+            redraw();
+        };
+        svg.addEventListener("wheel", function (evt) {
+            evt.preventDefault();
+            var frac = toDomain(evt);
+            var span = domain[1] - domain[0];
+            var newSpan = span * (evt.deltaY > 0 ? 1.25 : 0.8);
+            setDomain(domain[0] + frac * (span - newSpan), newSpan);
+        });
+        var dragStart = null;
+        svg.addEventListener("mousedown", function (evt) {
+            dragStart = {x: toDomain(evt), lo: domain[0]};
+        });
+        window.addEventListener("mouseup", function () {
+            dragStart = null;
+        });
+        svg.addEventListener("mousemove", function (evt) {
+            if (dragStart !== null) {
+                var span = domain[1] - domain[0];
+                setDomain(dragStart.lo - (toDomain(evt) - dragStart.x) * span, span);
+            }
+        });
+        svg.addEventListener("dblclick", function () {
+            setDomain(0, extent);
+        });
+        redraw();
+    }
+
+    function clipPlotArea(svg, id) {
+        var clip = node("clipPath", {id: id}, node("defs", {}, svg));
+        node("rect", {x: M.left, y: M.top, width: W - M.left - M.right, height: H - M.top - M.bottom}, clip);
+        return node("g", {"clip-path": "url(#" + id + ")"}, svg);
+    }
+
+    var clipCount = 0;
+
+    // Bar chart: spec.categories, spec.series [{name, values, color, colors}], optional spec.line {name, values, color}
+    function barChart(container, spec) {
+        var n = spec.categories.length;
+        if (n === 0) {
+            container.textContent = "No data";
+            return;
+        }
+        var clipId = "mqc_clip" + (clipCount++);
+        zoomable(container, n, Math.min(n, 3), function (svg, lo, hi) {
+            var pw = W - M.left - M.right;
+            var xs = function (v) { return M.left + (v - lo) / (hi - lo) * pw; };
+            var first = Math.max(0, Math.floor(lo)), last = Math.min(n - 1, Math.ceil(hi) - 1);
+            var ymax = 0;
+            for (var i = first; i <= last; i++) {
+                for (var s = 0; s < spec.series.length; s++) {
+                    ymax = Math.max(ymax, spec.series[s].values[i]);
+                }
+                if (spec.line) {
+                    ymax = Math.max(ymax, spec.line.values[i]);
+                }
+            }
+            var ys = yAxis(svg, spec, ymax);
+            var plot = clipPlotArea(svg, clipId);
+            var groupWidth = 0.8 / spec.series.length;
+            for (i = first; i <= last; i++) {
+                for (s = 0; s < spec.series.length; s++) {
+                    var series = spec.series[s];
+                    var value = series.values[i];
+                    var bar = node("rect", {x: xs(i + 0.1 + s * groupWidth), width: Math.max(1, xs(groupWidth) - xs(0)),
+                        y: ys(value), height: ys(0) - ys(value), fill: series.colors ? series.colors[i] : series.color}, plot);
+                    tooltip(bar, spec.categories[i] + (series.name ? " - " + series.name : "") + ": " + fmt(value));
+                }
+            }
+            if (spec.line) {
+                var points = [];
+                for (i = first; i <= last; i++) {
+                    points.push(xs(i + 0.5) + "," + ys(spec.line.values[i]));
+                }
+                node("polyline", {points: points.join(" "), fill: "none", stroke: spec.line.color, "stroke-width": 3, opacity: 0.7}, plot);
+                for (i = first; i <= last; i++) {
+                    var dot = node("circle", {cx: xs(i + 0.5), cy: ys(spec.line.values[i]), r: 4, fill: spec.line.color}, plot);
+                    tooltip(dot, spec.categories[i] + " - " + spec.line.name + ": " + fmt(spec.line.values[i]));
+                }
+            }
+            // Category labels, thinned out when they do not fit
+            var every = Math.max(1, Math.ceil((last - first + 1) * (spec.rotate ? 14 : 40) / pw));
+            for (i = first; i <= last; i += every) {
+                var x = xs(i + 0.5);
+                if (spec.rotate) {
+                    label(svg, x, H - M.bottom + 8, spec.categories[i], {"text-anchor": "end", "font-size": 10,
+                        transform: "rotate(-90 " + x + " " + (H - M.bottom + 8) + ")", "dominant-baseline": "middle"});
+                } else {
+                    label(svg, x, H - M.bottom + 18, spec.categories[i], {"text-anchor": "middle"});
+                }
+            }
+            var names = [], colors = [];
+            for (s = 0; s < spec.series.length; s++) {
+                if (spec.series[s].name) {
+                    names.push(spec.series[s].name);
+                    colors.push(spec.series[s].color);
+                }
+            }
+            if (spec.line) {
+                names.push(spec.line.name);
+                colors.push(spec.line.color);
+            }
+            legend(svg, W - M.right + 20, M.top + 10, names, colors);
+        });
+    }
+
+    // XY chart: spec.series [{name, x, y, color, line, points}]
+    function xyChart(container, spec) {
+        var xmin = Infinity, xmax = -Infinity;
+        for (var s = 0; s < spec.series.length; s++) {
+            for (var i = 0; i < spec.series[s].x.length; i++) {
+                xmin = Math.min(xmin, spec.series[s].x[i]);
+                xmax = Math.max(xmax, spec.series[s].x[i]);
+            }
+        }
+        if (!(xmax > xmin)) {
+            xmin = isFinite(xmin) ? xmin - 1 : 0;
+            xmax = xmin + 2;
+        }
+        var clipId = "mqc_clip" + (clipCount++);
+        zoomable(container, xmax - xmin, (xmax - xmin) / 1000, function (svg, lo, hi) {
+            lo += xmin;
+            hi += xmin;
+            var pw = W - M.left - M.right;
+            var xs = function (v) { return M.left + (v - lo) / (hi - lo) * pw; };
+            var ymax = 0;
+            for (var s = 0; s < spec.series.length; s++) {
+                for (var i = 0; i < spec.series[s].x.length; i++) {
+                    if (spec.series[s].x[i] >= lo && spec.series[s].x[i] <= hi) {
+                        ymax = Math.max(ymax, spec.series[s].y[i]);
+                    }
+                }
+            }
+            var ys = yAxis(svg, spec, ymax);
+            var plot = clipPlotArea(svg, clipId);
+            var ticks = niceTicks(lo, hi, 8);
+            for (i = 0; i < ticks.length; i++) {
+                label(svg, xs(ticks[i]), H - M.bottom + 18, fmt(ticks[i]), {"text-anchor": "middle"});
+            }
+            for (s = 0; s < spec.series.length; s++) {
+                var series = spec.series[s];
+                if (series.line) {
+                    var points = [];
+                    for (i = 0; i < series.x.length; i++) {
+                        points.push(xs(series.x[i]) + "," + ys(series.y[i]));
+                    }
+                    node("polyline", {points: points.join(" "), fill: "none", stroke: series.color, "stroke-width": 2}, plot);
+                }
+                for (i = 0; i < series.x.length; i++) {
+                    if (series.x[i] < lo || series.x[i] > hi) {
+                        continue;
+                    }
+                    var dot = node("circle", {cx: xs(series.x[i]), cy: ys(series.y[i]), r: series.points ? 3 : 5,
+                        fill: series.points ? "none" : series.color, stroke: series.color, "fill-opacity": 0,
+                        "stroke-opacity": series.points ? 1 : 0}, plot);
+                    tooltip(dot, (spec.xlabel || "x") + ": " + fmt(series.x[i]) + ", " + (spec.ylabel || "y") + ": " + fmt(series.y[i]));
+                }
+            }
+        });
+    }
+
+    // Pie chart: spec.labels, spec.values, spec.colors
+    function pie(svg, cx, cy, r, spec, fontSize) {
+        var total = 0;
+        for (var i = 0; i < spec.values.length; i++) {
+            total += spec.values[i];
+        }
+        if (total <= 0) {
+            node("circle", {cx: cx, cy: cy, r: r, fill: "none", stroke: "#cccccc"}, svg);
+            return;
+        }
+        var angle = 0;
+        for (i = 0; i < spec.values.length; i++) {
+            var frac = spec.values[i] / total;
+            if (frac <= 0) {
+                continue;
+            }
+            var slice;
+            if (frac >= 1) {
+                slice = node("circle", {cx: cx, cy: cy, r: r, fill: spec.colors[i]}, svg);
+            } else {
+                // Counterclockwise from 3 o'clock, like matplotlib
+                var a1 = angle, a2 = angle + frac * 2 * Math.PI;
+                slice = node("path", {d: "M" + cx + "," + cy + " L" + (cx + r * Math.cos(a1)) + "," + (cy - r * Math.sin(a1)) +
+                    " A" + r + "," + r + " 0 " + (frac > 0.5 ? 1 : 0) + ",0 " + (cx + r * Math.cos(a2)) + "," + (cy - r * Math.sin(a2)) + " Z",
+                    fill: spec.colors[i], stroke: "#ffffff", "stroke-width": 0.5}, svg);
+            }
+            tooltip(slice, spec.labels[i] + ": " + fmt(spec.values[i]) + " (" + (100 * frac).toFixed(1) + "%)");
+            if (frac >= 0.04) {
+                var mid = angle + frac * Math.PI;
+                var pct = label(svg, cx + 0.7 * r * Math.cos(mid), cy - 0.7 * r * Math.sin(mid) + fontSize / 3, (100 * frac).toFixed(1) + "%",
+                    {"text-anchor": "middle", "font-size": fontSize});
+                pct.setAttribute("pointer-events", "none");
+            }
+            angle += frac * 2 * Math.PI;
+        }
+    }
+
+    function pieChart(container, spec) {
+        var svg = newSvg(container, 700, 460);
+        label(svg, 350, 24, spec.title || "", {"text-anchor": "middle", "font-size": 16, "font-weight": "bold"});
+        pie(svg, 460, 250, 190, spec, 12);
+        legend(svg, 10, 50, spec.labels, spec.colors);
+    }
+
+    // Grid of triplet identity pies: data rows [triplet, amino acid, phase 0, phase 1, phase 2]
+    function tripletChart(container, rows) {
+        var cols = 8, cellW = 120, cellH = 135;
+        var height = Math.ceil(rows.length / cols) * cellH + 10;
+        var svg = newSvg(container, cols * cellW + 130, height);
+        for (var k = 0; k < rows.length; k++) {
+            var x = (k % cols) * cellW + cellW / 2, y = Math.floor(k / cols) * cellH;
+            var color = rows[k][0] === "ATG" ? "#00aa00" : rows[k][1] === "STOP" ? "#ff0000" : "#000000";
+            label(svg, x, y + 20, rows[k][0] + ": " + rows[k][1], {"text-anchor": "middle", "font-size": 15, fill: color});
+            pie(svg, x, y + 78, 48, {labels: PHASE_NAMES, values: rows[k].slice(2, 5), colors: PHASE_COLORS}, 9);
+        }
+        legend(svg, cols * cellW + 10, height / 2 - 30, PHASE_NAMES, PHASE_COLORS);
+    }
+
+    // Chart definitions on the embedded data
+    var CHARTS = {
+        tot_phase: function (container, data) {
+            barChart(container, {categories: ["0", "1", "2"], series: [{name: "", values: data.tot_phase, colors: PHASE_COLORS}],
+                xlabel: "Phase", ylabel: "Counts"});
+        },
+        rpf_phase: function (container, data) {
+            var series = [];
+            for (var p = 0; p < 3; p++) {
+                series.push({name: PHASE_NAMES[p], color: PHASE_COLORS[p], values: data.rpf_phase.counts.map(function (row) { return row[p]; })});
+            }
+            barChart(container, {categories: data.rpf_phase.lengths.map(String), series: series, xlabel: "RPF length", ylabel: "Count"});
+        },
+        phase_relpos: function (container, data) {
+            var n = data.phase_relpos[0].length, categories = [], series = [];
+            for (var b = 0; b < n; b++) {
+                categories.push((b / n).toFixed(3) + "-" + ((b + 1) / n).toFixed(3));
+            }
+            for (var p = 0; p < 3; p++) {
+                series.push({name: PHASE_NAMES[p], color: PHASE_COLORS[p], values: data.phase_relpos[p]});
+            }
+            barChart(container, {categories: categories, series: series, rotate: true,
+                xlabel: "Relative position in coding sequence", ylabel: "Counts"});
+        },
+        triplet_id: function (container, data) {
+            tripletChart(container, data.triplets);
+        },
+        codon_usage: function (container, data) {
+            codonChart(container, data.codon_usage, "Reference", "Percentage codon count [in %]");
+        },
+        norm_codon_usage: function (container, data) {
+            codonChart(container, data.norm_codon_usage, "Normalized reference", "Percentage normalized codon count [in %]");
+        },
+        ranked_genes: function (container, data) {
+            xyChart(container, {title: "Ranked gene abundance", xlabel: "Ranked genes", ylabel: "log2(#reads)",
+                series: [{x: data.genes.rank, y: data.genes.log2, color: "#8b0000", points: true}]});
+        },
+        cumulative: function (container, data) {
+            xyChart(container, {title: "Cumulative abundance", xlabel: "Ranked genes", ylabel: "Cumulative #reads",
+                series: [{x: data.genes.rank, y: data.genes.cumul, color: "#8b0000", points: true}]});
+        },
+        genes_density: function (container, data) {
+            xyChart(container, {title: "Density log2(#reads)", xlabel: "log2(#reads)", ylabel: "Density",
+                series: [{x: data.genes.density_x, y: data.genes.density_y, color: "#ff0000", line: true}]});
+        },
+        annotation_coding: function (container, data) {
+            pieChart(container, {title: "Metagenic classification", labels: data.annotation_coding.labels,
+                values: data.annotation_coding.values,
+                colors: ["#ee4000", "#c0ff3e", "#32cd32", "#0000ff", "#8b4789", "#ffff00"]});
+        },
+        annotation_noncoding: function (container, data) {
+            var colors = ["#ffff00"];
+            for (var i = 1; i < data.annotation_noncoding.labels.length; i++) {
+                colors.push("hsl(" + Math.round(360 * (i - 1) / (data.annotation_noncoding.labels.length - 1)) + ",100%,50%)");
+            }
+            pieChart(container, {title: "Overview other Ensembl biotypes", labels: data.annotation_noncoding.labels,
+                values: data.annotation_noncoding.values, colors: colors});
+        }
+    };
+
+    function codonChart(container, codons, reference_name, ylabel) {
+        barChart(container, {title: codons.title, categories: codons.labels, rotate: true,
+            series: [{name: codons.name, values: codons.sample, color: "#228EDA"}],
+            line: {name: reference_name, values: codons.reference, color: "#3BBE71"},
+            xlabel: "Triplet (amino acid)", ylabel: ylabel});
+    }
+
+    function render() {
+        var data = window.MQC_DATA;
+        var containers = document.querySelectorAll("[data-chart]");
+        for (var i = 0; i < containers.length; i++) {
+            var chart = containers[i].getAttribute("data-chart");
+            if (CHARTS.hasOwnProperty(chart)) {
+                CHARTS[chart](containers[i], data);
+            }
+        }
+    }
+
+    if (document.readyState === "loading") {
+        document.addEventListener("DOMContentLoaded", render);
+    } else {
+        render();
+    }
+})();
@@ -0,0 +1,310 @@
+#####################################
+##	mQC (MappingQC): ribosome profiling mapping quality control tool
+##  Author: S. Verbruggen
+##  Supervised by: G. Menschaert
+##
+##	Copyright (C) 2017 S. Verbruggen & G. Menschaert
+##
+##	This program is free software: you can redistribute it and/or modify
+##	it under the terms of the GNU General Public License as published by
+##	the Free Software Foundation, either version 3 of the License, or
+##	(at your option) any later version.
+##
+##	This program is distributed in the hope that it will be useful,
+##	but WITHOUT ANY WARRANTY; without even the implied warranty of
+##	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##	GNU General Public License for more details.
+##
+##	You should have received a copy of the GNU General Public License
+##	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+## 	For more (contact) information visit https://github.com/Biobix/mQC
+#####################################
+
+
+__author__ = 'Steven Verbruggen'
+
+import traceback
+import getopt
+import os
+import sys
+import random
+import numpy as np
+import pysam
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+
+
+
+'''
+
+Estimate P site offsets out of the 5' ends of reads around annotated start codons
+
+Only the reads near the start codons are fetched over the index of the (sorted) bam file.
+Per RPF length, a metagene profile of the 5' read ends around the start codons is made and
+the offset is the distance of its highest peak upstream of the start codon. The output files
+follow the plastid psite format, so mQC.pl reads them in the same way.
+
+Start codons are visited in a random (but fixed) order and reading stops as soon as each RPF
+length has the target number of start codon anchored reads, so the calibration time does not
+depend on the library depth. The confidence of each offset is written next to the offsets.
+
+ARGUMENTS
+
+    -b | --bam                              The sorted and indexed bam file
+                                                (mandatory)
+    -c | --start_codons                     Tab-separated start codons: chromosome, strand and
+                                                first start codon position (mandatory)
+    -n | --exp_name                         The name of the experiment
+                                                (mandatory)
+    -o | --outfolder                        The output folder
+                                                (default: current working directory)
+    -l | --min_length                       The minimum RPF length
+                                                (default 22)
+    -u | --max_length                       The maximum RPF length
+                                                (default 34)
+    -f | --flank                            Number of nucleotides around the start codon in the metagene
+                                                (default 50)
+    -t | --target_reads                     Stop when each RPF length has this many start codon anchored reads,
+                                                0 to use all reads (default 0)
+
+'''
+
+def main():
+
+    # Catch command line with getopt
+    try:
+        myopts, args = getopt.getopt(sys.argv[1:], "b:c:n:o:l:u:f:t:", ["bam=", "start_codons=", "exp_name=", \
+                        "outfolder=", "min_length=", "max_length=", "flank=", "target_reads="])
+    except getopt.GetoptError as err:
+        print err
+        sys.exit(1)
+
+    # Catch arguments
+    # o == option
+    # a == argument passed to the o
+    bam = ''
+    start_codons = ''
+    exp_name = ''
+    outfolder = os.getcwd()
+    min_length = 22
+    max_length = 34
+    flank = 50
+    target_reads = 0
+    for o, a in myopts:
+        if o in ('-b', '--bam'):
+            bam = a
+        if o in ('-c', '--start_codons'):
+            start_codons = a
+        if o in ('-n', '--exp_name'):
+            exp_name = a
+        if o in ('-o', '--outfolder'):
+            outfolder = a
+        if o in ('-l', '--min_length'):
+            min_length = int(a)
+        if o in ('-u', '--max_length'):
+            max_length = int(a)
+        if o in ('-f', '--flank'):
+            flank = int(a)
+        if o in ('-t', '--target_reads'):
+            target_reads = int(a)
+
+    # Check for correct arguments
+    if bam == '':
+        print "ERROR: do not forget the bam file!"
+        sys.exit(1)
+    if start_codons == '':
+        print "ERROR: do not forget the start codons file!"
+        sys.exit(1)
+    if exp_name == '':
+        print "ERROR: do not forget the experiment name!"
+        sys.exit(1)
+    if min_length > max_length:
+        print "ERROR: minimum RPF length should not be larger than the maximum RPF length!"
+        sys.exit(1)
+
+    # Index bam file if necessary
+    if not os.path.exists(bam + ".bai"):
+        pysam.index(bam)
+
+    # Metagene profiles and offsets
+    starts = read_start_codons(start_codons)
+    print "Start codons: " + str(sum([len(starts[key]) for key in starts]))
+    profiles = metagene_profiles(bam, starts, min_length, max_length, flank, target_reads)
+    offsets = determine_offsets(profiles, flank)
+
+    # Write in plastid format
+    write_profiles(outfolder + "/" + exp_name + "_metagene_profiles.txt", profiles, min_length, flank)
+    write_offsets(outfolder + "/" + exp_name + "_p_offsets.txt", offsets, min_length)
+    write_confidence(outfolder + "/" + exp_name + "_offset_confidence.txt", profiles, offsets, min_length, flank, target_reads)
+    plot_profiles(outfolder + "/" + exp_name + "_p_offsets.png", profiles, offsets, min_length, flank)
+
+    return
+
+
+## Read start codons: {(chr, strand): sorted positions} ##
+def read_start_codons(input_file):
+
+    starts = {}
+    with open(input_file, 'r') as FR:
+        for line in FR:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 3:
+                continue
+            starts.setdefault((fields[0], int(fields[1])), set()).add(int(fields[2]))
+
+    for key in starts:
+        starts[key] = sorted(starts[key])
+
+    return starts
+
+
+## Metagene profiles of 5' read ends around the start codons, one row per RPF length ##
+# Columns are the positions -flank..flank relative to the first start codon nucleotide
+def metagene_profiles(bam, starts, min_length, max_length, flank, target_reads):
+
+    width = 2 * flank + 1
+    n_lengths = max_length - min_length + 1
+    lengths = []
+    rel_positions = []
+    length_counts = np.zeros(n_lengths, dtype=np.int64)
+
+    # Random but reproducible order of start codons, so a subsample covers the whole genome
+    start_list = [(chr, strand, start) for (chr, strand) in sorted(starts) for start in starts[(chr, strand)]]
+    random.Random(12345).shuffle(start_list)
+
+    samfile = pysam.AlignmentFile(bam, "rb")
+    references = set(samfile.references)
+    visited = 0
+    for (chr, strand, start) in start_list:
+        # Ensembl chromosome names, with or without chr prefix in the bam file
+        ref = chr
+        if ref not in references:
+            ref = "chr" + chr
+            if chr == "MT":
+                ref = "chrM"
+            if ref not in references:
+                continue
+        # Fetch only the reads with their 5' end in the window (pysam is 0-based, half-open)
+        for read in samfile.fetch(ref, max(0, start - flank - 1), start + flank):
+            if read.is_unmapped or read.is_secondary or read.is_supplementary:
+                continue
+            if strand == 1 and not read.is_reverse:
+                rel_pos = (read.reference_start + 1) - start
+            elif strand == -1 and read.is_reverse:
+                rel_pos = start - read.reference_end
+            else:
+                continue
+            length = read.query_alignment_length
+            if -flank <= rel_pos <= flank and min_length <= length <= max_length:
+                lengths.append(length)
+                rel_positions.append(rel_pos)
+                length_counts[length - min_length] += 1
+        visited += 1
+        # Stop reading when every RPF length has enough anchored reads
+        if target_reads > 0 and length_counts.min() >= target_reads:
+            break
+    samfile.close()
+    print "Start codons visited: " + str(visited) + " (" + str(len(lengths)) + " anchored reads)"
+
+    # Vectorised histogram over (RPF length, relative position)
+    bins = (np.array(lengths, dtype=np.int64) - min_length) * width + (np.array(rel_positions, dtype=np.int64) + flank)
+    profiles = np.bincount(bins, minlength=n_lengths * width).reshape(n_lengths, width)
+
+    return profiles
+
+
+## Offsets: distance of the highest 5' end peak upstream of the start codon ##
+# Lengths without upstream reads get 50, like plastid does, and are corrected in mQC.pl
+def determine_offsets(profiles, flank):
+
+    upstream = profiles[:, :flank]
+    offsets = flank - np.argmax(upstream, axis=1)
+    offsets[upstream.sum(axis=1) == 0] = 50
+
+    return offsets
+
+
+## Write metagene profiles ##
+def write_profiles(output_file, profiles, min_length, flank):
+
+    with open(output_file, 'w') as FW:
+        FW.write("x\t" + "\t".join([str(min_length + i) for i in range(profiles.shape[0])]) + "\n")
+        for j in range(profiles.shape[1]):
+            FW.write(str(j - flank) + "\t" + "\t".join([str(count) for count in profiles[:, j]]) + "\n")
+
+    return
+
+
+## Write offsets ##
+def write_offsets(output_file, offsets, min_length):
+
+    with open(output_file, 'w') as FW:
+        FW.write("length\tp_offset\n")
+        for i in range(len(offsets)):
+            FW.write(str(min_length + i) + "\t" + str(offsets[i]) + "\n")
+
+    return
+
+
+## Write the confidence of each offset ##
+# Peak fraction: part of the upstream reads at the offset peak. Peak ratio: offset peak versus the
+# second highest upstream peak. Confidence is high with at least the target number of reads (or
+# 1000 without target) and a peak ratio of 2, low with less than 100 reads or a peak ratio below 1.5.
+def write_confidence(output_file, profiles, offsets, min_length, flank, target_reads):
+
+    upstream = profiles[:, :flank]
+    reads = upstream.sum(axis=1)
+    sorted_peaks = np.sort(upstream, axis=1)
+    peaks = sorted_peaks[:, -1]
+    second_peaks = sorted_peaks[:, -2]
+    min_reads_high = target_reads if target_reads > 0 else 1000
+
+    with open(output_file, 'w') as FW:
+        FW.write("length\tp_offset\treads\tpeak_fraction\tpeak_ratio\tconfidence\n")
+        for i in range(len(offsets)):
+            peak_fraction = float(peaks[i]) / reads[i] if reads[i] > 0 else 0.0
+            peak_ratio = float(peaks[i]) / second_peaks[i] if second_peaks[i] > 0 else float(peaks[i])
+            if reads[i] < 100 or peak_ratio < 1.5:
+                confidence = "low"
+            elif reads[i] >= min_reads_high and peak_ratio >= 2:
+                confidence = "high"
+            else:
+                confidence = "medium"
+            FW.write(str(min_length + i) + "\t" + str(offsets[i]) + "\t" + str(reads[i]) + "\t" + \
+                     "%.3f" % peak_fraction + "\t" + "%.2f" % peak_ratio + "\t" + confidence + "\n")
+
+    return
+
+
+## Plot the metagene profile of each RPF length with its offset ##
+def plot_profiles(output_file, profiles, offsets, min_length, flank):
+
+    n_lengths = profiles.shape[0]
+    x = np.arange(-flank, flank + 1)
+    fig, axes = plt.subplots(n_lengths, 1, figsize=(7, 1.2 * n_lengths), sharex=True, squeeze=False)
+    for i in range(n_lengths):
+        ax = axes[i, 0]
+        ax.plot(x, profiles[i], color='#4B0082')
+        if offsets[i] <= flank:
+            ax.axvline(-offsets[i], color='#FF7F50', linestyle='--')
+        ax.set_yticks([])
+        ax.set_ylabel(str(min_length + i) + "\n(" + str(offsets[i]) + ")", rotation=0, ha='right', va='center', fontsize=8)
+    axes[-1, 0].set_xlabel("5' end distance to start codon (nt)")
+    fig.tight_layout()
+    fig.savefig(output_file)
+    plt.close(fig)
+
+    return
+
+
+#######Set Main##################
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception, e:
+        traceback.print_exc()
+        sys.exit(1)
+#################################